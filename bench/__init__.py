@@ -0,0 +1,28 @@
+# bench/
+# Pruebas de carga contra una base local (SQLite o Postgres) con datos sintéticos.
+# No se usa en producción.
+#
+#   python -m bench.sembrar --clientes 100000 --ventas 5000000
+#       llena clientes, precios, boletas, ventas, devoluciones y movimientos
+#       (por default en bench/bench.db; con PGHOST y demás, en ese Postgres)
+#
+#   python -m bench.carga --levantar --terminales 16 --segundos 60 --clientes 100000
+#       N terminales (Bascula + Caja) repitiendo el flujo real contra el server:
+#       nueva boleta -> pendientes -> cobrar -> devolución -> saldo.
+#       Al final imprime p50/p95/p99 y throughput por ruta y guarda el JSON.
+#
+#   python -m bench.informe bench/resultados.json [otro.json]
+#       vuelve a imprimir un resultado, o compara dos corridas
+#
+#   python -m bench.planes
+#       revisa el plan de cada query caliente sobre la base grande; sale con
+#       código 1 si alguna dejó de usar su índice
+#
+# Los dos primeros usan la misma semilla (--semilla) para que las corridas se
+# puedan repetir. La carga y planes necesitan httpx (pip install httpx).
+import os
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# sin PGHOST, el server (importado o levantado desde aquí) usa esta base y no rastro.db
+os.environ.setdefault("DB_PATH", os.path.join(BENCH_DIR, "bench.db"))
@@ -0,0 +1,182 @@
+# bench/carga.py
+# Carga contra el server corriendo: cada terminal es un par Bascula + Caja con
+# su propia sesión que repite el flujo real del rastro:
+#
+#   Bascula: nueva boleta -> pendientes
+#   Caja:    pendientes -> abrir cobro -> cobrar -> (a veces) devolución -> saldo
+#
+# La Caja cobra la boleta abierta más vieja que no haya tomado otra terminal
+# (como en el mostrador). Se mide cada request completo (con el cuerpo) y al
+# final se imprime p50/p95/p99 y throughput por ruta (bench/informe.py).
+#
+#   python -m bench.carga --levantar --terminales 8 --segundos 60
+#   python -m bench.carga --url http://127.0.0.1:8000 --clientes 100000
+#
+# --levantar arranca uvicorn con la misma configuración del entorno (PGHOST o
+# bench/bench.db) y lo apaga al terminar. --clientes debe ser el mismo que se
+# usó en bench.sembrar (los ids van de 1 a N).
+import argparse
+import os
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+from bench import BENCH_DIR
+from bench.informe import Resultados, guardar, imprimir, resumir
+
+BASE_DIR = os.path.dirname(BENCH_DIR)
+RE_COBRAR = re.compile(r"/boletas/cobrar/(\d+)")
+RE_VENTA = re.compile(r"Venta generada #(\d+)")
+MARCA_ERROR = "<b>Error:</b>"  # error_card() responde 200 con esta tarjeta
+
+def parsear_args(argv=None):
+    ap = argparse.ArgumentParser(description="Carga con terminales Bascula + Caja")
+    ap.add_argument("--url", default="http://127.0.0.1:8765")
+    ap.add_argument("--levantar", action="store_true", help="arrancar uvicorn en el puerto de --url")
+    ap.add_argument("--workers", type=int, default=1, help="workers de uvicorn con --levantar")
+    ap.add_argument("--terminales", type=int, default=4)
+    ap.add_argument("--segundos", type=float, default=30)
+    ap.add_argument("--clientes", type=int, default=1000, help="ids de cliente 1..N (los de bench.sembrar)")
+    ap.add_argument("--devoluciones", type=float, default=0.1, help="fracción de ventas con devolución")
+    ap.add_argument("--pausa", type=float, default=0.0, help="segundos entre pasos (tiempo de captura)")
+    ap.add_argument("--semilla", type=int, default=1)
+    ap.add_argument("--caja-password", default=os.getenv("CAJA_PASSWORD", "caja123"))
+    ap.add_argument("--bascula-password", default=os.getenv("BASCULA_PASSWORD", "bascula123"))
+    ap.add_argument("--salida", default=os.path.join(BENCH_DIR, "resultados.json"))
+    return ap.parse_args(argv)
+
+class Mostrador:
+    """Boletas ya tomadas por alguna Caja (compartido entre terminales)."""
+
+    def __init__(self):
+        self.tomadas: set = set()
+        self.lock = threading.Lock()
+
+    def tomar(self, ids) -> int:
+        with self.lock:
+            for boleta_id in ids:
+                if boleta_id not in self.tomadas:
+                    self.tomadas.add(boleta_id)
+                    return boleta_id
+        return 0
+
+class Terminal(threading.Thread):
+    def __init__(self, num: int, args, resultados: Resultados, mostrador: Mostrador, hasta: float):
+        super().__init__(daemon=True)
+        self.args, self.resultados, self.mostrador, self.hasta = args, resultados, mostrador, hasta
+        self.rng = random.Random(args.semilla * 1000 + num)
+        self.bascula = httpx.Client(base_url=args.url, timeout=60)
+        self.caja = httpx.Client(base_url=args.url, timeout=60)
+
+    def pedir(self, cliente: httpx.Client, metodo: str, url: str, ruta: str, **kwargs) -> str:
+        """Hace el request y lo registra con la plantilla de la ruta. Regresa el cuerpo."""
+        inicio = time.perf_counter()
+        try:
+            r = cliente.request(metodo, url, **kwargs)
+            ok = r.status_code < 400 and MARCA_ERROR not in r.text
+            texto = r.text
+        except httpx.HTTPError:
+            ok, texto = False, ""
+        self.resultados.registrar(f"{metodo} {ruta}", time.perf_counter() - inicio, ok)
+        if self.args.pausa:
+            time.sleep(self.args.pausa)
+        return texto
+
+    def login(self):
+        self.pedir(self.bascula, "POST", "/login", "/login",
+                   data={"username": "Bascula", "password": self.args.bascula_password})
+        self.pedir(self.caja, "POST", "/login", "/login",
+                   data={"username": "Caja", "password": self.args.caja_password})
+
+    def ciclo(self):
+        rng = self.rng
+        cliente_id = 0 if rng.random() < 0.25 else rng.randint(1, self.args.clientes)
+        producto_id = rng.choices([1, 2, 3, 4, 5], [45, 15, 20, 12, 8])[0]
+        tipo = rng.choices(["normal", "mayoreo", "menudeo"], [60, 30, 10])[0] if producto_id <= 2 else "normal"
+        cajas = rng.randint(1, 6)
+        self.pedir(self.bascula, "POST", "/boletas/nueva", "/boletas/nueva", data={
+            "cliente_id": cliente_id, "producto_id": producto_id, "tipo_venta": tipo,
+            "num_pollos": cajas * 9, "num_cajas": cajas,
+            "peso_total_kg": round(cajas * rng.uniform(18, 24), 3), "comentarios": "bench",
+        })
+        self.pedir(self.bascula, "GET", "/boletas/pendientes", "/boletas/pendientes")
+
+        pendientes = self.pedir(self.caja, "GET", "/boletas/pendientes", "/boletas/pendientes")
+        boleta_id = self.mostrador.tomar(int(i) for i in RE_COBRAR.findall(pendientes))
+        if not boleta_id:
+            return
+        self.pedir(self.caja, "GET", f"/boletas/cobrar/{boleta_id}", "/boletas/cobrar/{boleta_id}")
+        metodo = rng.choices(["efectivo", "tarjeta", "credito_cliente"], [45, 10, 45])[0]
+        cobro = self.pedir(self.caja, "POST", f"/boletas/cobrar/{boleta_id}", "/boletas/cobrar/{boleta_id}",
+                           data={"peso_caja_kg": 1.8, "metodo_pago": metodo})
+        venta = RE_VENTA.search(cobro)
+        if venta and rng.random() < self.args.devoluciones:
+            self.pedir(self.caja, "POST", "/devoluciones/nueva", "/devoluciones/nueva", data={
+                "venta_id": venta.group(1), "peso_devuelto_kg": round(rng.uniform(0.2, 2), 3),
+                "motivo": "bench",
+            })
+        if cliente_id:
+            self.pedir(self.caja, "GET", f"/clientes/saldo?cliente_id={cliente_id}", "/clientes/saldo")
+
+    def run(self):
+        try:
+            self.login()
+            while time.perf_counter() < self.hasta:
+                self.ciclo()
+        finally:
+            self.bascula.close()
+            self.caja.close()
+
+def levantar(url: str, workers: int) -> subprocess.Popen:
+    puerto = httpx.URL(url).port or 80
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--port", str(puerto),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=BASE_DIR, env=os.environ.copy(),
+    )
+    for _ in range(300):
+        try:
+            if httpx.get(url + "/login", timeout=1).status_code == 200:
+                return proc
+        except httpx.HTTPError:
+            pass
+        if proc.poll() is not None:
+            sys.exit("uvicorn no arrancó")
+        time.sleep(0.1)
+    proc.terminate()
+    sys.exit("uvicorn no respondió en 30s")
+
+def correr(args):
+    proc = levantar(args.url, args.workers) if args.levantar else None
+    try:
+        resultados = Resultados()
+        mostrador = Mostrador()
+        inicio = time.perf_counter()
+        terminales = [Terminal(n, args, resultados, mostrador, inicio + args.segundos)
+                      for n in range(args.terminales)]
+        for t in terminales:
+            t.start()
+        for t in terminales:
+            t.join()
+        segundos = time.perf_counter() - inicio
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+
+    motor = "postgres" if os.getenv("PGHOST") else "sqlite"
+    resumen = resumir(resultados, segundos, {
+        "motor": motor, "terminales": args.terminales, "segundos": round(segundos, 1),
+        "workers": args.workers if args.levantar else None, "clientes": args.clientes,
+    })
+    imprimir(resumen)
+    guardar(resumen, args.salida)
+    print(f"\nguardado en {args.salida}")
+
+if __name__ == "__main__":
+    correr(parsear_args())
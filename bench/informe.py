@@ -0,0 +1,99 @@
+# bench/informe.py
+# Latencias por ruta de una corrida de bench.carga: p50/p95/p99, máximo,
+# throughput y errores. También compara dos corridas guardadas.
+#
+#   python -m bench.informe bench/resultados.json
+#   python -m bench.informe antes.json despues.json
+import json
+import sys
+import threading
+
+class Resultados:
+    """Duraciones por ruta ("GET /boletas/pendientes"); lo comparten las terminales."""
+
+    def __init__(self):
+        self.duraciones: dict = {}
+        self.errores: dict = {}
+        self.lock = threading.Lock()
+
+    def registrar(self, ruta: str, segundos: float, ok: bool):
+        with self.lock:
+            self.duraciones.setdefault(ruta, []).append(segundos)
+            if not ok:
+                self.errores[ruta] = self.errores.get(ruta, 0) + 1
+
+def percentil(ordenados: list, p: float) -> float:
+    """Percentil por rango más cercano sobre una lista ya ordenada."""
+    if not ordenados:
+        return 0.0
+    i = max(0, min(len(ordenados) - 1, round(p / 100 * len(ordenados) + 0.5) - 1))
+    return ordenados[i]
+
+def resumir(resultados: Resultados, segundos: float, corrida: dict) -> dict:
+    rutas = []
+    todas = []
+    for ruta, duraciones in sorted(resultados.duraciones.items()):
+        ordenados = sorted(duraciones)
+        todas.extend(ordenados)
+        rutas.append({
+            "ruta": ruta,
+            "n": len(ordenados),
+            "por_seg": round(len(ordenados) / segundos, 2),
+            "errores": resultados.errores.get(ruta, 0),
+            "p50_ms": round(percentil(ordenados, 50) * 1000, 1),
+            "p95_ms": round(percentil(ordenados, 95) * 1000, 1),
+            "p99_ms": round(percentil(ordenados, 99) * 1000, 1),
+            "max_ms": round(ordenados[-1] * 1000, 1),
+        })
+    todas.sort()
+    total = {
+        "ruta": "TOTAL", "n": len(todas), "por_seg": round(len(todas) / segundos, 2) if segundos else 0,
+        "errores": sum(resultados.errores.values()),
+        "p50_ms": round(percentil(todas, 50) * 1000, 1),
+        "p95_ms": round(percentil(todas, 95) * 1000, 1),
+        "p99_ms": round(percentil(todas, 99) * 1000, 1),
+        "max_ms": round(todas[-1] * 1000, 1) if todas else 0.0,
+    }
+    return {"corrida": corrida, "rutas": rutas + [total]}
+
+COLUMNAS = [("n", 7), ("por_seg", 8), ("errores", 7), ("p50_ms", 8), ("p95_ms", 8), ("p99_ms", 8), ("max_ms", 8)]
+
+def imprimir(resumen: dict):
+    print(" ".join(f"{k}={v}" for k, v in resumen["corrida"].items()))
+    ancho = max(len(r["ruta"]) for r in resumen["rutas"])
+    print(f"{'ruta':<{ancho}} " + " ".join(f"{c:>{w}}" for c, w in COLUMNAS))
+    for r in resumen["rutas"]:
+        print(f"{r['ruta']:<{ancho}} " + " ".join(f"{r[c]:>{w}}" for c, w in COLUMNAS))
+
+def comparar(antes: dict, despues: dict):
+    """p50/p95/p99 de cada ruta en las dos corridas y el cambio en %."""
+    previas = {r["ruta"]: r for r in antes["rutas"]}
+    ancho = max(len(r["ruta"]) for r in despues["rutas"])
+    print(f"{'ruta':<{ancho}} " + " ".join(f"{c:>22}" for c in ("p50_ms", "p95_ms", "p99_ms")))
+    for r in despues["rutas"]:
+        a = previas.get(r["ruta"])
+        celdas = []
+        for c in ("p50_ms", "p95_ms", "p99_ms"):
+            if a is None:
+                celdas.append(f"{'—':>9} -> {r[c]:>9}   ")
+                continue
+            cambio = f"{100 * (r[c] - a[c]) / a[c]:+.0f}%" if a[c] else ""
+            celdas.append(f"{a[c]:>7} -> {r[c]:>7} {cambio:>5}")
+        print(f"{r['ruta']:<{ancho}} " + " ".join(celdas))
+
+def guardar(resumen: dict, archivo: str):
+    with open(archivo, "w", encoding="utf-8") as f:
+        json.dump(resumen, f, ensure_ascii=False, indent=2)
+
+def cargar(archivo: str) -> dict:
+    with open(archivo, encoding="utf-8") as f:
+        return json.load(f)
+
+if __name__ == "__main__":
+    archivos = sys.argv[1:]
+    if len(archivos) == 1:
+        imprimir(cargar(archivos[0]))
+    elif len(archivos) == 2:
+        comparar(cargar(archivos[0]), cargar(archivos[1]))
+    else:
+        sys.exit("Uso: python -m bench.informe resultados.json [otro.json]")
@@ -0,0 +1,256 @@
+# bench/planes.py
+# Revisa que las queries calientes sigan usando índices. Sobre una base grande
+# de bench.sembrar recorre las páginas y el flujo de cobro con el diagnóstico de
+# queries prendido (DB_DIAGNOSTICO, ver server.py), así se revisan las queries que
+# el server arma de verdad, con sus parámetros. A cada forma distinta le saca el
+# plan (EXPLAIN QUERY PLAN en SQLite, EXPLAIN (FORMAT JSON) en Postgres) y marca:
+#
+#   - recorrido completo (SCAN / Seq Scan) de una tabla grande, salvo que la
+#     query termine pronto por su LIMIT sin ordenar aparte;
+#   - ordenamiento aparte (USE TEMP B-TREE / Sort) sobre muchas filas.
+#
+# Las queries que recorren todo a propósito van en PERMITIDAS con su razón.
+# Sale con código 1 si algo se marca, para correrlo en CI o antes de subir cambios
+# a queries o índices.
+#
+#   python -m bench.planes                     siembra bench/bench.db si hace falta
+#   python -m bench.planes --ventas 2000000    base más grande (se vuelve a sembrar)
+#   python -m bench.planes --planes            imprime todos los planes
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+from datetime import date, timedelta
+
+LOG = os.path.join(tempfile.gettempdir(), f"bench_planes_{os.getpid()}.log")
+# antes de importar server: captura cada query con sus parámetros
+os.environ.update(DB_DIAGNOSTICO="1", DB_LENTA_MS="0", DB_DIAGNOSTICO_LOG=LOG,
+                  PRECIOS_COMPACTAR_HORAS="0", SNAPSHOT_HORAS="0")
+
+from fastapi.testclient import TestClient
+
+import server
+from bench import sembrar
+from server import IS_POSTGRES, db_cursor, db_execute, normalizar_sql
+
+FILAS_GRANDE = 5000  # una tabla con menos filas se puede recorrer completa
+SORT_FILAS_MAX = 1000  # Postgres: Sort estimado en más filas que esto se marca
+
+# (ruta, fragmento del SQL) -> (problemas que se aceptan, razón). "*" en la ruta
+# = cualquiera. "recorre" = tabla completa, "ordena" = ordenamiento aparte.
+RECORRIDO_COMPLETO = ("recorre", "ordena")  # se aceptan los dos
+PERMITIDAS = {
+    ("/export/{nombre}.csv", ""): (RECORRIDO_COMPLETO, "el export recorre el rango completo a propósito"),
+    ("/reportes/snapshot", ""): (RECORRIDO_COMPLETO, "el snapshot lee todo lo nuevo desde la última versión"),
+    ("*", "SELECT COUNT(*) AS c FROM clientes"): (RECORRIDO_COMPLETO, "contar_filas lo cachea; en Postgres usa reltuples"),
+    ("/clientes/cartera", "FROM saldos_clientes"): (RECORRIDO_COMPLETO, "la cartera resume todos los saldos"),
+    ("/api/clientes/sugerir", "FROM clientes ORDER BY nombre"): (RECORRIDO_COMPLETO, "el índice de prefijos se carga completo una vez"),
+    # la búsqueda sí debe usar su índice (FTS5 / pg_trgm); ordenar por relevancia
+    # los que coinciden no tiene índice posible
+    ("/clientes", "clientes_fts MATCH"): (("ordena",), "ordenar por relevancia"),
+    ("/clientes", "word_similarity"): (("ordena",), "ordenar por relevancia"),
+}
+
+def parsear_args(argv=None):
+    ap = argparse.ArgumentParser(description="Planes de las queries calientes")
+    ap.add_argument("--clientes", type=int, default=20000)
+    ap.add_argument("--ventas", type=int, default=500000)
+    ap.add_argument("--dias", type=int, default=365)
+    ap.add_argument("--planes", action="store_true", help="imprimir el plan de cada query")
+    return ap.parse_args(argv)
+
+def preparar_base(args):
+    """Siembra la base si no tiene al menos la escala pedida."""
+    server.init_db()
+    with server.db_conn() as conn:
+        c = db_cursor(conn)
+        db_execute(c, "SELECT COUNT(*) AS c FROM ventas")
+        ventas = int(c.fetchone()["c"])
+    if ventas < args.ventas * 0.9:
+        sembrar.sembrar(sembrar.parsear_args([
+            "--limpiar", "--clientes", str(args.clientes), "--ventas", str(args.ventas), "--dias", str(args.dias),
+        ]))
+
+def tablas_grandes() -> set:
+    grandes = set()
+    with server.db_conn() as conn:
+        c = db_cursor(conn)
+        for tabla in ("clientes", "precios", "boletas_pesaje", "ventas", "devoluciones",
+                      "movimientos_cliente", "saldos_clientes", "resumen_diario"):
+            db_execute(c, f"SELECT COUNT(*) AS c FROM {tabla}")
+            if int(c.fetchone()["c"]) >= FILAS_GRANDE:
+                grandes.add(tabla)
+    return grandes
+
+def _primer_link(html: str, patron: str) -> str:
+    m = re.search(patron, html)
+    return m.group(0).replace("&amp;", "&") if m else ""
+
+def recorrer(cl: TestClient):
+    """Las páginas y el flujo que hay que cubrir, con parámetros típicos."""
+    hoy = date.today()
+    mes = hoy.isoformat()[:7]
+    hace_un_mes = (hoy - timedelta(days=30)).isoformat()
+    with server.db_conn() as conn:
+        c = db_cursor(conn)
+        # un cliente con mucha historia (el saldo pagina sobre sus movimientos)
+        db_execute(c, "SELECT cliente_id FROM saldos_clientes ORDER BY num_movimientos DESC LIMIT 1")
+        row = c.fetchone()
+        cliente_id = row["cliente_id"] if row else 1
+        db_execute(c, "SELECT nombre FROM clientes WHERE id = ?", (cliente_id,))
+        nombre = c.fetchone()["nombre"]
+
+    cl.post("/login", data={"username": "Caja", "password": "caja123"})
+    paginas = [
+        "/", "/clientes", f"/clientes?q={cliente_id}", f"/clientes?q={nombre.split()[0]}",
+        f"/api/clientes/sugerir?q={nombre[:3]}", "/precios", "/precios/copiar",
+        "/precios/matriz", f"/api/precios/matriz?desde={hace_un_mes}&hasta={hoy}",
+        "/boletas/pendientes", "/boletas/cobradas", f"/clientes/saldo?cliente_id={cliente_id}",
+        "/clientes/saldos", "/clientes/cartera", f"/cierre?dia={hoy}", f"/cierre?mes={mes}",
+        "/export", "/reportes",
+    ]
+    for url in paginas:
+        html = cl.get(url).text
+        # la segunda página (cursor) usa otra forma de query
+        siguiente = _primer_link(html, r"[^\"'\s]*despues=[^\"'\s]+")
+        if siguiente:
+            cl.get(siguiente)
+
+    # flujo de cobro: nueva boleta, cobrar, devolución
+    cl.post("/boletas/nueva", data={"cliente_id": cliente_id, "producto_id": 1, "tipo_venta": "normal",
+                                    "num_pollos": 18, "num_cajas": 2, "peso_total_kg": 44})
+    boleta = re.findall(r"/boletas/cobrar/(\d+)", cl.get("/boletas/pendientes").text)[-1]
+    cl.get(f"/boletas/cobrar/{boleta}")
+    venta = re.search(r"Venta generada #(\d+)", cl.post(f"/boletas/cobrar/{boleta}", data={
+        "peso_caja_kg": 1.8, "metodo_pago": "credito_cliente"}).text)
+    if venta:
+        cl.post("/devoluciones/nueva", data={"venta_id": venta.group(1), "peso_devuelto_kg": 1})
+
+def queries_capturadas() -> dict:
+    """{sql normalizado: (ruta, sql, params)} de lo que se ejecutó."""
+    formas = {}
+    with open(LOG, encoding="utf-8") as f:
+        for linea in f:
+            r = json.loads(linea)
+            if r["tipo"] != "lenta" or "ruta" not in r:
+                continue
+            formas.setdefault(normalizar_sql(r["sql"]), (r["ruta"], r["sql"], r["params"]))
+    return formas
+
+def plan_sqlite(c, sql: str, params) -> list:
+    db_execute(c, "EXPLAIN QUERY PLAN " + sql, params)
+    return [r["detail"] for r in c.fetchall()]
+
+RE_TABLAS = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)(?:\s+(?:AS\s+)?(?!WHERE|JOIN|LEFT|ON|ORDER|GROUP|LIMIT|USING)(\w+))?", re.I)
+
+def _alias_sqlite(sql: str) -> dict:
+    """EXPLAIN QUERY PLAN nombra las tablas por su alias: alias -> tabla."""
+    alias = {}
+    for tabla, nombre in RE_TABLAS.findall(sql):
+        alias[tabla] = tabla
+        if nombre:
+            alias[nombre] = tabla
+    return alias
+
+def problemas_sqlite(plan: list, sql: str, grandes: set) -> list:
+    # SQLite no da estimados de filas: un ordenamiento aparte se marca si recorre
+    # completa una tabla grande, o si hay LIMIT (paginar o un top-N debe salir en
+    # el orden del índice, no ordenando todo lo que encontró)
+    problemas = []
+    tiene_limit = re.search(r"\bLIMIT\b", sql, re.I) is not None
+    ordena = any("USE TEMP B-TREE" in p for p in plan)
+    alias = _alias_sqlite(sql)
+    lee_grandes = completas = False
+    for paso in plan:
+        m = re.match(r"(SCAN|SEARCH) (\w+)", paso)
+        tabla = alias.get(m.group(2), m.group(2)) if m else None
+        if tabla not in grandes:
+            continue
+        lee_grandes = True
+        if m.group(1) == "SCAN" and " INDEX " not in paso and not (tiene_limit and not ordena):
+            completas = True
+            problemas.append(("recorre", f"recorre completa {tabla}"))
+    if ordena and (completas or (tiene_limit and lee_grandes)):
+        problemas.extend(("ordena", p.lower()) for p in plan if "USE TEMP B-TREE" in p)
+    return problemas
+
+def plan_postgres(c, sql: str, params) -> dict:
+    db_execute(c, "EXPLAIN (FORMAT JSON) " + sql, params)
+    plan = c.fetchone()["QUERY PLAN"]
+    return (json.loads(plan) if isinstance(plan, str) else plan)[0]["Plan"]
+
+def _nodos(nodo: dict, bajo_limit: bool = False):
+    yield nodo, bajo_limit
+    bajo_limit = bajo_limit or nodo["Node Type"] == "Limit"
+    for hijo in nodo.get("Plans", []):
+        yield from _nodos(hijo, bajo_limit)
+
+def problemas_postgres(plan: dict, grandes: set) -> list:
+    problemas = []
+    hay_sort = any(n["Node Type"] in ("Sort", "Incremental Sort") for n, _ in _nodos(plan))
+    for nodo, bajo_limit in _nodos(plan):
+        tipo = nodo["Node Type"]
+        if tipo == "Seq Scan" and nodo.get("Relation Name") in grandes and not (bajo_limit and not hay_sort):
+            problemas.append(("recorre", f"recorre completa {nodo['Relation Name']}"))
+        if tipo == "Sort" and nodo.get("Plan Rows", 0) > SORT_FILAS_MAX:
+            problemas.append(("ordena", f"sort de ~{nodo['Plan Rows']} filas ({', '.join(nodo.get('Sort Key', []))})"))
+    return problemas
+
+def _texto_plan_postgres(nodo: dict, nivel: int = 0) -> list:
+    detalle = nodo.get("Relation Name") or nodo.get("Index Name") or ""
+    lineas = [f"{'  ' * nivel}{nodo['Node Type']} {detalle} (~{nodo.get('Plan Rows')} filas)"]
+    for hijo in nodo.get("Plans", []):
+        lineas.extend(_texto_plan_postgres(hijo, nivel + 1))
+    return lineas
+
+def permitida(ruta: str, sql: str, problemas: list):
+    """La razón si todos los problemas están aceptados para esta query."""
+    for (r, fragmento), (aceptados, razon) in PERMITIDAS.items():
+        if r in ("*", ruta) and fragmento in sql and all(tipo in aceptados for tipo, _ in problemas):
+            return razon
+    return None
+
+def revisar(args) -> int:
+    if os.path.exists(LOG):
+        os.remove(LOG)
+    preparar_base(args)
+    grandes = tablas_grandes()
+    with TestClient(server.app) as cl:
+        recorrer(cl)
+    formas = queries_capturadas()
+    os.remove(LOG)
+
+    fallas = 0
+    with server.db_conn() as conn:
+        c = db_cursor(conn)
+        for ruta, sql, params in formas.values():
+            if server._operacion(sql) == "otra":
+                continue
+            if IS_POSTGRES:
+                arbol = plan_postgres(c, sql, params)
+                plan, problemas = _texto_plan_postgres(arbol), problemas_postgres(arbol, grandes)
+            else:
+                plan = plan_sqlite(c, sql, params)
+                problemas = problemas_sqlite(plan, sql, grandes)
+            razon = permitida(ruta, sql, problemas) if problemas else None
+            if problemas and not razon:
+                fallas += 1
+            if problemas or args.planes:
+                estado = "FALLA" if problemas and not razon else ("permitida: " + razon if razon else "ok")
+                print(f"[{estado}] {ruta}: {' '.join(sql.split())[:160]}")
+                for _, texto in problemas:
+                    print(f"    - {texto}")
+                if args.planes or (problemas and not razon):
+                    for linea in plan:
+                        print(f"      {linea}")
+        conn.rollback()
+
+    motor = "postgres" if IS_POSTGRES else "sqlite"
+    print(f"\n{len(formas)} queries distintas en {motor} (tablas grandes: {', '.join(sorted(grandes))}); "
+          f"{fallas} con plan malo")
+    return 1 if fallas else 0
+
+if __name__ == "__main__":
+    sys.exit(revisar(parsear_args()))
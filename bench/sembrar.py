@@ -0,0 +1,324 @@
+# bench/sembrar.py
+# Llena la base con datos sintéticos a la escala que se pida. Las distribuciones
+# imitan la operación real: pocos clientes concentran la mayoría de las compras,
+# las ventas caen en la mañana, los precios generales cambian cada pocos días,
+# algunos clientes tienen precio especial, los créditos se abonan días después y
+# ~2% de las ventas tienen devolución. Los derivados (saldos, vigencias de
+# precios, resumen_diario) se calculan al final igual que en la app.
+#
+#   python -m bench.sembrar                                  escala chica (1000 / 50000)
+#   python -m bench.sembrar --clientes 100000 --ventas 5000000 --dias 730
+#   python -m bench.sembrar --limpiar ...                    borra lo que haya antes
+#
+# Sin PGHOST escribe en bench/bench.db (ver bench/__init__.py).
+import argparse
+import heapq
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+import server
+from server import IS_POSTGRES, db_cursor, db_execute
+
+TABLAS = ["devoluciones", "ventas", "boletas_pesaje", "movimientos_cliente",
+          "saldos_clientes", "resumen_diario", "precios", "clientes"]
+LOTE_VENTAS = 20000  # se escribe y commitea cada tantas ventas
+
+NOMBRES = ["Juan", "María", "José", "Guadalupe", "Francisco", "Juana", "Antonio", "Rosa",
+           "Pedro", "Margarita", "Miguel", "Teresa", "Alejandro", "Carmen", "Jesús", "Lucía"]
+APELLIDOS = ["Hernández", "García", "Martínez", "López", "González", "Pérez", "Rodríguez",
+             "Sánchez", "Ramírez", "Cruz", "Flores", "Gómez", "Morales", "Vázquez", "Reyes"]
+NEGOCIOS = ["Pollería", "Rosticería", "Taquería", "Cocina económica", "Carnicería", "Restaurante"]
+MOTIVOS = ["mal estado", "peso incorrecto", "producto equivocado", "cliente canceló", ""]
+
+# (código, peso en el total de ventas, precio base por kg)
+PRODUCTOS = [("POLLO_ENTERO", 45, 46.0), ("POLLO_VIVO", 15, 38.0), ("PECHUGA", 20, 95.0),
+             ("PIERNA_MUSLO", 12, 62.0), ("ALITAS", 8, 72.0)]
+TIPOS = [("normal", 60, 0.0), ("mayoreo", 30, -3.5), ("menudeo", 10, 4.0)]
+TIPOS_NOMBRES = [t[0] for t in TIPOS]
+TIPOS_PESOS = [t[1] for t in TIPOS]
+# kg de la boleta: media del log por tipo (mayoreo = pedidos grandes)
+LOG_KG = {"normal": 3.0, "mayoreo": 4.6, "menudeo": 1.6}
+PESO_CAJA_KG = 1.8
+KG_POR_CAJA = 22
+KG_POR_POLLO = 2.4
+
+def parsear_args(argv=None):
+    ap = argparse.ArgumentParser(description="Datos sintéticos para pruebas de carga")
+    ap.add_argument("--clientes", type=int, default=1000)
+    ap.add_argument("--ventas", type=int, default=50000)
+    ap.add_argument("--dias", type=int, default=365, help="días de historia hasta ayer")
+    ap.add_argument("--abiertas", type=int, default=20, help="boletas de hoy sin cobrar")
+    ap.add_argument("--contado", type=float, default=0.25, help="fracción de ventas sin cliente")
+    ap.add_argument("--especiales", type=float, default=0.05, help="fracción de clientes con precio especial")
+    ap.add_argument("--devoluciones", type=float, default=0.02, help="fracción de ventas con devolución")
+    ap.add_argument("--semilla", type=int, default=1)
+    ap.add_argument("--limpiar", action="store_true", help="borrar clientes, precios y movimientos antes")
+    return ap.parse_args(argv)
+
+def insertar(c, tabla: str, columnas: str, filas: list):
+    if not filas:
+        return
+    if IS_POSTGRES:
+        execute_values(c, f"INSERT INTO {tabla} ({columnas}) VALUES %s", filas, page_size=1000)
+    else:
+        marcas = ", ".join("?" * len(filas[0]))
+        c.executemany(f"INSERT INTO {tabla} ({columnas}) VALUES ({marcas})", filas)
+
+def limpiar(c):
+    if IS_POSTGRES:
+        db_execute(c, f"TRUNCATE {', '.join(TABLAS)} RESTART IDENTITY")
+        return
+    for tabla in TABLAS:
+        db_execute(c, f"DELETE FROM {tabla}")
+    db_execute(c, "DELETE FROM sqlite_sequence WHERE name IN (%s)" % ", ".join("?" * len(TABLAS)), TABLAS)
+
+def _hay_datos(c) -> bool:
+    for tabla in ("clientes", "ventas", "precios"):
+        db_execute(c, f"SELECT COUNT(*) AS c FROM {tabla}")
+        if int(c.fetchone()["c"]):
+            return True
+    return False
+
+class Sembrador:
+    def __init__(self, args, productos: dict):
+        self.args = args
+        self.rng = random.Random(args.semilla)
+        self.productos = [(productos[cod], peso, base) for cod, peso, base in PRODUCTOS if cod in productos]
+        self.con_tipos = {productos[cod] for cod in server.PRODUCTOS_CON_TIPOS if cod in productos}
+        self.producto_ids = [p[0] for p in self.productos]
+        self.producto_pesos = [p[1] for p in self.productos]
+        self.cliente_ids = range(1, args.clientes + 1)
+        # ids explícitos: la base empieza vacía y así las referencias se arman aquí
+        self.ids = {"precio": 0, "venta": 0, "devolucion": 0, "movimiento": 0}
+        # precio vigente: general (producto, tipo) y especial (cliente, producto, tipo)
+        self.general: dict = {}
+        self.especial: dict = {}
+        # saldo, movimientos, último movimiento, último pago
+        self.saldos: dict = {}
+        self.abonos: list = []  # heap (fecha_hora, cliente_id, monto)
+        self.lote = {"precios": [], "boletas": [], "ventas": [], "devoluciones": [], "movimientos": []}
+
+        # Pareto: el 20% de los clientes hace la mayor parte de las compras
+        pesos = [self.rng.paretovariate(1.16) for _ in range(args.clientes)]
+        acumulado, total = [], 0.0
+        for p in pesos:
+            total += p
+            acumulado.append(total)
+        self.clientes_acum = acumulado
+
+    def _id(self, tipo: str) -> int:
+        self.ids[tipo] += 1
+        return self.ids[tipo]
+
+    def clientes(self, c):
+        filas = []
+        for cid in range(1, self.args.clientes + 1):
+            if self.rng.random() < 0.4:
+                nombre = f"{self.rng.choice(NEGOCIOS)} {self.rng.choice(APELLIDOS)}"
+            else:
+                nombre = f"{self.rng.choice(NOMBRES)} {self.rng.choice(APELLIDOS)} {self.rng.choice(APELLIDOS)}"
+            referencia = f"Mercado {self.rng.randint(1, 40)} local {self.rng.randint(1, 300)}"
+            filas.append((cid, nombre, referencia))
+        insertar(c, "clientes", "id, nombre, referencia", filas)
+
+    def _tipos(self, producto_id):
+        return TIPOS if producto_id in self.con_tipos else TIPOS[:1]
+
+    def _precio(self, cliente_id, producto_id, tipo, dia: str, precio: float):
+        precio = round(precio, 2)
+        self.lote["precios"].append((self._id("precio"), cliente_id, producto_id, dia, tipo, precio))
+        if cliente_id is None:
+            self.general[(producto_id, tipo)] = precio
+        else:
+            self.especial[(cliente_id, producto_id, tipo)] = precio
+
+    def precios_del_dia(self, dia: date, primero: bool):
+        txt = dia.isoformat()
+        for producto_id, _, base in self.productos:
+            for tipo, _, ajuste in self._tipos(producto_id):
+                # el general se mueve cada ~4 días con una caminata aleatoria
+                if primero or self.rng.random() < 0.25:
+                    anterior = self.general.get((producto_id, tipo), base + ajuste)
+                    nuevo = anterior * (1 + self.rng.gauss(0, 0.02))
+                    self._precio(None, producto_id, tipo, txt, min(max(nuevo, (base + ajuste) * 0.7), (base + ajuste) * 1.4))
+        if primero:
+            for cliente_id in range(1, self.args.clientes + 1):
+                if self.rng.random() < self.args.especiales:
+                    producto_id = self._producto()
+                    tipo = self._tipo(producto_id)
+                    self._precio(cliente_id, producto_id, tipo, txt,
+                                 self.general[(producto_id, tipo)] * self.rng.uniform(0.9, 0.97))
+        elif self.especial and self.rng.random() < 0.03:
+            # de vez en cuando se renegocia un especial
+            llave = self.rng.choice(list(self.especial))
+            self._precio(*llave, txt, self.general[llave[1:]] * self.rng.uniform(0.9, 0.97))
+
+    def _producto(self):
+        return self.rng.choices(self.producto_ids, self.producto_pesos)[0]
+
+    def _tipo(self, producto_id):
+        if producto_id not in self.con_tipos:
+            return "normal"
+        return self.rng.choices(TIPOS_NOMBRES, TIPOS_PESOS)[0]
+
+    def _cliente(self):
+        if self.rng.random() < self.args.contado:
+            return None
+        return self.rng.choices(self.cliente_ids, cum_weights=self.clientes_acum)[0]
+
+    def _hora(self, dia: date) -> datetime:
+        # de 5:00 a 15:00, con el pico a las 8
+        minutos = int(self.rng.triangular(5 * 60, 15 * 60, 8 * 60))
+        return datetime(dia.year, dia.month, dia.day) + timedelta(minutes=minutos, seconds=self.rng.randint(0, 59))
+
+    def _pesaje(self, producto_id, tipo):
+        kg = self.rng.lognormvariate(LOG_KG[tipo], 0.6)
+        cajas = max(1, round(kg / KG_POR_CAJA))
+        kg = max(kg, cajas * PESO_CAJA_KG + 0.5)
+        pollos = round(kg / KG_POR_POLLO) if producto_id in self.con_tipos else 0
+        return round(kg, 3), cajas, pollos
+
+    def dia(self, dia: date, num_ventas: int):
+        eventos = []  # movimientos del día; se ordenan para calcular saldo_despues
+        for _ in range(num_ventas):
+            cliente_id = self._cliente()
+            producto_id = self._producto()
+            tipo = self._tipo(producto_id)
+            kg, cajas, pollos = self._pesaje(producto_id, tipo)
+            hora = self._hora(dia)
+            precio = self.especial.get((cliente_id, producto_id, tipo)) or self.general[(producto_id, tipo)]
+            neto = round(kg - cajas * PESO_CAJA_KG, 3)
+            total = round(neto * precio, 2)
+            if cliente_id is None:
+                metodo = "efectivo" if self.rng.random() < 0.8 else "tarjeta"
+            else:
+                metodo = self.rng.choices(["credito_cliente", "efectivo", "tarjeta"], [45, 45, 10])[0]
+
+            venta_id = self._id("venta")
+            pesada = (hora - timedelta(minutes=self.rng.randint(2, 40))).isoformat(timespec="seconds")
+            cobrada = hora.isoformat(timespec="seconds")
+            self.lote["boletas"].append((venta_id, pesada, cliente_id, producto_id, tipo,
+                                         pollos, cajas, kg, "", "cerrada"))
+            self.lote["ventas"].append((venta_id, cobrada, venta_id, cliente_id, producto_id,
+                                        neto, precio, total, metodo))
+
+            if cliente_id is not None and metodo == "credito_cliente":
+                eventos.append((cobrada, cliente_id, "venta", venta_id, total))
+                # la mayoría abona el crédito completo a los pocos días
+                if self.rng.random() < 0.9:
+                    abono = hora + timedelta(days=1 + int(self.rng.expovariate(1 / 6)), hours=self.rng.randint(0, 5))
+                    heapq.heappush(self.abonos, (abono.isoformat(timespec="seconds"), cliente_id, total))
+
+            if self.rng.random() < self.args.devoluciones:
+                devuelto = round(neto * self.rng.uniform(0.05, 0.3), 3)
+                monto = round(devuelto * precio, 2)
+                dev_id = self._id("devolucion")
+                fecha_dev = min(hora + timedelta(minutes=self.rng.randint(10, 300)),
+                                datetime(dia.year, dia.month, dia.day, 23, 59)).isoformat(timespec="seconds")
+                self.lote["devoluciones"].append((dev_id, fecha_dev, venta_id, cliente_id, devuelto, monto,
+                                                  self.rng.choice(MOTIVOS)))
+                if cliente_id is not None:
+                    eventos.append((fecha_dev, cliente_id, "devolucion", dev_id, -monto))
+
+        fin_dia = (dia + timedelta(days=1)).isoformat()
+        while self.abonos and self.abonos[0][0] < fin_dia:
+            fecha_hora, cliente_id, monto = heapq.heappop(self.abonos)
+            eventos.append((fecha_hora, cliente_id, "ajuste", 0, -monto))
+
+        eventos.sort(key=lambda e: e[0])
+        for fecha_hora, cliente_id, tipo, referencia_id, monto in eventos:
+            saldo = self.saldos.setdefault(cliente_id, [0.0, 0, None, None])
+            saldo[0] = round(saldo[0] + monto, 2)
+            saldo[1] += 1
+            saldo[2] = fecha_hora
+            if monto < 0 and tipo != "devolucion":
+                saldo[3] = fecha_hora
+            self.lote["movimientos"].append((self._id("movimiento"), fecha_hora, cliente_id, tipo,
+                                             referencia_id, monto, saldo[0]))
+
+    def abiertas(self, hoy: date):
+        for _ in range(self.args.abiertas):
+            producto_id = self._producto()
+            tipo = self._tipo(producto_id)
+            kg, cajas, pollos = self._pesaje(producto_id, tipo)
+            self.lote["boletas"].append((self._id("venta"), self._hora(hoy).isoformat(timespec="seconds"),
+                                         self._cliente(), producto_id, tipo, pollos, cajas, kg, "", "abierta"))
+
+    def escribir(self, c):
+        lote = self.lote
+        insertar(c, "precios", "id, cliente_id, producto_id, fecha, tipo_venta, precio_por_kg", lote["precios"])
+        insertar(c, "boletas_pesaje", "id, fecha_hora, cliente_id, producto_id, tipo_venta, num_pollos, "
+                                      "num_cajas, peso_total_kg, comentarios, estado", lote["boletas"])
+        insertar(c, "ventas", "id, fecha_hora, boleta_id, cliente_id, producto_id, peso_neto_kg, "
+                              "precio_por_kg, total, metodo_pago", lote["ventas"])
+        insertar(c, "devoluciones", "id, fecha_hora, venta_id, cliente_id, peso_devuelto_kg, "
+                                    "monto_devuelto, motivo", lote["devoluciones"])
+        insertar(c, "movimientos_cliente", "id, fecha_hora, cliente_id, tipo, referencia_id, monto, "
+                                           "saldo_despues", lote["movimientos"])
+        for filas in lote.values():
+            filas.clear()
+
+    def saldos_clientes(self, c):
+        insertar(c, "saldos_clientes", "cliente_id, saldo, num_movimientos, ultimo_movimiento, ultimo_pago",
+                 [(cid, *s) for cid, s in self.saldos.items()])
+
+def sembrar(args):
+    inicio = time.perf_counter()
+    server.init_db()
+    with server.db_conn(escritura=True) as conn:
+        c = db_cursor(conn)
+        if args.limpiar:
+            limpiar(c)
+            conn.commit()
+        elif _hay_datos(c):
+            sys.exit("La base ya tiene datos; usa --limpiar para borrarlos antes de sembrar.")
+
+        db_execute(c, "SELECT id, codigo FROM productos")
+        s = Sembrador(args, {r["codigo"]: r["id"] for r in c.fetchall()})
+        s.clientes(c)
+        conn.commit()
+        print(f"clientes: {args.clientes}")
+
+        hoy = date.today()
+        dias = [hoy - timedelta(days=n) for n in range(args.dias, 0, -1)]
+        # domingo flojo, sábado fuerte
+        factor = [1.0, 1.0, 1.0, 1.0, 1.1, 1.3, 0.5]
+        total_factor = sum(factor[d.weekday()] for d in dias)
+        pendientes = 0
+        for i, dia in enumerate(dias):
+            s.precios_del_dia(dia, primero=(i == 0))
+            num = args.ventas * factor[dia.weekday()] / total_factor
+            num = int(num) + (1 if s.rng.random() < num % 1 else 0)
+            s.dia(dia, num)
+            pendientes += num
+            if pendientes >= LOTE_VENTAS:
+                s.escribir(c)
+                conn.commit()
+                pendientes = 0
+                print(f"  {dia}: {s.ids['venta']} ventas", flush=True)
+        s.precios_del_dia(hoy, primero=not dias)
+        s.abiertas(hoy)
+        s.escribir(c)
+        s.saldos_clientes(c)
+        conn.commit()
+
+        print("derivados: vigencias de precios, resumen_diario", flush=True)
+        server.recalcular_vigencias(c)
+        server.reconstruir_resumen_diario(c)
+        if IS_POSTGRES:
+            for tabla in ("clientes", "precios", "boletas_pesaje", "ventas", "devoluciones", "movimientos_cliente"):
+                db_execute(c, f"SELECT setval(pg_get_serial_sequence('{tabla}', 'id'), "
+                              f"COALESCE((SELECT MAX(id) FROM {tabla}), 0) + 1, false)")
+        conn.commit()
+        db_execute(c, "ANALYZE")
+        conn.commit()
+
+    print(f"listo en {time.perf_counter() - inicio:.1f}s: {s.ids['venta'] - args.abiertas} ventas, "
+          f"{s.ids['devolucion']} devoluciones, {s.ids['movimiento']} movimientos, {s.ids['precio']} precios")
+
+if __name__ == "__main__":
+    sembrar(parsear_args())
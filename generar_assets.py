@@ -0,0 +1,33 @@
+# generar_assets.py
+# Genera las variantes chicas del logo que usa el header (se ve a 110px de alto).
+# Se corre a mano cuando cambie el logo original y se suben los archivos que deja
+# en static/. Necesita Pillow (pip install pillow), que no hace falta en producción.
+import os
+
+from PIL import Image
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, "static")
+LOGO_ORIGINAL = os.path.join(STATIC_DIR, "logo_san_pablito.png")
+
+# alto en px: 1x y 2x (pantallas retina / tablet)
+ALTOS_LOGO = [110, 220]
+
+def generar_logos():
+    with Image.open(LOGO_ORIGINAL) as img:
+        img = img.convert("RGBA")
+        for alto in ALTOS_LOGO:
+            ancho = round(img.width * alto / img.height)
+            chico = img.resize((ancho, alto), Image.LANCZOS)
+
+            png = os.path.join(STATIC_DIR, f"logo_san_pablito_{alto}.png")
+            chico.quantize(colors=256, method=Image.FASTOCTREE).save(png, optimize=True)
+
+            webp = os.path.join(STATIC_DIR, f"logo_san_pablito_{alto}.webp")
+            chico.save(webp, "WEBP", quality=85, method=6)
+
+            print(f"{os.path.basename(png)}: {os.path.getsize(png)} bytes")
+            print(f"{os.path.basename(webp)}: {os.path.getsize(webp)} bytes")
+
+if __name__ == "__main__":
+    generar_logos()
@@ -0,0 +1,32 @@
+# reconstruir_resumen.py
+# Recalcula resumen_diario (la tabla del cierre de caja) a partir de ventas y
+# devoluciones. Se corre a mano si se corrigieron ventas directo en la base o
+# para revisar que el resumen cuadre. Usa la misma configuración que el servidor
+# (PGHOST y demás para Postgres; si no, rastro.db).
+#
+#   python reconstruir_resumen.py                        todo el historial
+#   python reconstruir_resumen.py 2026-10-01             un día
+#   python reconstruir_resumen.py 2026-10-01 2026-10-31  un rango (incluye ambos)
+import sys
+from datetime import date
+
+import server
+
+def reconstruir(desde=None, hasta=None):
+    server.init_db()  # aplica migraciones pendientes
+    with server.db_conn(escritura=True) as conn:
+        c = server.db_cursor(conn)
+        filas = server.reconstruir_resumen_diario(c, desde, hasta)
+        conn.commit()
+    rango = f"{desde} a {hasta}" if desde else "todo el historial"
+    print(f"resumen_diario: {filas} filas ({rango})")
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    try:
+        fechas = [date.fromisoformat(a).isoformat() for a in args[:2]]
+    except ValueError:
+        sys.exit("Uso: python reconstruir_resumen.py [desde AAAA-MM-DD] [hasta AAAA-MM-DD]")
+    desde = fechas[0] if fechas else None
+    hasta = fechas[1] if len(fechas) > 1 else desde
+    reconstruir(desde, hasta)
@@ -0,0 +1,311 @@
+# reportes.py
+# Reportes de historial (kg por semana, rendimiento por cliente, etc.) sobre un
+# snapshot columnar de ventas y devoluciones, para no recorrer la base en vivo.
+#
+# El snapshot son archivos .npy (uno por columna) que se abren con mmap. Clientes,
+# productos, tipo de venta y método de pago van codificados como índices de un
+# diccionario que se guarda en meta.json. Las ventas y devoluciones no se
+# modifican después de creadas, así que cada actualización solo lee de la base
+# las filas con id mayor al último del snapshot (menos SNAPSHOT_SOLAPE, abajo).
+#
+#   python reportes.py snapshot     actualiza el snapshot (para un cron)
+#
+# Cada actualización escribe una carpeta nueva (snapshot/v<timestamp>) y al final
+# cambia snapshot/ACTUAL, así quien esté leyendo nunca ve archivos a medias.
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+import server
+
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(server.BASE_DIR, "snapshot"))
+SNAPSHOT_VERSIONES = 2  # carpetas que se conservan (la actual y la anterior)
+FETCH = 5000
+# En Postgres con varios workers los ids de la secuencia no se commitean en
+# orden: una venta con id menor puede commitearse después de un snapshot y
+# quedaría fuera para siempre. Por eso cada actualización vuelve a leer los
+# últimos SNAPSHOT_SOLAPE ids y descarta los que ya estaban. En SQLite hay un
+# solo escritor (BEGIN IMMEDIATE) y los ids se commitean en orden.
+SNAPSHOT_SOLAPE = int(os.getenv("SNAPSHOT_SOLAPE", "5000" if server.IS_POSTGRES else "0"))
+
+# columna -> dtype; las columnas de diccionario guardan el índice (-1 = sin valor)
+COLUMNAS = {
+    "ventas": {
+        "id": np.int64, "fecha": np.int32, "cliente": np.int32, "producto": np.int16,
+        "tipo_venta": np.int8, "metodo_pago": np.int8, "kg": np.float64,
+        "pollos": np.int32, "cajas": np.int32, "precio": np.float64, "total": np.float64,
+    },
+    "devoluciones": {
+        "id": np.int64, "fecha": np.int32, "cliente": np.int32, "producto": np.int16,
+        "tipo_venta": np.int8, "metodo_pago": np.int8, "kg": np.float64, "total": np.float64,
+    },
+}
+DICCIONARIOS = ("cliente", "producto", "tipo_venta", "metodo_pago")
+
+SQL_SNAPSHOT = {
+    "ventas": """
+        SELECT v.id, v.fecha_hora, v.cliente_id AS cliente, v.producto_id AS producto,
+               b.tipo_venta, v.metodo_pago, v.peso_neto_kg AS kg, b.num_pollos AS pollos,
+               b.num_cajas AS cajas, v.precio_por_kg AS precio, v.total
+        FROM ventas v
+        LEFT JOIN boletas_pesaje b ON b.id = v.boleta_id
+        WHERE v.id > ?
+        ORDER BY v.id
+    """,
+    "devoluciones": """
+        SELECT d.id, d.fecha_hora, d.cliente_id AS cliente, v.producto_id AS producto,
+               b.tipo_venta, v.metodo_pago, d.peso_devuelto_kg AS kg, d.monto_devuelto AS total
+        FROM devoluciones d
+        LEFT JOIN ventas v ON v.id = d.venta_id
+        LEFT JOIN boletas_pesaje b ON b.id = v.boleta_id
+        WHERE d.id > ?
+        ORDER BY d.id
+    """,
+}
+
+# ---------------- SNAPSHOT ----------------
+
+def _version_actual():
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, "ACTUAL")) as f:
+            nombre = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return os.path.join(SNAPSHOT_DIR, nombre) if nombre else None
+
+def _meta_vacia():
+    return {
+        "generado": None,
+        "max_id": {tabla: 0 for tabla in COLUMNAS},
+        "filas": {tabla: 0 for tabla in COLUMNAS},
+        "diccionarios": {d: [] for d in DICCIONARIOS},
+        "nombres": {"cliente": {}, "producto": {}},
+    }
+
+def _codificar(valores, diccionario, indice):
+    """Valores crudos -> índices del diccionario (que se va extendiendo)."""
+    codigos = np.empty(len(valores), dtype=np.int64)
+    for i, v in enumerate(valores):
+        if v is None:
+            codigos[i] = -1
+            continue
+        cod = indice.get(v)
+        if cod is None:
+            cod = indice[v] = len(diccionario)
+            diccionario.append(v)
+        codigos[i] = cod
+    return codigos
+
+def _leer_nuevas(conn, tabla, desde_id, meta):
+    """Filas con id > desde_id como dict de columnas numpy."""
+    dic = meta["diccionarios"]
+    indices = {d: {v: i for i, v in enumerate(dic[d])} for d in DICCIONARIOS}
+    cols = COLUMNAS[tabla]
+    partes = {col: [] for col in cols}
+
+    c = server.cursor_servidor(conn, f"snapshot_{tabla}", FETCH)
+    server.db_execute(c, SQL_SNAPSHOT[tabla], (desde_id,))
+    while True:
+        filas = c.fetchmany(FETCH)
+        if not filas:
+            break
+        por_col = {k: [r[k] for r in filas] for k in filas[0].keys()}
+        partes["id"].append(np.array(por_col["id"], dtype=cols["id"]))
+        dias = np.array([f[:10] for f in por_col["fecha_hora"]], dtype="datetime64[D]")
+        partes["fecha"].append(dias.astype(np.int64).astype(cols["fecha"]))
+        for d in DICCIONARIOS:
+            partes[d].append(_codificar(por_col[d], dic[d], indices[d]).astype(cols[d]))
+        for col in cols:
+            if col in DICCIONARIOS or col in ("id", "fecha"):
+                continue
+            partes[col].append(np.array([0 if v is None else float(v) for v in por_col[col]],
+                                        dtype=cols[col]))
+    c.close()
+
+    return {col: np.concatenate(p) if p else np.empty(0, dtype=cols[col]) for col, p in partes.items()}
+
+def actualizar_snapshot() -> dict:
+    """Agrega al snapshot las ventas/devoluciones nuevas y cambia ACTUAL a la
+    versión nueva. Regresa la meta de la versión escrita."""
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    anterior = _version_actual()
+    meta = _meta_vacia()
+    if anterior:
+        with open(os.path.join(anterior, "meta.json")) as f:
+            meta = json.load(f)
+
+    nombre = f"v{time.time_ns()}"
+    destino = os.path.join(SNAPSHOT_DIR, nombre)
+    os.makedirs(destino)
+
+    with server.db_conn() as conn:
+        for tabla, cols in COLUMNAS.items():
+            previas = None
+            if anterior and meta["filas"][tabla]:
+                previas = {col: np.load(os.path.join(anterior, f"{tabla}.{col}.npy"), mmap_mode="r") for col in cols}
+            corte = max(0, meta["max_id"][tabla] - SNAPSHOT_SOLAPE)
+            nuevas = _leer_nuevas(conn, tabla, corte, meta)
+            if previas is not None and corte < meta["max_id"][tabla]:
+                # del solape solo quedan las que se commitearon tarde
+                ids = previas["id"]
+                faltan = ~np.isin(nuevas["id"], ids[ids > corte])
+                nuevas = {col: arr[faltan] for col, arr in nuevas.items()}
+            for col in cols:
+                arr = nuevas[col]
+                if previas is not None:
+                    arr = np.concatenate([previas[col], arr])
+                np.save(os.path.join(destino, f"{tabla}.{col}.npy"), arr)
+            meta["filas"][tabla] += len(nuevas["id"])
+            if len(nuevas["id"]):
+                meta["max_id"][tabla] = max(meta["max_id"][tabla], int(nuevas["id"].max()))
+
+        # nombres actuales (los clientes borrados se quedan con el último nombre conocido)
+        c = server.db_cursor(conn)
+        server.db_execute(c, "SELECT id, nombre FROM clientes")
+        meta["nombres"]["cliente"].update({str(r["id"]): r["nombre"] for r in c.fetchall()})
+        server.db_execute(c, "SELECT id, codigo FROM productos")
+        meta["nombres"]["producto"].update({str(r["id"]): r["codigo"] for r in c.fetchall()})
+
+    meta["generado"] = datetime.now().isoformat(timespec="seconds")
+    with open(os.path.join(destino, "meta.json"), "w") as f:
+        json.dump(meta, f)
+
+    tmp = os.path.join(SNAPSHOT_DIR, f"ACTUAL.{nombre}")
+    with open(tmp, "w") as f:
+        f.write(nombre)
+    os.replace(tmp, os.path.join(SNAPSHOT_DIR, "ACTUAL"))
+
+    versiones = sorted(d for d in os.listdir(SNAPSHOT_DIR) if d.startswith("v"))
+    for vieja in versiones[:-SNAPSHOT_VERSIONES]:
+        shutil.rmtree(os.path.join(SNAPSHOT_DIR, vieja), ignore_errors=True)
+    return meta
+
+class Snapshot:
+    """Columnas del snapshot abiertas con mmap (no se leen hasta que se usan)."""
+
+    def __init__(self, carpeta: str):
+        with open(os.path.join(carpeta, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.tablas = {
+            tabla: {col: np.load(os.path.join(carpeta, f"{tabla}.{col}.npy"), mmap_mode="r") for col in cols}
+            for tabla, cols in COLUMNAS.items()
+        }
+
+    def etiqueta(self, dim: str, codigo: int) -> str:
+        if codigo < 0:
+            return "OTRO / contado" if dim == "cliente" else "-"
+        valor = self.meta["diccionarios"][dim][codigo]
+        if dim in self.meta["nombres"]:
+            return self.meta["nombres"][dim].get(str(valor), f"#{valor}")
+        return str(valor)
+
+_snapshot_cache = {}
+
+def cargar_snapshot():
+    """Snapshot actual, o None si todavía no se ha generado."""
+    carpeta = _version_actual()
+    if not carpeta:
+        return None
+    snap = _snapshot_cache.get(carpeta)
+    if snap is None:
+        _snapshot_cache.clear()
+        snap = _snapshot_cache[carpeta] = Snapshot(carpeta)
+    return snap
+
+# ---------------- REPORTES ----------------
+# fecha es días desde 1970-01-01 (jueves): la semana empieza en lunes.
+
+TIEMPOS = ("dia", "semana", "mes", "anio")
+
+def _cubeta(dias, periodo):
+    d = np.asarray(dias, dtype=np.int64)
+    if periodo == "dia":
+        return d
+    if periodo == "semana":
+        return d - (d + 3) % 7
+    unidad = "M" if periodo == "mes" else "Y"
+    return d.astype("datetime64[D]").astype(f"datetime64[{unidad}]").astype("datetime64[D]").astype(np.int64)
+
+def agrupar(snap, tabla: str, por, medidas, desde: str = "", hasta: str = ""):
+    """GROUP BY vectorizado sobre el snapshot. `por` son claves de TIEMPOS o de
+    DICCIONARIOS; `medidas` columnas numéricas que se suman ("n" = número de filas).
+    Regresa una lista de dicts ordenada por las claves."""
+    t = snap.tablas[tabla]
+    mascara = np.ones(len(t["id"]), dtype=bool)
+    if desde:
+        mascara &= t["fecha"] >= np.datetime64(desde, "D").astype(np.int64)
+    if hasta:
+        mascara &= t["fecha"] <= np.datetime64(hasta, "D").astype(np.int64)
+
+    claves = []
+    for clave in por:
+        col = _cubeta(t["fecha"][mascara], clave) if clave in TIEMPOS else t[clave][mascara].astype(np.int64)
+        claves.append(col)
+    if not claves or not mascara.any():
+        return []
+
+    grupos, inversa = np.unique(np.stack(claves, axis=1), axis=0, return_inverse=True)
+    inversa = inversa.ravel()
+    sumas = {}
+    for m in medidas:
+        pesos = None if m == "n" else t[m][mascara]
+        sumas[m] = np.bincount(inversa, weights=pesos, minlength=len(grupos))
+
+    filas = []
+    for i, grupo in enumerate(grupos):
+        fila = {}
+        for clave, valor in zip(por, grupo):
+            if clave in TIEMPOS:
+                fila[clave] = str(np.datetime64(int(valor), "D"))
+            else:
+                fila[clave] = snap.etiqueta(clave, int(valor))
+        for m in medidas:
+            fila[m] = int(sumas[m][i]) if m in ("n", "pollos", "cajas") else round(float(sumas[m][i]), 2)
+        filas.append(fila)
+    return filas
+
+def rendimiento_por_cliente(snap, desde: str = "", hasta: str = ""):
+    """kg por caja y por pollo de cada cliente, del más al menos comprador."""
+    filas = agrupar(snap, "ventas", ("cliente",), ("n", "kg", "pollos", "cajas", "total"), desde, hasta)
+    for f in filas:
+        f["kg_por_caja"] = round(f["kg"] / f["cajas"], 3) if f["cajas"] else None
+        f["kg_por_pollo"] = round(f["kg"] / f["pollos"], 3) if f["pollos"] else None
+    filas.sort(key=lambda f: f["kg"], reverse=True)
+    return filas
+
+# nombre -> (título, función(snap, desde, hasta), columnas a mostrar)
+REPORTES = {
+    "kg_semana_producto": (
+        "Kg por producto por semana",
+        lambda s, d, h: agrupar(s, "ventas", ("semana", "producto"), ("n", "kg", "total"), d, h),
+        ("semana", "producto", "n", "kg", "total"),
+    ),
+    "mes_metodo_pago": (
+        "Ventas por mes y método de pago",
+        lambda s, d, h: agrupar(s, "ventas", ("mes", "metodo_pago"), ("n", "kg", "total"), d, h),
+        ("mes", "metodo_pago", "n", "kg", "total"),
+    ),
+    "rendimiento_cliente": (
+        "Rendimiento por cliente (kg por caja y por pollo)",
+        rendimiento_por_cliente,
+        ("cliente", "n", "kg", "cajas", "pollos", "kg_por_caja", "kg_por_pollo", "total"),
+    ),
+    "devoluciones_mes_producto": (
+        "Devoluciones por mes y producto",
+        lambda s, d, h: agrupar(s, "devoluciones", ("mes", "producto"), ("n", "kg", "total"), d, h),
+        ("mes", "producto", "n", "kg", "total"),
+    ),
+}
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["snapshot"]:
+        sys.exit("Uso: python reportes.py snapshot")
+    t0 = time.monotonic()
+    meta = actualizar_snapshot()
+    print(f"snapshot: {meta['filas']['ventas']} ventas, {meta['filas']['devoluciones']} devoluciones "
+          f"({time.monotonic() - t0:.1f}s)")
@@ -1,21 +1,42 @@
 # server.py
-from fastapi import FastAPI, Request, Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi import FastAPI, Request, Form, Depends, File, UploadFile
+from fastapi.responses import HTMLResponse, RedirectResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from datetime import datetime, date, timedelta
-import os, sqlite3
+from decimal import Decimal
+import os, re, sys, asyncio, logging, sqlite3, threading, time, json, base64, unicodedata, bisect, heapq, hashlib, queue, csv, io
+from collections import OrderedDict, Counter
+from contextvars import ContextVar
+from contextlib import contextmanager, asynccontextmanager
+from functools import lru_cache
 from typing import Optional
+from urllib.parse import urlencode, parse_qs
+from html import escape
 
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 from psycopg2.pool import ThreadedConnectionPool
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
 from passlib.context import CryptContext
 
+try:
+    import asyncpg
+except ImportError:  # sin asyncpg, Postgres async cae al wrapper con hilos
+    asyncpg = None
+
+try:
+    import openpyxl
+except ImportError:  # solo hace falta para importar listas de precios .xlsx
+    openpyxl = None
+
 # ---------------- CONFIG ----------------
 
+# fallas de los hilos de fondo, con traceback, al log del server
+log = logging.getLogger(__name__)
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(BASE_DIR, "rastro.db")
+DB_PATH = os.getenv("DB_PATH", os.path.join(BASE_DIR, "rastro.db"))  # bench/ usa otra base
 
 APP_SECRET = os.getenv("APP_SECRET", "dev-secret")
 
@@ -34,19 +55,500 @@ BASCULA_PASSWORD_HASH = pwd_context.hash(BASCULA_PASSWORD)
 
 # Pool Postgres
 PG_POOL: Optional[ThreadedConnectionPool] = None
+PG_ASYNC_POOL = None  # asyncpg.Pool
+# Statements registrados (Consulta) como PREPARE/EXECUTE en psycopg2 y caché de
+# statements de asyncpg. Apagar (0) detrás de PgBouncer en modo transaction.
+PG_PREPARAR = os.getenv("PG_PREPARAR", "1") == "1"
+
+# SQLite (modo local / un solo servidor)
+SQLITE_POOL_MAX = int(os.getenv("SQLITE_POOL_MAX", "8"))
+SQLITE_BUSY_MS = int(os.getenv("SQLITE_BUSY_MS", "5000"))
+SQLITE_MMAP_MB = int(os.getenv("SQLITE_MMAP_MB", "256"))
+
+# Cache de precios (en memoria, por proceso)
+PRECIOS_CACHE_DIAS = int(os.getenv("PRECIOS_CACHE_DIAS", "7"))
+PRECIOS_CACHE_MAX = int(os.getenv("PRECIOS_CACHE_MAX", "20000"))
+PRECIOS_CACHE_TTL = float(os.getenv("PRECIOS_CACHE_TTL", "60"))
 
 # ---------------- APP ----------------
 
 app = FastAPI()
-app.add_middleware(SessionMiddleware, secret_key=APP_SECRET)
 
 # static
 STATIC_DIR = os.path.join(BASE_DIR, "static")
 os.makedirs(STATIC_DIR, exist_ok=True)
-app.mount("/static", StaticFiles(directory=STATIC_DIR), name="static")
+
+class StaticConCache(StaticFiles):
+    """Las URLs de asset_url() llevan ?v=<hash del contenido>: si el archivo
+    cambia, cambia la URL, así que esas se pueden cachear para siempre."""
+
+    async def get_response(self, path, scope):
+        response = await super().get_response(path, scope)
+        if response.status_code == 200:
+            if b"v=" in scope.get("query_string", b""):
+                response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+            else:
+                response.headers["Cache-Control"] = "public, max-age=0, must-revalidate"
+        return response
+
+app.mount("/static", StaticConCache(directory=STATIC_DIR), name="static")
+
+_assets_hash: dict = {}
+
+def asset_url(nombre: str) -> str:
+    """/static/<nombre>?v=<hash>; el hash se calcula una vez por proceso."""
+    h = _assets_hash.get(nombre)
+    if h is None:
+        with open(os.path.join(STATIC_DIR, nombre), "rb") as f:
+            h = hashlib.sha256(f.read()).hexdigest()[:12]
+        _assets_hash[nombre] = h
+    return f"/static/{nombre}?v={h}"
+
+# ---------------- MÉTRICAS ----------------
+# Histogramas y gauges en memoria (por proceso) que /metrics expone en el
+# formato de texto de Prometheus. Observar es un bisect y una suma bajo un lock.
+# Con varios workers cada proceso lleva sus propias métricas.
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")  # si se define, /metrics lo pide
+
+BUCKETS_SEG = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_CANTIDAD = (0, 1, 2, 5, 10, 20, 50, 100, 250, 500, 1000, 5000, 10000)
+
+METRICAS = []
+
+def _etiquetas_txt(nombres, valores, extra: str = "") -> str:
+    # json.dumps escapa \\, " y saltos de línea igual que pide el formato
+    partes = [f"{n}={json.dumps(str(v), ensure_ascii=False)}" for n, v in zip(nombres, valores)]
+    if extra:
+        partes.append(extra)
+    return "{" + ",".join(partes) + "}" if partes else ""
+
+def _num_txt(v) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+class Histograma:
+    def __init__(self, nombre: str, ayuda: str, etiquetas=(), buckets=BUCKETS_SEG):
+        self.nombre, self.ayuda, self.etiquetas, self.buckets = nombre, ayuda, etiquetas, buckets
+        self.series: dict = {}  # valores de etiquetas -> [conteo por bucket..., +Inf, suma]
+        self.lock = threading.Lock()
+        METRICAS.append(self)
+
+    def observar(self, valor, *etiquetas):
+        i = bisect.bisect_left(self.buckets, valor)
+        with self.lock:
+            serie = self.series.get(etiquetas)
+            if serie is None:
+                serie = self.series[etiquetas] = [0] * (len(self.buckets) + 1) + [0.0]
+            serie[i] += 1
+            serie[-1] += valor
+
+    def texto(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        with self.lock:
+            series = [(k, list(v)) for k, v in self.series.items()]
+        for valores, serie in series:
+            acumulado = 0
+            for le, n in zip(self.buckets + ("+Inf",), serie[:-1]):
+                acumulado += n
+                le_txt = le if le == "+Inf" else _num_txt(le)
+                etiquetas = _etiquetas_txt(self.etiquetas, valores, 'le="' + le_txt + '"')
+                lineas.append(f"{self.nombre}_bucket{etiquetas} {acumulado}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas_txt(self.etiquetas, valores)} {_num_txt(serie[-1])}")
+            lineas.append(f"{self.nombre}_count{_etiquetas_txt(self.etiquetas, valores)} {acumulado}")
+        return lineas
+
+class Medidor:
+    """Gauge que se lee al momento de exponer: fn() -> [(valores de etiquetas, valor)]."""
+
+    def __init__(self, nombre: str, ayuda: str, etiquetas, fn):
+        self.nombre, self.ayuda, self.etiquetas, self.fn = nombre, ayuda, etiquetas, fn
+        METRICAS.append(self)
+
+    def texto(self) -> list:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} gauge"]
+        for valores, valor in self.fn():
+            lineas.append(f"{self.nombre}{_etiquetas_txt(self.etiquetas, valores)} {_num_txt(valor)}")
+        return lineas
+
+def metricas_texto() -> str:
+    lineas = []
+    for m in METRICAS:
+        lineas.extend(m.texto())
+    return "\n".join(lineas) + "\n"
+
+HTTP_DURACION = Histograma(
+    "http_request_duration_seconds", "Duración de cada request (incluye el streaming del cuerpo).",
+    ("method", "route", "status"))
+DB_QUERY_DURACION = Histograma(
+    "db_query_duration_seconds", "Duración de cada query.", ("operacion",))
+DB_QUERIES_REQUEST = Histograma(
+    "db_queries_per_request", "Queries por request.", ("route",), BUCKETS_CANTIDAD)
+DB_TIEMPO_REQUEST = Histograma(
+    "db_time_per_request_seconds", "Tiempo total en queries por request.", ("route",))
+DB_FILAS_REQUEST = Histograma(
+    "db_rows_per_request", "Filas devueltas o modificadas por request (en SQLite solo las modificadas).",
+    ("route",), BUCKETS_CANTIDAD)
+DB_POOL_ESPERA = Histograma(
+    "db_pool_wait_seconds", "Espera para obtener una conexión del pool.", ("pool",))
+
+# [queries, segundos, filas] del request en curso; None fuera de un request
+_metricas_request: ContextVar[Optional[list]] = ContextVar("metricas_request", default=None)
+
+_OPERACIONES = {"SELECT": "select", "WITH": "select", "INSERT": "insert", "UPDATE": "update", "DELETE": "delete"}
+
+def _operacion(query: str) -> str:
+    palabra = query.lstrip()[:6].upper().split(None, 1)
+    return _OPERACIONES.get(palabra[0] if palabra else "", "otra")
+
+def medir_query(query: str, inicio: float, filas: int = -1) -> float:
+    duracion = time.perf_counter() - inicio
+    DB_QUERY_DURACION.observar(duracion, _operacion(query))
+    acumulado = _metricas_request.get()
+    if acumulado is not None:
+        acumulado[0] += 1
+        acumulado[1] += duracion
+        if filas > 0:
+            acumulado[2] += filas
+    if DB_DIAGNOSTICO:
+        diag = _diagnostico_request.get()
+        if diag is not None:
+            forma = diag["formas"].setdefault(normalizar_sql(query), [0, 0.0])
+            forma[0] += 1
+            forma[1] += duracion
+    return duracion
+
+# ---- diagnóstico de queries (opt-in) ----
+# Con DB_DIAGNOSTICO=1 se agrupan las queries de cada request por su SQL
+# normalizado y al terminar se reportan las formas repetidas (N+1) y los requests
+# con demasiadas queries. Toda query que pase DB_LENTA_MS se reporta con sus
+# parámetros y el plan (EXPLAIN) que se saca en ese momento. El reporte son
+# líneas JSON en DB_DIAGNOSTICO_LOG, o en el log del server si no se define.
+DB_DIAGNOSTICO = os.getenv("DB_DIAGNOSTICO", "0") == "1"
+DB_DIAGNOSTICO_LOG = os.getenv("DB_DIAGNOSTICO_LOG", "")
+DB_LENTA_SEG = float(os.getenv("DB_LENTA_MS", "200")) / 1000 if DB_DIAGNOSTICO else float("inf")
+DB_REPETIDAS_MIN = int(os.getenv("DB_REPETIDAS_MIN", "5"))  # misma forma N veces = N+1
+DB_QUERIES_MAX = int(os.getenv("DB_QUERIES_MAX", "30"))  # queries por request
+
+# {"scope": scope ASGI, "formas": {sql normalizado: [veces, segundos]}}
+_diagnostico_request: ContextVar[Optional[dict]] = ContextVar("diagnostico_request", default=None)
+_diagnostico_lock = threading.Lock()
+
+_RE_LITERALES = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_RE_LISTA_PARAMS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+
+def normalizar_sql(query: str) -> str:
+    """Forma de la query: literales como ?, listas IN (?, ?, ...) como (?...) y
+    espacios colapsados, para que las variantes del mismo SQL caigan juntas."""
+    q = _RE_LITERALES.sub("?", " ".join(query.split()))
+    return _RE_LISTA_PARAMS.sub("(?...)", q)
+
+def reportar_diagnostico(tipo: str, **datos):
+    diag = _diagnostico_request.get()
+    registro = {"ts": datetime.now().isoformat(timespec="milliseconds"), "tipo": tipo}
+    if diag is not None:
+        scope = diag["scope"]
+        registro.update(metodo=scope["method"], ruta=_ruta_metricas(scope), path=scope["path"])
+    registro.update(datos)
+    linea = json.dumps(registro, ensure_ascii=False, default=str)
+    if not DB_DIAGNOSTICO_LOG:
+        log.warning(linea)
+        return
+    with _diagnostico_lock:
+        try:
+            with open(DB_DIAGNOSTICO_LOG, "a", encoding="utf-8") as f:
+                f.write(linea + "\n")
+        except OSError:
+            # el diagnóstico no debe tumbar el request que lo generó
+            log.exception("no se pudo escribir %s", DB_DIAGNOSTICO_LOG)
+
+def plan_query(cur, query: str, params=()) -> list:
+    """EXPLAIN de una query ya ejecutada, con un cursor aparte para no pisar el
+    resultado que todavía va a leer quien la ejecutó."""
+    if _operacion(query) == "otra":
+        return []
+    if IS_POSTGRES:
+        c = cur.connection.cursor()
+        # savepoint: si el EXPLAIN falla no debe abortar la transacción en curso
+        c.execute("SAVEPOINT diagnostico_plan")
+        try:
+            c.execute("EXPLAIN " + _sql_psycopg(query), params)
+            plan = [list(r.values())[0] if isinstance(r, dict) else r[0] for r in c.fetchall()]
+            c.execute("RELEASE SAVEPOINT diagnostico_plan")
+        except psycopg2.Error as e:
+            c.execute("ROLLBACK TO SAVEPOINT diagnostico_plan")
+            plan = [f"sin plan: {e}".strip()]
+        return plan
+    try:
+        c = cur.connection.cursor()
+        c.execute("EXPLAIN QUERY PLAN " + query, params)
+        return [r[3] for r in c.fetchall()]
+    except sqlite3.Error as e:
+        return [f"sin plan: {e}"]
+
+def reportar_lenta(query: str, params, duracion: float, plan: list):
+    reportar_diagnostico("lenta", ms=round(duracion * 1000, 1), sql=" ".join(query.split()),
+                         params=list(params), plan=plan)
+
+def _cerrar_diagnostico(diag: dict):
+    formas = diag["formas"]
+    total = sum(v[0] for v in formas.values())
+    for sql, (veces, segundos) in formas.items():
+        if veces >= DB_REPETIDAS_MIN:
+            reportar_diagnostico("repetida", veces=veces, ms=round(segundos * 1000, 1), sql=sql)
+    if total >= DB_QUERIES_MAX:
+        reportar_diagnostico("muchas_queries", queries=total, formas=len(formas),
+                             ms=round(sum(v[1] for v in formas.values()) * 1000, 1))
+
+def _ruta_metricas(scope) -> str:
+    # la plantilla de la ruta (/boletas/cobrar/{boleta_id}), no el path, para no
+    # crear una serie por id
+    ruta = scope.get("route")
+    if ruta is not None and hasattr(ruta, "path"):
+        return ruta.path
+    if scope.get("path", "").startswith("/static/"):
+        return "/static"
+    return "sin_ruta"
+
+class MetricasMiddleware:
+    """Middleware ASGI: mide cada request hasta que se termina de mandar el cuerpo."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        inicio = time.perf_counter()
+        acumulado = [0, 0.0, 0]
+        token = _metricas_request.set(acumulado)
+        diag = {"scope": scope, "formas": {}} if DB_DIAGNOSTICO else None
+        token_diag = _diagnostico_request.set(diag)
+        status = [500]
+
+        async def send_con_status(mensaje):
+            if mensaje["type"] == "http.response.start":
+                status[0] = mensaje["status"]
+            await send(mensaje)
+
+        try:
+            await self.app(scope, receive, send_con_status)
+        finally:
+            if diag is not None:
+                _cerrar_diagnostico(diag)
+            _diagnostico_request.reset(token_diag)
+            _metricas_request.reset(token)
+            ruta = _ruta_metricas(scope)
+            HTTP_DURACION.observar(time.perf_counter() - inicio, scope["method"], ruta, status[0])
+            DB_QUERIES_REQUEST.observar(acumulado[0], ruta)
+            DB_TIEMPO_REQUEST.observar(acumulado[1], ruta)
+            DB_FILAS_REQUEST.observar(acumulado[2], ruta)
+
+app.add_middleware(MetricasMiddleware)
+
+# ---------------- PERFILADOR ----------------
+# Un usuario Caja agrega ?_profile=1 a cualquier URL y en vez de la página recibe
+# el árbol de llamadas de ese request; las pilas crudas quedan en PERFILES_DIR en
+# formato "folded" (flamegraph.pl, speedscope). Es por muestreo: un hilo aparte
+# lee las pilas cada PERFIL_INTERVALO_MS del hilo del event loop (middlewares,
+# sesión, endpoints async) y del hilo del threadpool que corre el endpoint (con
+# layout() y las queries adentro). Sin el parámetro solo cuesta buscarlo en el
+# query string; sin sesión de Caja el request va normal y no se muestrea nada.
+# Un perfil a la vez; si ya hay uno corriendo, el request también va normal.
+
+PERFILES_DIR = os.getenv("PERFILES_DIR", os.path.join(BASE_DIR, "perfiles"))
+PERFIL_INTERVALO_MS = float(os.getenv("PERFIL_INTERVALO_MS", "1"))
+PERFIL_MIN_PCT = 0.5  # ramas más chicas no se dibujan (sí quedan en el archivo)
+
+_perfil_lock = threading.Lock()
+
+class Perfilador:
+    def __init__(self, scope):
+        self.scope = scope
+        self.hilo_loop = threading.get_ident()
+        self.muestras: Counter = Counter()  # pila (raíz -> hoja) -> muestras
+        self._parar = threading.Event()
+        self._hilo = threading.Thread(target=self._muestrear, daemon=True)
+
+    def __enter__(self):
+        self.inicio = time.perf_counter()
+        self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._hilo.join()
+        self.duracion = time.perf_counter() - self.inicio
+
+    def _muestrear(self):
+        propio = threading.get_ident()
+        intervalo = PERFIL_INTERVALO_MS / 1000
+        while not self._parar.wait(intervalo):
+            # el endpoint se conoce hasta que el router resuelve la ruta
+            endpoint = getattr(self.scope.get("route"), "endpoint", None)
+            codigo = getattr(endpoint, "__code__", None)
+            for ident, frame in sys._current_frames().items():
+                if ident == propio:
+                    continue
+                es_del_request = ident == self.hilo_loop
+                pila = []
+                while frame is not None:
+                    co = frame.f_code
+                    es_del_request = es_del_request or co is codigo
+                    pila.append((co.co_filename, co.co_firstlineno, co.co_name))
+                    frame = frame.f_back
+                # el loop parado en select() solo espera al threadpool: no se cuenta
+                if es_del_request and not (ident == self.hilo_loop and pila[0][0].endswith("selectors.py")):
+                    pila.reverse()
+                    self.muestras[tuple(pila)] += 1
+
+    def guardar(self, ruta: str) -> str:
+        os.makedirs(PERFILES_DIR, exist_ok=True)
+        nombre = datetime.now().strftime("%Y%m%d-%H%M%S-%f") + re.sub(r"[^\w]+", "_", ruta).rstrip("_") + ".folded"
+        archivo = os.path.join(PERFILES_DIR, nombre)
+        with open(archivo, "w", encoding="utf-8") as f:
+            for pila, n in self.muestras.most_common():
+                f.write(";".join(_nombre_frame(fr) for fr in pila) + f" {n}\n")
+        return archivo
+
+def _nombre_frame(frame) -> str:
+    archivo, linea, funcion = frame
+    if archivo.startswith(BASE_DIR):
+        archivo = os.path.relpath(archivo, BASE_DIR)
+    elif "site-packages" in archivo:
+        archivo = archivo.split("site-packages" + os.sep, 1)[1]
+    else:
+        archivo = os.path.basename(archivo)
+    return f"{funcion} ({archivo}:{linea})"
+
+def _arbol_perfil(muestras: Counter) -> dict:
+    """{frame: [muestras, hijos]} a partir de las pilas."""
+    raiz: dict = {}
+    for pila, n in muestras.items():
+        nivel = raiz
+        for frame in pila:
+            nodo = nivel.setdefault(frame, [0, {}])
+            nodo[0] += n
+            nivel = nodo[1]
+    return raiz
+
+def _arbol_perfil_html(nivel: dict, total: int) -> str:
+    partes = []
+    for frame, (n, hijos) in sorted(nivel.items(), key=lambda kv: -kv[1][0]):
+        pct = 100 * n / total
+        if pct < PERFIL_MIN_PCT:
+            continue
+        propio = n - sum(h[0] for h in hijos.values())
+        etiqueta = (
+            f"<span class='barra' style='width:{pct:.1f}px'></span> <b>{pct:.1f}%</b> "
+            f"{escape(_nombre_frame(frame))}"
+            + (f" <span class='muted'>(propio {100 * propio / total:.1f}%)</span>" if propio else "")
+        )
+        # las ramas pesadas salen abiertas para no hacer clic frame por frame
+        abierto = " open" if pct >= 10 else ""
+        if hijos:
+            partes.append(f"<details{abierto}><summary>{etiqueta}</summary>{_arbol_perfil_html(hijos, total)}</details>")
+        else:
+            partes.append(f"<div class='hoja'>{etiqueta}</div>")
+    return "".join(partes)
+
+def reporte_perfil(request: Request, perfil: Perfilador, status: int, enviados: int,
+                   archivo: Optional[str]) -> HTMLResponse:
+    total = sum(perfil.muestras.values())
+    ruta = _ruta_metricas(request.scope)
+    resumen = (f"Status {status} · {enviados} bytes · {perfil.duracion * 1000:.1f} ms · "
+               f"{total} muestras cada {PERFIL_INTERVALO_MS:g} ms")
+    if not total:
+        body = f"""
+        <h2>Perfil: {escape(request.method)} {escape(ruta)}</h2>
+        <div class="card">{resumen}<br>
+          Muestras insuficientes: el request terminó antes de tomar una muestra.
+          No se guardó archivo; baja PERFIL_INTERVALO_MS o perfila una página más pesada.
+        </div>
+        """
+        return layout(request, "Perfil", body)
+    propios: Counter = Counter()
+    for pila, n in perfil.muestras.items():
+        propios[pila[-1]] += n
+    top = "".join(
+        f"<tr><td>{escape(_nombre_frame(fr))}</td><td>{n}</td><td>{100 * n / total:.1f}%</td></tr>"
+        for fr, n in propios.most_common(15)
+    )
+    body = f"""
+    <style>
+      .perfil details {{ margin-left: 14px; }}
+      .perfil .hoja {{ margin-left: 28px; }}
+      .perfil summary, .perfil .hoja {{ font-family: monospace; font-size: 12px; white-space: nowrap; }}
+      .perfil .barra {{ display: inline-block; height: 8px; background: #f59e0b; }}
+      .perfil .muted {{ color: #6b7280; }}
+    </style>
+    <h2>Perfil: {escape(request.method)} {escape(ruta)}</h2>
+    <div class="card">
+      {resumen}<br>
+      Pilas crudas: <code>{escape(archivo)}</code>
+    </div>
+    <div class="card"><h3>Más tiempo propio</h3>
+      <table><tr><th>Función</th><th>Muestras</th><th>%</th></tr>{top}</table>
+    </div>
+    <div class="card perfil"><h3>Árbol de llamadas</h3>{_arbol_perfil_html(_arbol_perfil(perfil.muestras), total)}</div>
+    """
+    return layout(request, "Perfil", body)
+
+class PerfilMiddleware:
+    """Middleware ASGI, dentro de SessionMiddleware: la sesión ya se conoce antes
+    de decidir si se perfila."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or b"_profile=1" not in scope["query_string"]
+            or parse_qs(scope["query_string"].decode("latin-1")).get("_profile") != ["1"]
+            or scope.get("session", {}).get("role") != "Caja"
+            or not _perfil_lock.acquire(blocking=False)
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # el reporte reemplaza a la respuesta: su cuerpo se descarta conforme
+        # sale (las respuestas en streaming no se juntan en memoria)
+        status, enviados = [500], [0]
+
+        async def descartar(mensaje):
+            if mensaje["type"] == "http.response.start":
+                status[0] = mensaje["status"]
+            elif mensaje["type"] == "http.response.body":
+                enviados[0] += len(mensaje.get("body", b""))
+
+        try:
+            with Perfilador(scope) as perfil:
+                await self.app(scope, receive, descartar)
+        finally:
+            _perfil_lock.release()
+
+        archivo = None
+        if perfil.muestras:
+            archivo = await run_in_threadpool(perfil.guardar, _ruta_metricas(scope))
+        await reporte_perfil(Request(scope), perfil, status[0], enviados[0], archivo)(scope, receive, send)
+
+app.add_middleware(PerfilMiddleware)
+# la sesión va por fuera de todo (se agrega al último): el perfilador y los
+# handlers la leen ya decodificada
+app.add_middleware(SessionMiddleware, secret_key=APP_SECRET)
 
 # ---------------- DB HELPERS ----------------
 
+class ConexionPG(psycopg2.extensions.connection):
+    """Conexión psycopg2 que recuerda qué Consultas ya preparó. PREPARE vive lo
+    que vive la sesión (un ROLLBACK no lo borra), así que basta con un set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparadas: set = set()
+
 def init_pg_pool():
     global PG_POOL
     if not IS_POSTGRES:
@@ -64,16 +566,126 @@ def init_pg_pool():
         password=os.getenv("PGPASSWORD"),
         sslmode=os.getenv("PGSSLMODE", "require"),
         connect_timeout=10,
+        connection_factory=ConexionPG if PG_PREPARAR else None,
     )
 
-def get_conn():
+class SQLitePool:
+    """Conexiones SQLite reutilizables, en WAL.
+
+    - Lectores: hasta SQLITE_POOL_MAX conexiones que se reciclan entre requests.
+    - Escritor: una sola conexión por proceso; quien la toma tiene el lock del
+      proceso y arranca con BEGIN IMMEDIATE, así el lock de escritura de SQLite
+      se pide al inicio (esperando hasta busy_timeout si otro worker escribe)
+      en lugar de fallar con "database is locked" a media transacción.
+      Los requests hacen fila antes, en el event loop (turno_escritor); el lock
+      del proceso solo lo esperan además los hilos de fondo.
+    """
+
+    def __init__(self, path: str, max_lectores: int):
+        self.path = path
+        self.max_lectores = max_lectores
+        self.lectores: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self.escritor: Optional[sqlite3.Connection] = None
+        self.escritor_lock = threading.Lock()
+        self.lectores_en_uso = 0  # solo para métricas
+        self._cuenta_lock = threading.Lock()
+
+    def _contar(self, delta: int):
+        with self._cuenta_lock:
+            self.lectores_en_uso += delta
+
+    def _conectar(self) -> sqlite3.Connection:
+        # la dependency puede abrirla en un hilo del threadpool y usarla en otro
+        # (siempre un request a la vez), por eso check_same_thread=False
+        conn = sqlite3.connect(self.path, timeout=SQLITE_BUSY_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_MS}")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_MB * 1024 * 1024}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def lector(self) -> sqlite3.Connection:
+        try:
+            conn = self.lectores.get_nowait()
+        except queue.Empty:
+            conn = self._conectar()
+        self._contar(1)
+        return conn
+
+    def tomar_escritor(self) -> sqlite3.Connection:
+        self.escritor_lock.acquire()
+        try:
+            if self.escritor is None:
+                self.escritor = self._conectar()
+            self.escritor.execute("BEGIN IMMEDIATE")
+            return self.escritor
+        except Exception:
+            self.escritor_lock.release()
+            raise
+
+    def regresar(self, conn: sqlite3.Connection):
+        if conn is self.escritor:
+            try:
+                conn.rollback()  # lo que no se commiteó se descarta
+            except Exception:
+                try:
+                    conn.close()
+                except Exception:
+                    pass
+                self.escritor = None
+            finally:
+                self.escritor_lock.release()
+            return
+
+        self._contar(-1)
+        try:
+            conn.rollback()
+            if self.lectores.qsize() < self.max_lectores:
+                self.lectores.put_nowait(conn)
+                return
+        except Exception:
+            pass
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+SQLITE_POOL = SQLitePool(DB_PATH, SQLITE_POOL_MAX)
+
+def _estado_pools():
+    if IS_POSTGRES:
+        estado = []
+        if PG_POOL is not None:
+            estado += [(("postgres", "en_uso"), len(PG_POOL._used)), (("postgres", "libres"), len(PG_POOL._pool)),
+                       (("postgres", "max"), PG_POOL.maxconn)]
+        if PG_ASYNC_POOL is not None:
+            libres = PG_ASYNC_POOL.get_idle_size()
+            estado += [(("asyncpg", "en_uso"), PG_ASYNC_POOL.get_size() - libres), (("asyncpg", "libres"), libres),
+                       (("asyncpg", "max"), PG_ASYNC_POOL.get_max_size())]
+        return estado
+    return [
+        (("sqlite_lector", "en_uso"), SQLITE_POOL.lectores_en_uso),
+        (("sqlite_lector", "libres"), SQLITE_POOL.lectores.qsize()),
+        (("sqlite_lector", "max"), SQLITE_POOL.max_lectores),
+        (("sqlite_escritor", "en_uso"), 1 if SQLITE_POOL.escritor_lock.locked() else 0),
+    ]
+
+DB_POOL_CONEXIONES = Medidor(
+    "db_pool_connections", "Conexiones del pool por estado.", ("pool", "estado"), _estado_pools)
+
+def get_conn(escritura: bool = False):
+    inicio = time.perf_counter()
     if IS_POSTGRES:
         if PG_POOL is None:
             init_pg_pool()
-        return PG_POOL.getconn()
-
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+        conn, pool = PG_POOL.getconn(), "postgres"
+    elif escritura:
+        conn, pool = SQLITE_POOL.tomar_escritor(), "sqlite_escritor"
+    else:
+        conn, pool = SQLITE_POOL.lector(), "sqlite_lector"
+    DB_POOL_ESPERA.observar(time.perf_counter() - inicio, pool)
     return conn
 
 def close_conn(conn):
@@ -86,208 +698,705 @@ def close_conn(conn):
                 conn.close()
             except Exception:
                 pass
-    else:
+    elif conn is not None:
+        SQLITE_POOL.regresar(conn)
+
+@contextmanager
+def db_conn(conn=None, escritura: bool = False):
+    """Usa la conexión que te pasen; si no hay, saca una del pool y la regresa al final.
+    escritura=True en SQLite da la conexión escritora (ver SQLitePool)."""
+    if conn is not None:
+        yield conn
+        return
+    conn = get_conn(escritura)
+    try:
+        yield conn
+    finally:
+        close_conn(conn)
+
+def get_db():
+    """Dependency: una sola conexión por request, compartida con todos los helpers.
+    Se regresa al pool aunque el handler truene (lo no commiteado se descarta)."""
+    with db_conn() as conn:
+        yield conn
+
+# Turno del escritor SQLite para los requests: se espera aquí, en el event loop.
+# Si cada request esperara el escritor_lock dentro del threadpool, con todos los
+# hilos bloqueados en él el que tiene la conexión ya no tendría hilo para sus
+# queries, su commit ni para regresarla, y el proceso entero se queda colgado.
+_turno_escritor = asyncio.Lock()
+
+@asynccontextmanager
+async def turno_escritor():
+    if IS_POSTGRES:
+        yield
+        return
+    async with _turno_escritor:
+        yield
+
+async def get_db_escritura(request: Request):
+    """Como get_db, para los handlers que escriben. Sin sesión no se toma la
+    conexión (el handler responde con ensure_role); así un POST anónimo nunca
+    ocupa el escritor."""
+    if not request.session.get("role"):
+        yield None
+        return
+    async with turno_escritor():
+        conn = await run_in_threadpool(get_conn, True)
         try:
-            conn.close()
-        except Exception:
-            pass
+            yield conn
+        finally:
+            await run_in_threadpool(close_conn, conn)
+
+# ---------------- DB ASYNC ----------------
+# Mismos queries con "?" que db_execute, pero con await:
+# - Postgres + asyncpg: I/O nativo en el event loop, sin hilos.
+# - SQLite (o Postgres sin asyncpg): cada llamada corre en el threadpool, así
+#   ninguna llamada bloqueante queda en el loop.
+
+@lru_cache(maxsize=1024)
+def _sql_asyncpg(query: str, con_id: bool = False) -> str:
+    partes = query.split("?")
+    out = [partes[0]]
+    for n, parte in enumerate(partes[1:], start=1):
+        out.append(f"${n}")
+        out.append(parte)
+    q = "".join(out)
+    return q.rstrip().rstrip(";") + " RETURNING id" if con_id else q
+
+def texto_asyncpg(query: str, con_id: bool = False) -> str:
+    """Texto para asyncpg: el ya traducido de una Consulta o el de la caché.
+    asyncpg prepara cada texto una vez por conexión (statement_cache_size)."""
+    if isinstance(query, Consulta):
+        return query.con_id.asyncpg if con_id else query.asyncpg
+    return _sql_asyncpg(query, con_id)
+
+async def _pg_async_init(conn):
+    # fechas y numéricos como texto hacia/desde Python, igual que con SQLite
+    # y psycopg2 (fecha 'YYYY-MM-DD', precios como Decimal)
+    await conn.set_type_codec("date", schema="pg_catalog", encoder=str, decoder=str, format="text")
+    await conn.set_type_codec("numeric", schema="pg_catalog", encoder=str, decoder=Decimal, format="text")
+
+async def get_pg_async_pool():
+    global PG_ASYNC_POOL
+    if PG_ASYNC_POOL is None:
+        PG_ASYNC_POOL = await asyncpg.create_pool(
+            min_size=int(os.getenv("PG_POOL_MIN", "1")),
+            max_size=int(os.getenv("PG_ASYNC_POOL_MAX", os.getenv("PG_POOL_MAX", "8"))),
+            host=os.getenv("PGHOST"),
+            port=int(os.getenv("PGPORT", "5432")),
+            database=os.getenv("PGDATABASE", "postgres"),
+            user=os.getenv("PGUSER"),
+            password=os.getenv("PGPASSWORD"),
+            ssl=os.getenv("PGSSLMODE", "require"),
+            timeout=10,
+            init=_pg_async_init,
+            statement_cache_size=100 if PG_PREPARAR else 0,
+        )
+    return PG_ASYNC_POOL
+
+class AsyncPG:
+    """Conexión asyncpg con una transacción abierta."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.tr = None
+
+    async def _begin(self):
+        self.tr = self.conn.transaction()
+        await self.tr.start()
+
+    async def _medir(self, query: str, params, inicio: float, filas: int):
+        duracion = medir_query(query, inicio, filas)
+        if duracion < DB_LENTA_SEG:
+            return
+        plan = []
+        if _operacion(query) != "otra":
+            try:
+                async with self.conn.transaction():  # savepoint
+                    plan = [r[0] for r in await self.conn.fetch("EXPLAIN " + texto_asyncpg(query), *params)]
+            except asyncpg.PostgresError as e:
+                plan = [f"sin plan: {e}"]
+        reportar_lenta(query, params, duracion, plan)
+
+    async def fetchall(self, query: str, params=()):
+        inicio = time.perf_counter()
+        filas = await self.conn.fetch(texto_asyncpg(query), *params)
+        await self._medir(query, params, inicio, len(filas))
+        return filas
+
+    async def fetchone(self, query: str, params=()):
+        inicio = time.perf_counter()
+        fila = await self.conn.fetchrow(texto_asyncpg(query), *params)
+        await self._medir(query, params, inicio, 1 if fila else 0)
+        return fila
+
+    async def execute(self, query: str, params=()):
+        inicio = time.perf_counter()
+        estado = await self.conn.execute(texto_asyncpg(query), *params)
+        ultimo = estado.rsplit(" ", 1)[-1]  # "UPDATE 3", "INSERT 0 1"
+        await self._medir(query, params, inicio, int(ultimo) if ultimo.isdigit() else -1)
+
+    async def executemany(self, query: str, seq_params):
+        inicio = time.perf_counter()
+        seq_params = list(seq_params)
+        await self.conn.executemany(texto_asyncpg(query), seq_params)
+        duracion = medir_query(query, inicio, len(seq_params))
+        if duracion >= DB_LENTA_SEG:
+            reportar_lenta(query, seq_params[:1], duracion, [])
+
+    async def insert_and_get_id(self, query: str, params=()):
+        inicio = time.perf_counter()
+        nuevo_id = await self.conn.fetchval(texto_asyncpg(query, con_id=True), *params)
+        await self._medir(query, params, inicio, 1)
+        return nuevo_id
+
+    async def commit(self):
+        await self.tr.commit()
+        await self._begin()
+
+    async def _cerrar(self):
+        if self.tr is not None:
+            try:
+                await self.tr.rollback()  # lo no commiteado se descarta
+            except Exception:
+                pass
+
+class AsyncHilo:
+    """Conexión normal (SQLite / psycopg2) con cada llamada en el threadpool."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def _cursor(self):
+        return db_cursor(self.conn)
+
+    def _fetchall(self, query, params):
+        c = self._cursor()
+        db_execute(c, query, params)
+        return c.fetchall()
+
+    def _fetchone(self, query, params):
+        c = self._cursor()
+        db_execute(c, query, params)
+        return c.fetchone()
+
+    def _execute(self, query, params):
+        db_execute(self._cursor(), query, params)
+
+    def _insert_and_get_id(self, query, params):
+        return insert_and_get_id(self._cursor(), query, params)
+
+    def _executemany(self, query, seq_params):
+        db_executemany(self._cursor(), query, seq_params)
+
+    async def fetchall(self, query: str, params=()):
+        return await run_in_threadpool(self._fetchall, query, params)
+
+    async def fetchone(self, query: str, params=()):
+        return await run_in_threadpool(self._fetchone, query, params)
+
+    async def execute(self, query: str, params=()):
+        await run_in_threadpool(self._execute, query, params)
+
+    async def executemany(self, query: str, seq_params):
+        await run_in_threadpool(self._executemany, query, seq_params)
+
+    async def insert_and_get_id(self, query: str, params=()):
+        return await run_in_threadpool(self._insert_and_get_id, query, params)
+
+    async def commit(self):
+        await run_in_threadpool(self.conn.commit)
+
+@asynccontextmanager
+async def adb_conn(escritura: bool = False):
+    """Versión async de db_conn(): entrega un AsyncPG o un AsyncHilo."""
+    if IS_POSTGRES and asyncpg is not None:
+        pool = await get_pg_async_pool()
+        inicio = time.perf_counter()
+        async with pool.acquire() as conn:
+            DB_POOL_ESPERA.observar(time.perf_counter() - inicio, "asyncpg")
+            db = AsyncPG(conn)
+            await db._begin()
+            try:
+                yield db
+            finally:
+                await db._cerrar()
+        return
+
+    if not escritura:
+        conn = await run_in_threadpool(get_conn)
+        try:
+            yield AsyncHilo(conn)
+        finally:
+            await run_in_threadpool(close_conn, conn)
+        return
+
+    async with turno_escritor():
+        conn = await run_in_threadpool(get_conn, True)
+        try:
+            yield AsyncHilo(conn)
+        finally:
+            await run_in_threadpool(close_conn, conn)
+
+async def get_adb():
+    async with adb_conn() as db:
+        yield db
+
+async def get_adb_escritura(request: Request):
+    """Como get_db_escritura: sin sesión no se toma la conexión."""
+    if not request.session.get("role"):
+        yield None
+        return
+    async with adb_conn(escritura=True) as db:
+        yield db
+
+@lru_cache(maxsize=1024)
+def _sql_psycopg(query: str, con_id: bool = False) -> str:
+    # los % literales (LIKE '...%', operador <%) se escapan para psycopg2
+    q = query.replace("%", "%%").replace("?", "%s")
+    return q.rstrip().rstrip(";") + " RETURNING id" if con_id else q
+
+CONSULTAS: dict = {}  # nombre -> Consulta
+
+class Consulta(str):
+    """Statement fijo con "?", declarado una sola vez a nivel módulo:
+
+        SQL_SALDO_ACTUAL = Consulta("saldo_actual", "SELECT saldo FROM ... = ?")
+
+    Es un str (sirve en cualquier lugar donde sirve el texto), pero trae hechas
+    desde el import las traducciones a psycopg2 (%s) y asyncpg ($1) y, si es
+    INSERT, la variante con RETURNING id para insert_and_get_id. En Postgres con
+    psycopg2, db_execute la corre como PREPARE/EXECUTE: el parse y el plan se
+    hacen una vez por conexión y no en cada request. asyncpg ya prepara cada
+    texto por su cuenta."""
+
+    def __new__(cls, nombre: str, sql: str, variante: bool = False):
+        if nombre in CONSULTAS:
+            raise ValueError(f"Consulta repetida: {nombre}")
+        self = super().__new__(cls, sql)
+        self.nombre = nombre
+        self.psycopg = _sql_psycopg(sql)
+        self.asyncpg = _sql_asyncpg(sql)
+        # PREPARE toma los $n de asyncpg; EXECUTE pasa los valores con %s
+        self.preparar = f"PREPARE {nombre} AS {self.asyncpg}"
+        n = sql.count("?")
+        self.ejecutar = f"EXECUTE {nombre} ({', '.join(['%s'] * n)})" if n else f"EXECUTE {nombre}"
+        self.con_id = None
+        CONSULTAS[nombre] = self
+        if _operacion(sql) == "insert" and not variante:
+            self.con_id = Consulta(nombre + "_id", sql.rstrip().rstrip(";") + " RETURNING id", variante=True)
+        return self
+
+def db_cursor(conn):
+    """Cursor que entrega filas como dict en los dos motores."""
+    return conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+
+def _execute_pg(cur, query: str, params):
+    preparadas = getattr(cur.connection, "preparadas", None)
+    # sin PG_PREPARAR no hay set; los cursores con nombre (DECLARE ... CURSOR FOR)
+    # no aceptan EXECUTE
+    if not isinstance(query, Consulta):
+        cur.execute(_sql_psycopg(query), params)
+        return
+    if preparadas is None or cur.name is not None:
+        cur.execute(query.psycopg, params)
+        return
+    if query.nombre not in preparadas:
+        cur.execute(query.preparar)
+        preparadas.add(query.nombre)
+    cur.execute(query.ejecutar, params)
 
 def db_execute(cur, query: str, params=()):
+    inicio = time.perf_counter()
     if IS_POSTGRES:
-        query = query.replace("?", "%s")
-    cur.execute(query, params)
+        _execute_pg(cur, query, params)
+    else:
+        cur.execute(query, params)
+    duracion = medir_query(query, inicio, cur.rowcount)
+    if duracion >= DB_LENTA_SEG:
+        reportar_lenta(query, params, duracion, plan_query(cur, query, params))
+
+def db_executemany(cur, query: str, seq_params):
+    inicio = time.perf_counter()
+    seq_params = list(seq_params)
+    cur.executemany(_sql_psycopg(query) if IS_POSTGRES else query, seq_params)
+    duracion = medir_query(query, inicio, cur.rowcount)
+    if duracion >= DB_LENTA_SEG:
+        reportar_lenta(query, seq_params[:1], duracion, [])
+
+def db_execute_values(cur, query: str, filas: list, **kwargs):
+    """execute_values de psycopg2 (query con VALUES %s), medido como db_execute."""
+    inicio = time.perf_counter()
+    execute_values(cur, query, filas, **kwargs)
+    duracion = medir_query(query, inicio, cur.rowcount)
+    if duracion >= DB_LENTA_SEG:
+        reportar_lenta(query, filas[:1], duracion, [])
 
 def insert_and_get_id(cur, query: str, params=()):
+    inicio = time.perf_counter()
     if IS_POSTGRES:
-        q = query.replace("?", "%s").rstrip().rstrip(";") + " RETURNING id"
-        cur.execute(q, params)
-        row = cur.fetchone()
-        return row["id"]
-    cur.execute(query, params)
-    return cur.lastrowid
-
-def init_db():
-    conn = get_conn()
-    cur = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+        if isinstance(query, Consulta):
+            _execute_pg(cur, query.con_id, params)
+        else:
+            cur.execute(_sql_psycopg(query, con_id=True), params)
+        nuevo_id = cur.fetchone()["id"]
+    else:
+        cur.execute(query, params)
+        nuevo_id = cur.lastrowid
+    duracion = medir_query(query, inicio, 1)
+    if duracion >= DB_LENTA_SEG:
+        reportar_lenta(query, params, duracion, plan_query(cur, query, params))
+    return nuevo_id
+
+# ---------------- MIGRACIONES ----------------
+# Cada paso se aplica una sola vez y queda anotado en schema_version.
+# Los pasos son idempotentes (IF NOT EXISTS) por si uno se quedó a medias.
+# {pk}, {num} y {fecha} se traducen al tipo de cada motor.
+
+DDL_TIPOS = {
+    "postgres": {"pk": "SERIAL PRIMARY KEY", "num": "NUMERIC", "fecha": "DATE"},
+    "sqlite": {"pk": "INTEGER PRIMARY KEY AUTOINCREMENT", "num": "REAL", "fecha": "TEXT"},
+}
+
+def agregar_columna(tabla: str, columna: str, tipo: str):
+    """Paso de migración: ALTER TABLE ADD COLUMN solo si la columna no existe
+    (SQLite no tiene ADD COLUMN IF NOT EXISTS)."""
+    def paso(cur):
+        motor = "postgres" if IS_POSTGRES else "sqlite"
+        if IS_POSTGRES:
+            db_execute(cur, """
+                SELECT column_name AS name FROM information_schema.columns
+                WHERE table_name = ?
+            """, (tabla,))
+        else:
+            cur.execute(f"PRAGMA table_info({tabla})")
+        if columna in {r["name"] for r in cur.fetchall()}:
+            return
+        cur.execute(f"ALTER TABLE {tabla} ADD COLUMN {columna} {tipo.format(**DDL_TIPOS[motor])}")
+    return paso
+
+PRODUCTOS_BASE = [
+    ("Pollo entero", "POLLO_ENTERO"),
+    ("Pollo vivo", "POLLO_VIVO"),
+    ("Pechuga", "PECHUGA"),
+    ("Pierna/Muslo", "PIERNA_MUSLO"),
+    ("Alitas", "ALITAS"),
+]
+
+def sembrar_productos(cur):
+    """Paso de migración: los productos base, solo si la tabla está vacía. Va
+    dentro de la transacción de las migraciones (con su lock), así dos workers
+    que arrancan a la vez sobre una base nueva no los insertan dos veces."""
+    db_execute(cur, "SELECT COUNT(*) AS c FROM productos")
+    if int(cur.fetchone()["c"]) == 0:
+        for nombre, codigo in PRODUCTOS_BASE:
+            db_execute(cur, "INSERT INTO productos (nombre, codigo) VALUES (?, ?)", (nombre, codigo))
 
-    if IS_POSTGRES:
-        cur.execute("""
+MIGRACIONES = [
+    (1, "tablas base", [
+        """
         CREATE TABLE IF NOT EXISTS clientes (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             nombre TEXT NOT NULL,
             referencia TEXT
-        );
-        """)
-        cur.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS productos (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             nombre TEXT NOT NULL,
             codigo TEXT UNIQUE NOT NULL
-        );
-        """)
-        cur.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS precios (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             cliente_id INTEGER NULL,
             producto_id INTEGER NOT NULL,
-            fecha DATE NOT NULL,
+            fecha {fecha} NOT NULL,
             tipo_venta TEXT NOT NULL,
-            precio_por_kg NUMERIC NOT NULL
-        );
-        """)
-        cur.execute("""
+            precio_por_kg {num} NOT NULL
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS boletas_pesaje (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             fecha_hora TEXT NOT NULL,
             cliente_id INTEGER NULL,
             producto_id INTEGER NOT NULL,
             tipo_venta TEXT NOT NULL,
             num_pollos INTEGER NOT NULL,
             num_cajas INTEGER NOT NULL,
-            peso_total_kg NUMERIC NOT NULL,
+            peso_total_kg {num} NOT NULL,
             comentarios TEXT,
             estado TEXT NOT NULL
-        );
-        """)
-        cur.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS ventas (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             fecha_hora TEXT NOT NULL,
             boleta_id INTEGER NOT NULL,
             cliente_id INTEGER NULL,
             producto_id INTEGER NOT NULL,
-            peso_neto_kg NUMERIC NOT NULL,
-            precio_por_kg NUMERIC NOT NULL,
-            total NUMERIC NOT NULL,
+            peso_neto_kg {num} NOT NULL,
+            precio_por_kg {num} NOT NULL,
+            total {num} NOT NULL,
             metodo_pago TEXT NOT NULL
-        );
-        """)
-        cur.execute("""
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS movimientos_cliente (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             fecha_hora TEXT NOT NULL,
             cliente_id INTEGER NOT NULL,
             tipo TEXT NOT NULL,
             referencia_id INTEGER NOT NULL,
-            monto NUMERIC NOT NULL
-        );
-        """)
-        cur.execute("""
+            monto {num} NOT NULL
+        )
+        """,
+        """
         CREATE TABLE IF NOT EXISTS devoluciones (
-            id SERIAL PRIMARY KEY,
+            id {pk},
             fecha_hora TEXT NOT NULL,
             venta_id INTEGER NOT NULL,
             cliente_id INTEGER NULL,
-            peso_devuelto_kg NUMERIC NOT NULL,
-            monto_devuelto NUMERIC NOT NULL,
+            peso_devuelto_kg {num} NOT NULL,
+            monto_devuelto {num} NOT NULL,
             motivo TEXT
-        );
-        """)
-        # índice recomendado para que /clientes vuele
-        cur.execute("""
+        )
+        """,
+    ]),
+    (2, "índices de consultas frecuentes", [
+        # obtener_precio y precarga de /clientes
+        """
         CREATE INDEX IF NOT EXISTS idx_precios_lookup
-        ON precios (producto_id, tipo_venta, fecha, cliente_id);
-        """)
-    else:
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS clientes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            referencia TEXT
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS productos (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            nombre TEXT NOT NULL,
-            codigo TEXT UNIQUE NOT NULL
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS precios (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            cliente_id INTEGER NULL,
-            producto_id INTEGER NOT NULL,
-            fecha TEXT NOT NULL,
-            tipo_venta TEXT NOT NULL,
-            precio_por_kg REAL NOT NULL
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS boletas_pesaje (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha_hora TEXT NOT NULL,
-            cliente_id INTEGER NULL,
+        ON precios (producto_id, tipo_venta, fecha, cliente_id)
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_precios_cliente ON precios (cliente_id)",
+        # /boletas/pendientes: solo las abiertas, ya ordenadas por fecha
+        """
+        CREATE INDEX IF NOT EXISTS idx_boletas_abiertas
+        ON boletas_pesaje (fecha_hora) WHERE estado = 'abierta'
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_boletas_cliente ON boletas_pesaje (cliente_id)",
+        # /boletas/cobradas
+        "CREATE INDEX IF NOT EXISTS idx_ventas_fecha ON ventas (fecha_hora)",
+        "CREATE INDEX IF NOT EXISTS idx_ventas_cliente ON ventas (cliente_id)",
+        # /clientes/saldo
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimientos_cliente_fecha
+        ON movimientos_cliente (cliente_id, fecha_hora)
+        """,
+        # devolucion_crear / borrado de clientes
+        "CREATE INDEX IF NOT EXISTS idx_devoluciones_venta ON devoluciones (venta_id)",
+        "CREATE INDEX IF NOT EXISTS idx_devoluciones_cliente ON devoluciones (cliente_id)",
+    ]),
+    (3, "ventas por (fecha_hora, id) para paginar por cursor", [
+        "CREATE INDEX IF NOT EXISTS idx_ventas_fecha_id ON ventas (fecha_hora, id)",
+        "DROP INDEX IF EXISTS idx_ventas_fecha",
+    ]),
+    (4, "búsqueda de clientes indexada (FTS5 / pg_trgm)", [
+        {"sqlite": """
+        CREATE VIRTUAL TABLE IF NOT EXISTS clientes_fts USING fts5(
+            nombre, referencia,
+            content='clientes', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """},
+        # triggers: clientes_crear / clientes_eliminar (y cualquier otro INSERT) lo mantienen al día
+        {"sqlite": """
+        CREATE TRIGGER IF NOT EXISTS clientes_fts_ai AFTER INSERT ON clientes BEGIN
+            INSERT INTO clientes_fts (rowid, nombre, referencia)
+            VALUES (new.id, new.nombre, new.referencia);
+        END
+        """},
+        {"sqlite": """
+        CREATE TRIGGER IF NOT EXISTS clientes_fts_ad AFTER DELETE ON clientes BEGIN
+            INSERT INTO clientes_fts (clientes_fts, rowid, nombre, referencia)
+            VALUES ('delete', old.id, old.nombre, old.referencia);
+        END
+        """},
+        {"sqlite": """
+        CREATE TRIGGER IF NOT EXISTS clientes_fts_au AFTER UPDATE ON clientes BEGIN
+            INSERT INTO clientes_fts (clientes_fts, rowid, nombre, referencia)
+            VALUES ('delete', old.id, old.nombre, old.referencia);
+            INSERT INTO clientes_fts (rowid, nombre, referencia)
+            VALUES (new.id, new.nombre, new.referencia);
+        END
+        """},
+        {"sqlite": "INSERT INTO clientes_fts (clientes_fts) VALUES ('rebuild')"},
+        {"postgres": "CREATE EXTENSION IF NOT EXISTS pg_trgm"},
+        {"postgres": "CREATE EXTENSION IF NOT EXISTS unaccent"},
+        # unaccent() no es IMMUTABLE; este wrapper sí, para poder indexarlo
+        {"postgres": """
+        CREATE OR REPLACE FUNCTION f_unaccent(text) RETURNS text
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+        AS $$ SELECT public.unaccent('public.unaccent', $1) $$
+        """},
+        {"postgres": """
+        CREATE INDEX IF NOT EXISTS idx_clientes_busqueda_trgm ON clientes
+        USING gin (f_unaccent(lower(nombre || ' ' || coalesce(referencia, ''))) gin_trgm_ops)
+        """},
+    ]),
+    (5, "saldo materializado por cliente", [
+        """
+        CREATE TABLE IF NOT EXISTS saldos_clientes (
+            cliente_id INTEGER PRIMARY KEY,
+            saldo {num} NOT NULL DEFAULT 0,
+            num_movimientos INTEGER NOT NULL DEFAULT 0,
+            ultimo_movimiento TEXT
+        )
+        """,
+        # cada movimiento guarda el saldo que dejó: sirve de checkpoint para paginar
+        agregar_columna("movimientos_cliente", "saldo_despues", "{num}"),
+        """
+        UPDATE movimientos_cliente
+        SET saldo_despues = t.saldo
+        FROM (
+            SELECT id, SUM(monto) OVER (
+                PARTITION BY cliente_id ORDER BY fecha_hora, id
+            ) AS saldo
+            FROM movimientos_cliente
+        ) AS t
+        WHERE t.id = movimientos_cliente.id
+        """,
+        """
+        INSERT INTO saldos_clientes (cliente_id, saldo, num_movimientos, ultimo_movimiento)
+        SELECT cliente_id, SUM(monto), COUNT(*), MAX(fecha_hora)
+        FROM movimientos_cliente
+        GROUP BY cliente_id
+        ON CONFLICT (cliente_id) DO NOTHING
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_movimientos_cliente_fecha_id
+        ON movimientos_cliente (cliente_id, fecha_hora, id)
+        """,
+        "DROP INDEX IF EXISTS idx_movimientos_cliente_fecha",
+    ]),
+    (6, "cartera: último abono y ranking por saldo", [
+        agregar_columna("saldos_clientes", "ultimo_pago", "TEXT"),
+        """
+        UPDATE saldos_clientes
+        SET ultimo_pago = (
+            SELECT MAX(m.fecha_hora) FROM movimientos_cliente m
+            WHERE m.cliente_id = saldos_clientes.cliente_id
+              AND m.monto < 0 AND m.tipo <> 'devolucion'
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_saldos_saldo ON saldos_clientes (saldo, cliente_id)",
+    ]),
+    (7, "precios con vigencia (vigente_hasta)", [
+        agregar_columna("precios", "vigente_hasta", "{fecha}"),
+        """
+        UPDATE precios
+        SET vigente_hasta = t.hasta
+        FROM (
+            SELECT id, LEAD(fecha) OVER (
+                PARTITION BY cliente_id, producto_id, tipo_venta ORDER BY fecha, id
+            ) AS hasta
+            FROM precios
+        ) AS t
+        WHERE t.id = precios.id
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_precios_vigencia
+        ON precios (producto_id, tipo_venta, cliente_id, fecha)
+        """,
+        "DROP INDEX IF EXISTS idx_precios_lookup",
+    ]),
+    (8, "resumen diario para cierre de caja", [
+        """
+        CREATE TABLE IF NOT EXISTS resumen_diario (
+            fecha {fecha} NOT NULL,
             producto_id INTEGER NOT NULL,
             tipo_venta TEXT NOT NULL,
-            num_pollos INTEGER NOT NULL,
-            num_cajas INTEGER NOT NULL,
-            peso_total_kg REAL NOT NULL,
-            comentarios TEXT,
-            estado TEXT NOT NULL
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS ventas (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha_hora TEXT NOT NULL,
-            boleta_id INTEGER NOT NULL,
-            cliente_id INTEGER NULL,
-            producto_id INTEGER NOT NULL,
-            peso_neto_kg REAL NOT NULL,
-            precio_por_kg REAL NOT NULL,
-            total REAL NOT NULL,
-            metodo_pago TEXT NOT NULL
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS movimientos_cliente (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha_hora TEXT NOT NULL,
-            cliente_id INTEGER NOT NULL,
-            tipo TEXT NOT NULL,
-            referencia_id INTEGER NOT NULL,
-            monto REAL NOT NULL
-        );
-        """)
-        cur.execute("""
-        CREATE TABLE IF NOT EXISTS devoluciones (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            fecha_hora TEXT NOT NULL,
-            venta_id INTEGER NOT NULL,
-            cliente_id INTEGER NULL,
-            peso_devuelto_kg REAL NOT NULL,
-            monto_devuelto REAL NOT NULL,
-            motivo TEXT
-        );
-        """)
+            metodo_pago TEXT NOT NULL,
+            num_ventas INTEGER NOT NULL DEFAULT 0,
+            kg {num} NOT NULL DEFAULT 0,
+            pollos INTEGER NOT NULL DEFAULT 0,
+            cajas INTEGER NOT NULL DEFAULT 0,
+            total {num} NOT NULL DEFAULT 0,
+            num_devoluciones INTEGER NOT NULL DEFAULT 0,
+            kg_devuelto {num} NOT NULL DEFAULT 0,
+            monto_devuelto {num} NOT NULL DEFAULT 0,
+            PRIMARY KEY (fecha, producto_id, tipo_venta, metodo_pago)
+        )
+        """,
+        lambda cur: reconstruir_resumen_diario(cur),
+    ]),
+    (9, "productos base", [
+        sembrar_productos,
+    ]),
+]
+
+def aplicar_migraciones(conn):
+    cur = db_cursor(conn)
+    motor = "postgres" if IS_POSTGRES else "sqlite"
+
+    # si arrancan varios workers a la vez, solo uno migra: en Postgres con un
+    # advisory lock y en SQLite con la conexión escritora (BEGIN IMMEDIATE).
+    # En los dos motores el DDL es transaccional, así que todos los pasos
+    # pendientes van en una sola transacción y el lock se suelta en el commit.
+    if IS_POSTGRES:
+        cur.execute("SELECT pg_advisory_xact_lock(72417001)")
 
-    db_execute(cur, "SELECT COUNT(*) AS c FROM productos")
-    count_row = cur.fetchone()
-    count_val = count_row["c"] if isinstance(count_row, dict) else count_row["c"]
-    if int(count_val) == 0:
-        productos_seed = [
-            ("Pollo entero", "POLLO_ENTERO"),
-            ("Pollo vivo", "POLLO_VIVO"),
-            ("Pechuga", "PECHUGA"),
-            ("Pierna/Muslo", "PIERNA_MUSLO"),
-            ("Alitas", "ALITAS"),
-        ]
-        for nombre, codigo in productos_seed:
-            insert_and_get_id(
-                cur,
-                "INSERT INTO productos (nombre, codigo) VALUES (?, ?)",
-                (nombre, codigo),
-            )
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        descripcion TEXT NOT NULL,
+        aplicada TEXT NOT NULL
+    )
+    """)
+
+    db_execute(cur, "SELECT version FROM schema_version")
+    aplicadas = {int(r["version"]) for r in cur.fetchall()}
+
+    for version, descripcion, pasos in MIGRACIONES:
+        if version in aplicadas:
+            continue
+        for sql in pasos:
+            if callable(sql):
+                sql(cur)
+                continue
+            if isinstance(sql, dict):
+                sql = sql.get(motor)
+                if not sql:
+                    continue
+            cur.execute(sql.format(**DDL_TIPOS[motor]) if "{" in sql else sql)
+        db_execute(cur, """
+            INSERT INTO schema_version (version, descripcion, aplicada)
+            VALUES (?, ?, ?)
+        """, (version, descripcion, datetime.now().isoformat(timespec="seconds")))
 
     conn.commit()
-    close_conn(conn)
+
+def init_db():
+    with db_conn(escritura=True) as conn:
+        aplicar_migraciones(conn)  # incluye los productos base (migración 9)
+
+_compactador_iniciado = False
 
 @app.on_event("startup")
 def _startup():
+    global _compactador_iniciado
     if IS_POSTGRES:
         init_pg_pool()
     init_db()
+    if not _compactador_iniciado:
+        _compactador_iniciado = True
+        if PRECIOS_COMPACTAR_HORAS > 0:
+            threading.Thread(target=_compactar_precios_loop, name="compactar_precios", daemon=True).start()
+        if SNAPSHOT_HORAS > 0:
+            threading.Thread(target=_snapshot_loop, name="snapshot_reportes", daemon=True).start()
+
+@app.on_event("shutdown")
+async def _shutdown():
+    global PG_ASYNC_POOL
+    if PG_ASYNC_POOL is not None:
+        pool, PG_ASYNC_POOL = PG_ASYNC_POOL, None
+        await pool.close()
 
 # ---------------- AUTH / ROLES ----------------
 
@@ -319,143 +1428,39 @@ def nav_html(role: Optional[str]) -> str:
         <a href="/boletas/pendientes">Boletas pendientes</a>
         <a href="/boletas/cobradas">Boletas cobradas</a>
         <a href="/clientes/saldos">Saldos clientes</a>
+        <a href="/clientes/cartera">Cartera</a>
         <a href="/devoluciones/nueva">Devolución</a>
+        <a href="/cierre">Cierre</a>
+        <a href="/export">Exportar</a>
+        <a href="/reportes">Reportes</a>
         <a href="/logout">Salir</a>
     """
 
-def layout(request: Request, title: str, body: str) -> HTMLResponse:
+def layout_partes(request: Request, title: str) -> tuple[str, str]:
+    """Regresa (inicio, fin) de la página; el contenido va en medio."""
     role = request.session.get("role")
     role_badge = (
         f"<span style='margin-left:10px;color:#d1d5db;font-size:12px;'>Usuario: <b>{role}</b></span>"
         if role else ""
     )
 
-    html = f"""
+    inicio = f"""
     <html>
     <head>
         <title>{title}</title>
         <meta charset="utf-8" />
-        <style>
-            body {{
-                font-family: system-ui, -apple-system, BlinkMacSystemFont, 'Segoe UI', sans-serif;
-                margin: 0;
-                padding: 0;
-                background: #f3f3f3;
-            }}
-            header {{
-                background: #222;
-                color: white;
-                padding: 10px 20px;
-                display: flex;
-                align-items: center;
-                gap: 20px;
-            }}
-            header img.logo {{
-                height: 110px;
-                border-radius: 8px;
-                background: white;
-                padding: 6px;
-            }}
-            header .title-block {{
-                display: flex;
-                flex-direction: column;
-                width: 100%;
-            }}
-            header .title-block h1 {{
-                margin: 0;
-                font-size: 18px;
-                letter-spacing: 0.5px;
-            }}
-            header .title-block span {{
-                font-size: 12px;
-                color: #d1d5db;
-            }}
-            nav {{
-                margin-top: 8px;
-            }}
-            nav a {{
-                margin-right: 15px;
-                color: white;
-                text-decoration: none;
-                font-size: 14px;
-            }}
-            nav a:hover {{
-                text-decoration: underline;
-            }}
-            .container {{
-                padding: 20px;
-            }}
-            .card {{
-                background: white;
-                padding: 15px 20px;
-                margin-bottom: 15px;
-                border-radius: 8px;
-                box-shadow: 0 1px 3px rgba(0,0,0,0.12);
-            }}
-            .btn {{
-                padding: 6px 12px;
-                border-radius: 6px;
-                border: none;
-                cursor: pointer;
-                margin-right: 5px;
-                text-decoration: none;
-                display: inline-block;
-            }}
-            .btn-primary {{
-                background: #2563eb;
-                color: white;
-            }}
-            .btn-secondary {{
-                background: #e5e7eb;
-                color: #111;
-            }}
-            .btn-danger {{
-                background: #dc2626;
-                color: white;
-            }}
-            input, select, textarea {{
-                padding: 6px 8px;
-                margin: 4px 0 10px 0;
-                width: 100%;
-                box-sizing: border-box;
-            }}
-            label {{
-                font-size: 14px;
-                font-weight: 500;
-            }}
-            table {{
-                border-collapse: collapse;
-                width: 100%;
-                margin-top: 10px;
-            }}
-            th, td {{
-                border: 1px solid #ddd;
-                padding: 8px;
-                font-size: 13px;
-            }}
-            th {{
-                background-color: #f9fafb;
-                text-align: left;
-            }}
-            .error {{
-                background: #fee2e2;
-                border: 1px solid #fecaca;
-                padding: 12px;
-                border-radius: 8px;
-                color: #991b1b;
-            }}
-            .actions {{
-                white-space: nowrap;
-            }}
-            .actions form {{
-                display: inline;
-            }}
-        </style>
+        <link rel="stylesheet" href="{asset_url('estilos.css')}" />
     </head>
     <body>
         <header>
-            <img src="/static/logo_san_pablito.png" class="logo"
-                 alt="Procesadora y Distribuidora Avícola San Pablito" />
+            <picture>
+                <source type="image/webp"
+                        srcset="{asset_url('logo_san_pablito_110.webp')} 1x, {asset_url('logo_san_pablito_220.webp')} 2x" />
+                <img src="{asset_url('logo_san_pablito_110.png')}"
+                     srcset="{asset_url('logo_san_pablito_110.png')} 1x, {asset_url('logo_san_pablito_220.png')} 2x"
+                     width="165" height="110" class="logo"
+                     alt="Procesadora y Distribuidora Avícola San Pablito" />
+            </picture>
             <div class="title-block">
                 <h1>Procesadora y Distribuidora Avícola San Pablito{role_badge}</h1>
                 <span>Sistema de pesaje, precios, créditos y devoluciones</span>
@@ -463,12 +1468,88 @@ def layout(request: Request, title: str, body: str) -> HTMLResponse:
             </div>
         </header>
         <div class="container">
-            {body}
+    """
+    fin = """
         </div>
     </body>
     </html>
     """
-    return HTMLResponse(content=html)
+    return inicio, fin
+
+def layout(request: Request, title: str, body: str) -> HTMLResponse:
+    inicio, fin = layout_partes(request, title)
+    return HTMLResponse(content=inicio + body + fin)
+
+STREAM_CHUNK = 16 * 1024
+
+def layout_stream(request: Request, title: str, partes) -> StreamingResponse:
+    """Como layout(), pero el contenido es un iterable de pedazos de HTML: el
+    header y el nav salen de inmediato y las filas conforme las da el cursor.
+    Se agrupan en bloques de ~STREAM_CHUNK para no mandar un write por fila."""
+    inicio, fin = layout_partes(request, title)
+
+    def generar():
+        yield inicio
+        buf, tam = [], 0
+        for parte in partes:
+            if not parte:
+                continue
+            buf.append(parte)
+            tam += len(parte)
+            if tam >= STREAM_CHUNK:
+                yield "".join(buf)
+                buf, tam = [], 0
+        buf.append(fin)
+        yield "".join(buf)
+
+    return StreamingResponse(generar(), media_type="text/html; charset=utf-8")
+
+def iter_filas(c, tamano: int = 500):
+    """Itera el resultado del cursor en bloques de fetchmany, sin fetchall()."""
+    while True:
+        filas = c.fetchmany(tamano)
+        if not filas:
+            return
+        yield from filas
+
+def cursor_servidor(conn, nombre: str, tamano: int = 2000):
+    """Cursor para recorrer resultados grandes sin traerlos completos a memoria.
+    En Postgres es un cursor con nombre (del lado del servidor) que trae `tamano`
+    filas por viaje; en SQLite el cursor normal ya lee conforme se itera."""
+    if IS_POSTGRES:
+        c = conn.cursor(name=nombre, cursor_factory=RealDictCursor)
+        c.itersize = tamano
+        return c
+    return conn.cursor()
+
+class PaginaKeyset:
+    """Filas de una página keyset en orden de pantalla. La consulta trae
+    per_page+1 filas; la extra solo indica que hay más. Si la página va hacia
+    adelante las filas salen directo del cursor; si va hacia atrás (consulta en
+    orden inverso) se juntan primero, que son a lo mucho per_page."""
+
+    def __init__(self, c, per_page: int, hacia_atras: bool):
+        self.c = c
+        self.per_page = per_page
+        self.hacia_atras = hacia_atras
+        self.primera = self.ultima = None
+        self.hay_mas = False
+
+    def __iter__(self):
+        if self.hacia_atras:
+            filas, self.hay_mas = pagina_keyset(self.c.fetchall(), self.per_page, True)
+        else:
+            filas = iter_filas(self.c)
+        n = 0
+        for fila in filas:
+            if n == self.per_page:
+                self.hay_mas = True
+                break
+            if self.primera is None:
+                self.primera = fila
+            self.ultima = fila
+            n += 1
+            yield fila
 
 def error_card(request: Request, msg: str) -> HTMLResponse:
     return layout(request, "Error", f"<div class='card error'><b>Error:</b> {msg}</div>")
@@ -527,47 +1608,845 @@ def logout(request: Request):
 
 # ---------------- UTILIDADES ----------------
 
-def get_productos():
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    db_execute(c, "SELECT id, nombre, codigo FROM productos ORDER BY id")
-    productos = c.fetchall()
-    close_conn(conn)
-    return productos
-
-def get_clientes():
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    db_execute(c, "SELECT id, nombre FROM clientes ORDER BY nombre")
-    clientes = c.fetchall()
-    close_conn(conn)
-    return clientes
-
-def obtener_precio(cliente_id, producto_id, fecha_txt, tipo_venta):
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+SQL_PRODUCTOS = Consulta("productos", "SELECT id, nombre, codigo FROM productos ORDER BY id")
+
+def get_productos(conn=None):
+    with db_conn(conn) as conn:
+        c = db_cursor(conn)
+        db_execute(c, SQL_PRODUCTOS)
+        return c.fetchall()
+
+def get_clientes(conn=None):
+    with db_conn(conn) as conn:
+        c = db_cursor(conn)
+        db_execute(c, "SELECT id, nombre, referencia FROM clientes ORDER BY nombre")
+        return c.fetchall()
+
+# ---- cache de precios ----
+# fecha -> {(cliente_id, producto_id, tipo_venta): (precio, expira)}
+# Se guardan solo las últimas PRECIOS_CACHE_DIAS fechas; al entrar una nueva
+# se saca la más vieja. Un precio vale de su fecha en adelante, así que al
+# guardar se invalida la fecha que se tocó y todas las posteriores.
+_precios_cache: "OrderedDict[str, dict]" = OrderedDict()
+_precios_cache_n = 0
+_precios_cache_lock = threading.Lock()
+
+def _precio_cache_get(key, fecha_txt):
+    with _precios_cache_lock:
+        bucket = _precios_cache.get(fecha_txt)
+        if bucket is None:
+            return False, None
+        hit = bucket.get(key)
+        if hit is None:
+            return False, None
+        precio, expira = hit
+        if expira < time.monotonic():
+            return False, None
+        return True, precio
+
+def _precio_cache_put(key, fecha_txt, precio):
+    global _precios_cache_n
+    with _precios_cache_lock:
+        bucket = _precios_cache.get(fecha_txt)
+        if bucket is None:
+            bucket = _precios_cache[fecha_txt] = {}
+            # fechas viejas fuera (las fechas ISO ordenan como texto)
+            while len(_precios_cache) > PRECIOS_CACHE_DIAS:
+                vieja = min(_precios_cache)
+                _precios_cache_n -= len(_precios_cache.pop(vieja))
+            if fecha_txt not in _precios_cache:
+                return  # era más vieja que todas las guardadas: no se cachea
+        if key not in bucket:
+            _precios_cache_n += 1
+        bucket[key] = (precio, time.monotonic() + PRECIOS_CACHE_TTL)
+        # tope de entradas: se sacan fechas completas, de la más vieja a la más nueva
+        while _precios_cache_n > PRECIOS_CACHE_MAX and _precios_cache:
+            vieja = min(_precios_cache)
+            _precios_cache_n -= len(_precios_cache.pop(vieja))
+
+def invalidar_precios_cache(fecha_txt: Optional[str] = None):
+    global _precios_cache_n
+    with _precios_cache_lock:
+        if fecha_txt is None:
+            _precios_cache.clear()
+            _precios_cache_n = 0
+        else:
+            for f in [f for f in _precios_cache if f >= str(fecha_txt)]:
+                _precios_cache_n -= len(_precios_cache.pop(f))
+
+# 1 query: primero el vigente del cliente, si no hay, el general (cliente_id NULL).
+# Cada subconsulta es una sola lectura de idx_precios_vigencia (el rango de
+# fechas más reciente que empieza antes o en la fecha pedida).
+SQL_PRECIO = Consulta("precio", """
+    SELECT COALESCE(
+        (SELECT precio_por_kg FROM precios
+         WHERE producto_id = ? AND tipo_venta = ? AND cliente_id = ?
+           AND fecha <= ? AND (vigente_hasta IS NULL OR vigente_hasta > ?)
+         ORDER BY fecha DESC LIMIT 1),
+        (SELECT precio_por_kg FROM precios
+         WHERE producto_id = ? AND tipo_venta = ? AND cliente_id IS NULL
+           AND fecha <= ? AND (vigente_hasta IS NULL OR vigente_hasta > ?)
+         ORDER BY fecha DESC LIMIT 1)
+    ) AS precio_por_kg
+""")
+
+def _params_precio(cliente_id, producto_id, fecha_txt, tipo_venta):
+    return (producto_id, tipo_venta, cliente_id, fecha_txt, fecha_txt,
+            producto_id, tipo_venta, fecha_txt, fecha_txt)
+
+async def obtener_precio_async(db, cliente_id, producto_id, fecha_txt, tipo_venta):
+    fecha_txt = str(fecha_txt)
+    key = (cliente_id, int(producto_id), tipo_venta)
+    found, precio = _precio_cache_get(key, fecha_txt)
+    if found:
+        return precio
+
+    row = await db.fetchone(SQL_PRECIO, _params_precio(cliente_id, producto_id, fecha_txt, tipo_venta))
+    precio = float(row["precio_por_kg"]) if row and row["precio_por_kg"] is not None else None
+    _precio_cache_put(key, fecha_txt, precio)
+    return precio
+
+# ---- vigencia de precios ----
+# Cada fila de precios vale desde `fecha` hasta `vigente_hasta` (sin incluirla;
+# NULL = sigue vigente), así el último precio sigue valiendo los días siguientes
+# hasta que se capture otro. vigente_hasta es la fecha de la siguiente fila de la
+# misma llave (cliente, producto, tipo); las filas repetidas del mismo día quedan
+# con rango vacío (vigente_hasta = fecha) y las borra compactar_precios.
+IGUAL_O_NULOS = "IS NOT DISTINCT FROM" if IS_POSTGRES else "IS"
+DISTINTO_O_NULOS = "IS DISTINCT FROM" if IS_POSTGRES else "IS NOT"
+PRECIOS_COMPACTAR_HORAS = float(os.getenv("PRECIOS_COMPACTAR_HORAS", "24"))  # 0 = no compactar
+SNAPSHOT_HORAS = float(os.getenv("SNAPSHOT_HORAS", "0"))  # 0 = solo a mano o con cron (reportes.py)
+
+def filtro_clientes_precios(cliente_ids=None, incluir_general: bool = True):
+    """Condición SQL sobre cliente_id. cliente_ids=None = todos ("", ()).
+    Regresa (None, ()) si la selección queda vacía."""
+    if cliente_ids is None:
+        return "", ()
+    partes = []
+    if cliente_ids:
+        partes.append(f"cliente_id IN ({', '.join('?' for _ in cliente_ids)})")
+    if incluir_general:
+        partes.append("cliente_id IS NULL")
+    if not partes:
+        return None, ()
+    return f"({' OR '.join(partes)})", tuple(cliente_ids)
+
+def sql_vigencias(filtro: str = "") -> str:
+    return f"""
+        UPDATE precios SET vigente_hasta = t.hasta
+        FROM (
+            SELECT id, LEAD(fecha) OVER (
+                PARTITION BY cliente_id, producto_id, tipo_venta ORDER BY fecha, id
+            ) AS hasta
+            FROM precios
+            {"WHERE " + filtro if filtro else ""}
+        ) AS t
+        WHERE t.id = precios.id AND precios.vigente_hasta {DISTINTO_O_NULOS} t.hasta
+    """
 
-    if cliente_id is not None:
+def recalcular_vigencias(c, cliente_ids=None, incluir_general: bool = True):
+    """Recalcula vigente_hasta de los clientes tocados (llaves completas), en la
+    misma transacción que insertó o borró precios."""
+    filtro, params = filtro_clientes_precios(cliente_ids, incluir_general)
+    if filtro is not None:
+        db_execute(c, sql_vigencias(filtro), params)
+
+def compactar_precios(c) -> int:
+    """Borra lo que ya no cambia ningún precio: filas repetidas del mismo día y
+    filas que repiten el precio del rango anterior. Devuelve cuántas borró."""
+    db_execute(c, "DELETE FROM precios WHERE vigente_hasta IS NOT NULL AND vigente_hasta <= fecha")
+    borradas = c.rowcount
+    db_execute(c, """
+        DELETE FROM precios WHERE id IN (
+            SELECT id FROM (
+                SELECT id, precio_por_kg, LAG(precio_por_kg) OVER (
+                    PARTITION BY cliente_id, producto_id, tipo_venta ORDER BY fecha, id
+                ) AS anterior
+                FROM precios
+            ) t
+            WHERE t.anterior = t.precio_por_kg
+        )
+    """)
+    borradas += c.rowcount
+    if borradas:
+        recalcular_vigencias(c)
+    return borradas
+
+def _compactar_precios_loop():
+    while True:
+        try:
+            with db_conn(escritura=True) as conn:
+                c = db_cursor(conn)
+                # con varios workers solo compacta uno
+                ok = True
+                if IS_POSTGRES:
+                    db_execute(c, "SELECT pg_try_advisory_xact_lock(72417002) AS ok")
+                    ok = c.fetchone()["ok"]
+                if ok:
+                    compactar_precios(c)
+                conn.commit()
+        except Exception:
+            log.exception("compactar_precios falló")
+        time.sleep(PRECIOS_COMPACTAR_HORAS * 3600)
+
+def _snapshot_loop():
+    import reportes  # necesita numpy; se importa aquí para no cargarlo si no se usa
+    while True:
+        try:
+            reportes.actualizar_snapshot()
+        except Exception:
+            log.exception("snapshot de reportes falló")
+        time.sleep(SNAPSHOT_HORAS * 3600)
+
+# ---- importación de listas de precios ----
+# Una fila por precio: fecha, cliente, producto, tipo_venta, precio.
+# cliente puede ser id, referencia o nombre (vacío / 0 / OTRO = precio general);
+# producto puede ser código o nombre. fecha es opcional si se da en el formulario.
+COLUMNAS_LISTA_PRECIOS = ["fecha", "cliente", "producto", "tipo_venta", "precio"]
+TIPOS_VENTA = ("normal", "mayoreo", "menudeo")
+PRODUCTOS_CON_TIPOS = ("POLLO_ENTERO", "POLLO_VIVO")
+CLIENTE_GENERAL = ("", "0", "OTRO", "GENERAL", "CONTADO")
+IMPORTAR_MAX_ERRORES = 20
+
+def _celda_txt(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.date().isoformat()
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v).strip()
+
+def leer_lista_precios(nombre_archivo: str, contenido: bytes) -> list:
+    """Devuelve [(num_linea, {columna: texto})] de un CSV o XLSX con encabezados."""
+    if nombre_archivo.lower().endswith(".xlsx"):
+        if openpyxl is None:
+            raise ValueError("Para importar .xlsx hay que instalar openpyxl (o guarda el archivo como CSV).")
+        libro = openpyxl.load_workbook(io.BytesIO(contenido), read_only=True, data_only=True)
+        renglones = libro.active.iter_rows(values_only=True)
+    else:
+        texto = contenido.decode("utf-8-sig", errors="replace")
+        try:
+            dialecto = csv.Sniffer().sniff(texto[:4096], delimiters=",;\t")
+        except csv.Error:
+            dialecto = csv.excel
+        renglones = csv.reader(io.StringIO(texto), dialecto)
+
+    encabezado = None
+    filas = []
+    for num, renglon in enumerate(renglones, start=1):
+        celdas = [_celda_txt(v) for v in renglon]
+        if not any(celdas):
+            continue
+        if encabezado is None:
+            encabezado = [normalizar_texto(x).replace(" ", "_") for x in celdas]
+            faltan = [col for col in COLUMNAS_LISTA_PRECIOS if col != "fecha" and col not in encabezado]
+            if faltan:
+                raise ValueError(f"Faltan columnas en el encabezado: {', '.join(faltan)}.")
+            continue
+        filas.append((num, dict(zip(encabezado, celdas))))
+    return filas
+
+def _fecha_lista(txt: str) -> str:
+    for fmt in ("%Y-%m-%d", "%d/%m/%Y", "%d-%m-%Y"):
+        try:
+            return datetime.strptime(txt, fmt).date().isoformat()
+        except ValueError:
+            pass
+    raise ValueError(f"fecha '{txt}' no válida (usa AAAA-MM-DD o DD/MM/AAAA)")
+
+def _precio_lista(txt: str) -> float:
+    txt = txt.replace("$", "").replace(" ", "")
+    if "," in txt and "." not in txt:
+        txt = txt.replace(",", ".")
+    precio = float(txt.replace(",", ""))
+    if precio <= 0:
+        raise ValueError
+    return precio
+
+def validar_lista_precios(filas, clientes, productos, fecha_default: str = ""):
+    """Resuelve clientes/productos y valida. Devuelve (registros, errores, repetidos):
+    registros es {(cliente_id, producto_id, fecha, tipo_venta): precio}; si un precio
+    viene repetido en el archivo gana el último."""
+    por_cliente = {}
+    for cl in clientes:
+        por_cliente.setdefault(normalizar_texto(cl["nombre"]), cl["id"])
+        if cl["referencia"]:
+            por_cliente.setdefault(normalizar_texto(cl["referencia"]), cl["id"])
+    ids_cliente = {cl["id"] for cl in clientes}
+
+    por_producto = {}
+    codigo_de = {}
+    for p in productos:
+        por_producto[normalizar_texto(p["codigo"])] = p["id"]
+        por_producto.setdefault(normalizar_texto(p["nombre"]), p["id"])
+        codigo_de[p["id"]] = p["codigo"]
+
+    registros = {}
+    errores = []
+    repetidos = 0
+    for num, fila in filas:
+        try:
+            fecha_txt = fila.get("fecha") or fecha_default
+            if not fecha_txt:
+                raise ValueError("falta la fecha")
+            fecha = _fecha_lista(fecha_txt)
+
+            cliente_txt = fila.get("cliente", "")
+            if cliente_txt.upper() in CLIENTE_GENERAL:
+                cliente_id = None
+            elif cliente_txt.isdigit():
+                cliente_id = int(cliente_txt)
+                if cliente_id not in ids_cliente:
+                    raise ValueError(f"cliente #{cliente_id} no existe")
+            else:
+                cliente_id = por_cliente.get(normalizar_texto(cliente_txt))
+                if cliente_id is None:
+                    raise ValueError(f"cliente '{cliente_txt}' no encontrado")
+
+            producto_txt = normalizar_texto(fila.get("producto", "")).replace(" ", "_")
+            producto_id = por_producto.get(producto_txt) or por_producto.get(producto_txt.replace("_", " "))
+            if producto_id is None:
+                raise ValueError(f"producto '{fila.get('producto', '')}' no encontrado")
+
+            tipo_venta = (fila.get("tipo_venta") or "normal").lower()
+            if tipo_venta not in TIPOS_VENTA:
+                raise ValueError(f"tipo_venta '{tipo_venta}' no válido")
+            if tipo_venta != "normal" and codigo_de[producto_id] not in PRODUCTOS_CON_TIPOS:
+                raise ValueError(f"{codigo_de[producto_id]} solo tiene precio normal")
+
+            try:
+                precio = _precio_lista(fila.get("precio", ""))
+            except ValueError:
+                raise ValueError(f"precio '{fila.get('precio', '')}' no válido")
+        except ValueError as e:
+            errores.append(f"Línea {num}: {e}")
+            if len(errores) >= IMPORTAR_MAX_ERRORES:
+                break
+            continue
+
+        key = (cliente_id, producto_id, fecha, tipo_venta)
+        if key in registros:
+            repetidos += 1
+        registros[key] = precio
+    return registros, errores, repetidos
+
+def cargar_precios(c, registros: dict):
+    """Reemplaza en bloque los precios de `registros` (misma llave cliente/producto/
+    fecha/tipo) dentro de la transacción del handler. Devuelve (insertados, reemplazados)."""
+    llaves = list(registros)
+    valores = [k + (registros[k],) for k in llaves]
+    if not llaves:
+        return 0, 0
+
+    if IS_POSTGRES:
+        # una sola sentencia para borrar y otra para insertar, en lugar de ida y vuelta por fila
+        db_execute_values(c, """
+            DELETE FROM precios p
+            USING (VALUES %s) AS v (cliente_id, producto_id, fecha, tipo_venta)
+            WHERE p.producto_id = v.producto_id AND p.tipo_venta = v.tipo_venta
+              AND p.fecha = v.fecha AND p.cliente_id IS NOT DISTINCT FROM v.cliente_id
+        """, llaves, template="(%s::integer, %s::integer, %s::date, %s)", page_size=len(llaves))
+        reemplazados = c.rowcount
+        db_execute_values(c, """
+            INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
+            VALUES %s
+        """, valores, page_size=1000)
+    else:
+        db_executemany(c, """
+            DELETE FROM precios
+            WHERE producto_id = ? AND tipo_venta = ? AND fecha = ? AND cliente_id IS ?
+        """, [(pid, tipo, fecha, cid) for cid, pid, fecha, tipo in llaves])
+        reemplazados = c.rowcount
+        db_executemany(c, """
+            INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
+            VALUES (?, ?, ?, ?, ?)
+        """, valores)
+
+    tocados = {k[0] for k in llaves}
+    recalcular_vigencias(c, sorted(x for x in tocados if x is not None), None in tocados)
+    return len(valores), reemplazados
+
+# ---- copiar precios de un día a otro ----
+# Se toma el precio vigente por cliente/producto/tipo en la fecha origen y se
+# inserta en la fecha destino con un solo INSERT ... SELECT.
+
+def copiar_precios(c, fecha_origen: str, fecha_destino: str, cliente_ids=None,
+                   incluir_general: bool = True, ajuste_pct: float = 0.0,
+                   ajuste_kg: float = 0.0, reemplazar: bool = False):
+    """cliente_ids=None copia todos los clientes. Devuelve (copiados, reemplazados,
+    sin_cambio); sin_cambio son los que ya valían eso en la fecha destino y no se
+    guardan (compactar_precios los borraría de todos modos)."""
+    filtro, filtro_params = filtro_clientes_precios(cliente_ids, incluir_general)
+    if filtro is None:
+        return 0, 0, 0
+
+    db_execute(c, "SELECT COALESCE(MAX(id), 0) AS m FROM precios")
+    max_id = int(c.fetchone()["m"])
+
+    fecha_sql = "CAST(? AS DATE)" if IS_POSTGRES else "?"
+    sin_repetir = "" if reemplazar else f"""
+          AND NOT EXISTS (
+              SELECT 1 FROM precios d
+              WHERE d.fecha = ? AND d.producto_id = o.producto_id AND d.tipo_venta = o.tipo_venta
+                AND d.cliente_id {IGUAL_O_NULOS} o.cliente_id
+          )"""
+    db_execute(c, f"""
+        INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
+        SELECT o.cliente_id, o.producto_id, {fecha_sql}, o.tipo_venta,
+               ROUND(o.precio_por_kg * (1 + ? / 100.0) + ?, 2)
+        FROM precios o
+        WHERE o.fecha <= ? AND (o.vigente_hasta IS NULL OR o.vigente_hasta > ?)
+          {"AND " + filtro if filtro else ""}{sin_repetir}
+    """, (fecha_destino, float(ajuste_pct), float(ajuste_kg), fecha_origen, fecha_origen)
+         + filtro_params + (() if reemplazar else (fecha_destino,)))
+    copiados = c.rowcount
+
+    # lo que ya estaba en la fecha destino con la misma llave queda reemplazado
+    # (se borra después de insertar porque el precio origen puede ser esa misma fila)
+    reemplazados = 0
+    if reemplazar and copiados:
+        db_execute(c, f"""
+            DELETE FROM precios
+            WHERE fecha = ? AND id <= ? AND EXISTS (
+                SELECT 1 FROM precios n
+                WHERE n.id > ? AND n.fecha = precios.fecha AND n.producto_id = precios.producto_id
+                  AND n.tipo_venta = precios.tipo_venta AND n.cliente_id {IGUAL_O_NULOS} precios.cliente_id
+            )
+        """, (fecha_destino, max_id, max_id))
+        reemplazados = c.rowcount
+
+    # lo copiado que repite el precio del rango anterior no cambia nada: sin la
+    # fila (y sin la reemplazada) sigue valiendo ese precio
+    sin_cambio = 0
+    if copiados:
+        db_execute(c, f"""
+            DELETE FROM precios
+            WHERE id > ? AND precio_por_kg = (
+                SELECT a.precio_por_kg FROM precios a
+                WHERE a.fecha < precios.fecha AND a.producto_id = precios.producto_id
+                  AND a.tipo_venta = precios.tipo_venta AND a.cliente_id {IGUAL_O_NULOS} precios.cliente_id
+                ORDER BY a.fecha DESC, a.id DESC
+                LIMIT 1
+            )
+        """, (max_id,))
+        sin_cambio = c.rowcount
+
+    recalcular_vigencias(c, cliente_ids, incluir_general)
+    return copiados - sin_cambio, reemplazados, sin_cambio
+
+# ---- matriz de precios (clientes x días) ----
+MATRIZ_MAX_DIAS = 92
+
+def matriz_precios(c, desde: date, hasta: date, producto_id: int, tipo_venta: str, cliente_ids=None):
+    """Precios vigentes de cada día en [desde, hasta] en forma columnar:
+    fechas, general (una lista por día) y una fila por cliente con precio propio
+    (None = ese día aplica el general). Una sola consulta trae los rangos de
+    vigencia que tocan el periodo; cada rango se expande por slices, sin un
+    dict por celda."""
+    n = (hasta - desde).days + 1
+    fechas = [(desde + timedelta(days=i)).isoformat() for i in range(n)]
+
+    filtro, params = filtro_clientes_precios(cliente_ids, True)
+    cast = "::text" if IS_POSTGRES else ""
+    # el nombre con subconsulta y no con JOIN: con muchos clientes Postgres
+    # prefería un hash join que recorre toda la tabla para unas cuantas filas
+    db_execute(c, f"""
+        SELECT p.cliente_id, p.fecha{cast} AS fecha, p.vigente_hasta{cast} AS vigente_hasta,
+               p.precio_por_kg, (SELECT cl.nombre FROM clientes cl WHERE cl.id = p.cliente_id) AS nombre
+        FROM precios p
+        WHERE p.producto_id = ? AND p.tipo_venta = ?
+          AND p.fecha <= ? AND (p.vigente_hasta IS NULL OR p.vigente_hasta > ?)
+          {"AND " + filtro if filtro else ""}
+        ORDER BY nombre, p.cliente_id, p.fecha
+    """, (producto_id, tipo_venta, fechas[-1], fechas[0]) + params)
+
+    general = [None] * n
+    ids, nombres, filas = [], [], []
+    for r in iter_filas(c):
+        cid = r["cliente_id"]
+        if cid is None:
+            fila = general
+        else:
+            if not ids or ids[-1] != cid:
+                ids.append(cid)
+                nombres.append(r["nombre"] or f"#{cid}")
+                filas.append([None] * n)
+            fila = filas[-1]
+        i = max(0, (date.fromisoformat(r["fecha"]) - desde).days)
+        j = n if r["vigente_hasta"] is None else min(n, (date.fromisoformat(r["vigente_hasta"]) - desde).days)
+        if i < j:
+            fila[i:j] = [round(float(r["precio_por_kg"]), 2)] * (j - i)
+
+    return {
+        "desde": fechas[0],
+        "hasta": fechas[-1],
+        "producto_id": producto_id,
+        "tipo_venta": tipo_venta,
+        "fechas": fechas,
+        "general": general,
+        "cliente_id": ids,
+        "cliente": nombres,
+        "precios": filas,
+    }
+
+# ---- resumen diario (cierre de caja) ----
+# resumen_diario acumula por (fecha, producto, tipo_venta, metodo_pago) lo vendido
+# y lo devuelto. cobrar_boleta y devolucion_crear lo actualizan en su misma
+# transacción; las devoluciones cuentan el día en que se hacen, con el producto,
+# tipo y método de pago de la venta original.
+SQL_RESUMEN_UPSERT = Consulta("resumen_upsert", """
+    INSERT INTO resumen_diario (fecha, producto_id, tipo_venta, metodo_pago,
+                                num_ventas, kg, pollos, cajas, total,
+                                num_devoluciones, kg_devuelto, monto_devuelto)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (fecha, producto_id, tipo_venta, metodo_pago) DO UPDATE SET
+        num_ventas = resumen_diario.num_ventas + excluded.num_ventas,
+        kg = ROUND(resumen_diario.kg + excluded.kg, 3),
+        pollos = resumen_diario.pollos + excluded.pollos,
+        cajas = resumen_diario.cajas + excluded.cajas,
+        total = ROUND(resumen_diario.total + excluded.total, 2),
+        num_devoluciones = resumen_diario.num_devoluciones + excluded.num_devoluciones,
+        kg_devuelto = ROUND(resumen_diario.kg_devuelto + excluded.kg_devuelto, 3),
+        monto_devuelto = ROUND(resumen_diario.monto_devuelto + excluded.monto_devuelto, 2)
+""")
+
+def params_resumen_venta(fecha_hora, producto_id, tipo_venta, metodo_pago, kg, pollos, cajas, total):
+    return (fecha_hora[:10], producto_id, tipo_venta, metodo_pago,
+            1, round(float(kg), 3), int(pollos), int(cajas), round(float(total), 2), 0, 0, 0)
+
+def params_resumen_devolucion(fecha_hora, producto_id, tipo_venta, metodo_pago, kg_devuelto, monto_devuelto):
+    return (fecha_hora[:10], producto_id, tipo_venta, metodo_pago,
+            0, 0, 0, 0, 0, 1, round(float(kg_devuelto), 3), round(float(monto_devuelto), 2))
+
+def reconstruir_resumen_diario(c, desde: Optional[str] = None, hasta: Optional[str] = None):
+    """Recalcula resumen_diario desde ventas y devoluciones, para [desde, hasta]
+    (fechas YYYY-MM-DD) o todo si no se dan. No hace commit. Regresa filas escritas."""
+    desde = desde or "0001-01-01"
+    hasta_excl = (date.fromisoformat(hasta) + timedelta(days=1)).isoformat() if hasta else "9999-12-31"
+    tipo_fecha = DDL_TIPOS["postgres" if IS_POSTGRES else "sqlite"]["fecha"]
+
+    db_execute(c, "DELETE FROM resumen_diario WHERE fecha >= ? AND fecha < ?", (desde, hasta_excl))
+    db_execute(c, f"""
+        INSERT INTO resumen_diario (fecha, producto_id, tipo_venta, metodo_pago,
+                                    num_ventas, kg, pollos, cajas, total,
+                                    num_devoluciones, kg_devuelto, monto_devuelto)
+        SELECT CAST(dia AS {tipo_fecha}), producto_id, tipo_venta, metodo_pago,
+               SUM(num_ventas), ROUND(SUM(kg), 3), SUM(pollos), SUM(cajas), ROUND(SUM(total), 2),
+               SUM(num_devoluciones), ROUND(SUM(kg_devuelto), 3), ROUND(SUM(monto_devuelto), 2)
+        FROM (
+            SELECT SUBSTR(v.fecha_hora, 1, 10) AS dia, v.producto_id, b.tipo_venta, v.metodo_pago,
+                   1 AS num_ventas, v.peso_neto_kg AS kg, b.num_pollos AS pollos, b.num_cajas AS cajas,
+                   v.total AS total, 0 AS num_devoluciones, 0 AS kg_devuelto, 0 AS monto_devuelto
+            FROM ventas v
+            JOIN boletas_pesaje b ON b.id = v.boleta_id
+            WHERE v.fecha_hora >= ? AND v.fecha_hora < ?
+            UNION ALL
+            SELECT SUBSTR(d.fecha_hora, 1, 10), v.producto_id, b.tipo_venta, v.metodo_pago,
+                   0, 0, 0, 0, 0, 1, d.peso_devuelto_kg, d.monto_devuelto
+            FROM devoluciones d
+            JOIN ventas v ON v.id = d.venta_id
+            JOIN boletas_pesaje b ON b.id = v.boleta_id
+            WHERE d.fecha_hora >= ? AND d.fecha_hora < ?
+        ) x
+        GROUP BY dia, producto_id, tipo_venta, metodo_pago
+    """, (desde, hasta_excl, desde, hasta_excl))
+    return c.rowcount
+
+# ---- saldos de clientes ----
+# saldos_clientes lleva el saldo actual y cada movimiento guarda saldo_despues.
+# Se actualizan en la misma transacción del handler (no se hace commit aquí).
+
+# el upsert bloquea la fila del cliente hasta el commit: dos cobros
+# simultáneos al mismo cliente no se pisan el saldo
+SQL_SALDO_UPSERT = Consulta("saldo_upsert", """
+    INSERT INTO saldos_clientes (cliente_id, saldo, num_movimientos, ultimo_movimiento, ultimo_pago)
+    VALUES (?, ?, 1, ?, ?)
+    ON CONFLICT (cliente_id) DO UPDATE SET
+        saldo = ROUND(saldos_clientes.saldo + excluded.saldo, 2),
+        num_movimientos = saldos_clientes.num_movimientos + 1,
+        ultimo_movimiento = excluded.ultimo_movimiento,
+        ultimo_pago = COALESCE(excluded.ultimo_pago, saldos_clientes.ultimo_pago)
+""")
+SQL_SALDO_ACTUAL = Consulta("saldo_actual", "SELECT saldo FROM saldos_clientes WHERE cliente_id = ?")
+SQL_MOVIMIENTO_INSERT = Consulta("movimiento_insert", """
+    INSERT INTO movimientos_cliente (fecha_hora, cliente_id, tipo, referencia_id, monto, saldo_despues)
+    VALUES (?, ?, ?, ?, ?, ?)
+""")
+
+def _params_saldo(fecha_hora, cliente_id, tipo, monto):
+    monto = round(float(monto), 2)
+    # abono = lo que baja el saldo sin ser devolución
+    ultimo_pago = fecha_hora if (monto < 0 and tipo != "devolucion") else None
+    return monto, (cliente_id, monto, fecha_hora, ultimo_pago)
+
+def registrar_movimiento(c, fecha_hora, cliente_id, tipo, referencia_id, monto):
+    monto, params = _params_saldo(fecha_hora, cliente_id, tipo, monto)
+    db_execute(c, SQL_SALDO_UPSERT, params)
+    db_execute(c, SQL_SALDO_ACTUAL, (cliente_id,))
+    saldo = round(float(c.fetchone()["saldo"]), 2)
+    return insert_and_get_id(c, SQL_MOVIMIENTO_INSERT, (fecha_hora, cliente_id, tipo, referencia_id, monto, saldo))
+
+async def registrar_movimiento_async(db, fecha_hora, cliente_id, tipo, referencia_id, monto):
+    monto, params = _params_saldo(fecha_hora, cliente_id, tipo, monto)
+    await db.execute(SQL_SALDO_UPSERT, params)
+    row = await db.fetchone(SQL_SALDO_ACTUAL, (cliente_id,))
+    saldo = round(float(row["saldo"]), 2)
+    return await db.insert_and_get_id(SQL_MOVIMIENTO_INSERT, (fecha_hora, cliente_id, tipo, referencia_id, monto, saldo))
+
+# Antigüedad: los abonos pagan primero lo más viejo, así que el saldo pendiente
+# se reparte entre los cargos más recientes. Solo hay que sumar cargos de los
+# últimos 60 días; lo que sobra del saldo es "más de 60".
+CARTERA_TRAMOS = [(0, 7), (8, 30), (31, 60)]
+
+def antiguedad_saldo(saldo: float, cargos_por_tramo: list) -> list:
+    restante = max(0.0, float(saldo))
+    tramos = []
+    for cargos in cargos_por_tramo:
+        parte = min(restante, max(0.0, float(cargos)))
+        tramos.append(round(parte, 2))
+        restante -= parte
+    tramos.append(round(restante, 2))
+    return tramos
+
+def saldo_actual(c, cliente_id) -> float:
+    db_execute(c, SQL_SALDO_ACTUAL, (cliente_id,))
+    row = c.fetchone()
+    return round(float(row["saldo"]), 2) if row else 0.0
+
+# ---- búsqueda de clientes ----
+# SQLite: FTS5 con remove_diacritics; Postgres: pg_trgm sobre f_unaccent(lower(...)).
+# En los dos casos "jose" encuentra "José" y los resultados salen por relevancia.
+
+def normalizar_texto(txt: str) -> str:
+    txt = unicodedata.normalize("NFKD", txt or "")
+    txt = "".join(ch for ch in txt if not unicodedata.combining(ch))
+    return " ".join(txt.lower().split())
+
+def buscar_clientes(c, q: str, limite: int = 50):
+    q_norm = normalizar_texto(q)
+    if not q_norm:
+        return []
+
+    if IS_POSTGRES:
         db_execute(c, """
-            SELECT precio_por_kg FROM precios
-            WHERE cliente_id = ? AND producto_id = ? AND fecha = ? AND tipo_venta = ?
-            ORDER BY id DESC LIMIT 1
-        """, (cliente_id, producto_id, fecha_txt, tipo_venta))
+            SELECT id, nombre, referencia
+            FROM clientes
+            WHERE f_unaccent(lower(nombre || ' ' || coalesce(referencia, ''))) LIKE ?
+               OR ? <% f_unaccent(lower(nombre || ' ' || coalesce(referencia, '')))
+            ORDER BY word_similarity(?, f_unaccent(lower(nombre || ' ' || coalesce(referencia, '')))) DESC, id
+            LIMIT ?
+        """, (f"%{q_norm}%", q_norm, q_norm, limite))
+        return c.fetchall()
+
+    # cada palabra como prefijo: "jose pe" -> "jose"* "pe"*
+    match = " ".join('"' + tok.replace('"', '""') + '"*' for tok in q_norm.split())
+    db_execute(c, """
+        SELECT cl.id, cl.nombre, cl.referencia
+        FROM clientes_fts
+        JOIN clientes cl ON cl.id = clientes_fts.rowid
+        WHERE clientes_fts MATCH ?
+        ORDER BY clientes_fts.rank, cl.id
+        LIMIT ?
+    """, (match, limite))
+    return c.fetchall()
+
+# ---- índice de prefijos para el autocompletado ----
+# Lista ordenada de (palabra_normalizada, cliente_id): un prefijo es un rango
+# contiguo que se encuentra con bisect. Se carga completo la primera vez (y cada
+# PREFIJOS_TTL segundos, por si otro worker dio de alta clientes) y después
+# clientes_crear / clientes_eliminar lo actualizan de a uno.
+
+PREFIJOS_TTL = float(os.getenv("PREFIJOS_TTL", "300"))
+
+class IndicePrefijos:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.palabras: list = []     # [(palabra, cliente_id)] ordenada
+        self.nombres: dict = {}      # cliente_id -> (nombre, referencia, nombre_normalizado)
+        self.expira = 0.0
+
+    @staticmethod
+    def _palabras(nombre, referencia):
+        return set(normalizar_texto(f"{nombre} {referencia or ''}").split())
+
+    def cargar(self, conn=None):
+        clientes = get_clientes(conn)
+        palabras, nombres = [], {}
+        for cl in clientes:
+            nombres[cl["id"]] = (cl["nombre"], cl["referencia"] or "", normalizar_texto(cl["nombre"]))
+            palabras.extend((w, cl["id"]) for w in self._palabras(cl["nombre"], cl["referencia"]))
+        palabras.sort()
+        with self.lock:
+            self.palabras, self.nombres = palabras, nombres
+            self.expira = time.monotonic() + PREFIJOS_TTL
+
+    def agregar(self, cliente_id, nombre, referencia=""):
+        with self.lock:
+            if not self.expira:
+                return  # todavía no se carga; se cargará completo al primer uso
+            self.nombres[cliente_id] = (nombre, referencia or "", normalizar_texto(nombre))
+            for w in self._palabras(nombre, referencia):
+                bisect.insort(self.palabras, (w, cliente_id))
+
+    def quitar(self, cliente_id):
+        with self.lock:
+            datos = self.nombres.pop(cliente_id, None)
+            if datos is None:
+                return
+            for w in self._palabras(datos[0], datos[1]):
+                i = bisect.bisect_left(self.palabras, (w, cliente_id))
+                if i < len(self.palabras) and self.palabras[i] == (w, cliente_id):
+                    del self.palabras[i]
+
+    def _ids_con_prefijo(self, prefijo):
+        i = bisect.bisect_left(self.palabras, (prefijo,))
+        ids = set()
+        while i < len(self.palabras) and self.palabras[i][0].startswith(prefijo):
+            ids.add(self.palabras[i][1])
+            i += 1
+        return ids
+
+    def sugerir(self, q: str, limite: int = 10, conn=None):
+        if self.expira < time.monotonic():
+            self.cargar(conn)
+        tokens = normalizar_texto(q).split()
+        if not tokens:
+            return []
+        with self.lock:
+            # la palabra más larga primero: su rango suele ser el más chico
+            tokens.sort(key=len, reverse=True)
+            ids = self._ids_con_prefijo(tokens[0])
+            for tok in tokens[1:]:
+                if not ids:
+                    break
+                ids &= self._ids_con_prefijo(tok)
+            candidatos = [(cid, self.nombres[cid]) for cid in ids]
+
+        # primero los que empiezan con lo tecleado, luego alfabético
+        inicio = normalizar_texto(q)
+        mejores = heapq.nsmallest(limite, candidatos, key=lambda x: (
+            not x[1][2].startswith(inicio), x[1][2], x[0],
+        ))
+        return [
+            {"id": cid, "nombre": nombre, "referencia": ref}
+            for cid, (nombre, ref, _) in mejores
+        ]
+
+indice_clientes = IndicePrefijos()
+
+def cliente_autocomplete_html(opcion_cero: Optional[str] = None) -> str:
+    """Input con sugerencias (de /api/clientes/sugerir) que llena un hidden
+    cliente_id. Si opcion_cero viene, vacío = 0 (OTRO / contado)."""
+    valor = "0" if opcion_cero else ""
+    placeholder = f"Escribe para buscar… (vacío = {opcion_cero})" if opcion_cero else "Escribe para buscar…"
+    return f"""
+    <input type="hidden" name="cliente_id" id="cliente_id" value="{valor}" />
+    <input type="text" id="cliente_buscar" list="cliente_sugerencias" autocomplete="off"
+           placeholder="{placeholder}" />
+    <datalist id="cliente_sugerencias"></datalist>
+    <script>
+    (function() {{
+        var input = document.getElementById("cliente_buscar");
+        var hidden = document.getElementById("cliente_id");
+        var lista = document.getElementById("cliente_sugerencias");
+        var vacio = "{valor}";
+        var timer = null;
+        input.addEventListener("input", function() {{
+            var m = input.value.match(/#(\\d+)\\)$/);
+            // texto sin elegir de la lista: hidden vacío para que el submit lo frene
+            hidden.value = m ? m[1] : (input.value.trim() ? "" : vacio);
+            if (m) return;
+            clearTimeout(timer);
+            timer = setTimeout(function() {{
+                var q = input.value.trim();
+                if (!q) {{ lista.innerHTML = ""; return; }}
+                fetch("/api/clientes/sugerir?q=" + encodeURIComponent(q), {{credentials: "same-origin"}})
+                    .then(function(r) {{ return r.json(); }})
+                    .then(function(items) {{
+                        lista.innerHTML = "";
+                        items.forEach(function(it) {{
+                            var opt = document.createElement("option");
+                            opt.value = it.nombre + " (#" + it.id + ")";
+                            if (it.referencia) opt.label = it.referencia;
+                            lista.appendChild(opt);
+                        }});
+                    }});
+            }}, 150);
+        }});
+        input.form.addEventListener("submit", function(ev) {{
+            if (!hidden.value) {{
+                ev.preventDefault();
+                alert("Selecciona un cliente de la lista.");
+            }}
+        }});
+    }})();
+    </script>
+    """
+
+# ---- paginación por cursor (keyset) ----
+# El cursor es la llave de orden de la última/primera fila de la página,
+# así que cualquier página cuesta lo mismo (nada de OFFSET).
+
+def cursor_encode(*valores) -> str:
+    raw = json.dumps(list(valores), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def cursor_decode(txt: str):
+    if not txt:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(txt + "=" * (-len(txt) % 4))
+        valores = json.loads(raw)
+        return valores if isinstance(valores, list) else None
+    except (ValueError, TypeError):
+        return None
+
+def pagina_keyset(rows, per_page: int, hacia_atras: bool):
+    """rows viene con per_page+1 filas como máximo. Regresa (filas, hay_mas),
+    ya en orden de pantalla aunque se haya consultado hacia atrás."""
+    rows = list(rows)
+    hay_mas = len(rows) > per_page
+    rows = rows[:per_page]
+    if hacia_atras:
+        rows.reverse()
+    return rows, hay_mas
+
+# ---- totales cacheados ----
+# El COUNT(*) exacto se calcula a lo mucho una vez cada CONTEO_TTL segundos
+# por (tabla, filtro). Sin filtro en Postgres se usa la estadística del planner.
+
+CONTEO_TTL = float(os.getenv("CONTEO_TTL", "60"))
+_conteos_cache: dict = {}
+_conteos_lock = threading.Lock()
+
+def contar_filas(c, tabla: str, where: str = "", params=()):
+    key = (tabla, where, tuple(params))
+    with _conteos_lock:
+        hit = _conteos_cache.get(key)
+        if hit and hit[1] > time.monotonic():
+            return hit[0], hit[2]
+
+    total, exacto = None, True
+    if IS_POSTGRES and not where:
+        db_execute(c, "SELECT reltuples::bigint AS c FROM pg_class WHERE relname = ?", (tabla,))
         row = c.fetchone()
-        if row:
-            close_conn(conn)
-            return float(row["precio_por_kg"])
+        if row and int(row["c"]) > 0:
+            total, exacto = int(row["c"]), False
+    if total is None:
+        db_execute(c, f"SELECT COUNT(*) AS c FROM {tabla}" + (f" WHERE {where}" if where else ""), params)
+        total = int(c.fetchone()["c"])
 
-    db_execute(c, """
-        SELECT precio_por_kg FROM precios
-        WHERE cliente_id IS NULL AND producto_id = ? AND fecha = ? AND tipo_venta = ?
-        ORDER BY id DESC LIMIT 1
-    """, (producto_id, fecha_txt, tipo_venta))
-    row = c.fetchone()
-    close_conn(conn)
-    if row:
-        return float(row["precio_por_kg"])
-    return None
+    with _conteos_lock:
+        _conteos_cache[key] = (total, time.monotonic() + CONTEO_TTL, exacto)
+    return total, exacto
+
+def invalidar_conteos(tabla: str):
+    with _conteos_lock:
+        for key in [k for k in _conteos_cache if k[0] == tabla]:
+            _conteos_cache.pop(key, None)
 
 # ---------------- HOME ----------------
 
@@ -593,20 +2472,35 @@ def home(request: Request):
     """
     return layout(request, "Inicio", body)
 
+# ---------------- MÉTRICAS (Prometheus) ----------------
+
+@app.get("/metrics")
+def metrics(request: Request):
+    if METRICS_TOKEN:
+        auth = request.headers.get("authorization", "")
+        if auth != f"Bearer {METRICS_TOKEN}" and request.query_params.get("token") != METRICS_TOKEN:
+            return PlainTextResponse("no autorizado", status_code=401)
+    return PlainTextResponse(metricas_texto(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # ---------------- CLIENTES (Caja) ----------------
 # MEJORAS:
 # 1) Paginación
 # 2) Precarga de precios (1 query) para evitar N+1 queries por cliente
 
 @app.get("/clientes", response_class=HTMLResponse)
-def clientes_list(request: Request, q: str = "", page: int = 1):
+def clientes_list(
+    request: Request,
+    q: str = "",
+    despues: str = "",
+    antes: str = "",
+    conn=Depends(get_db),
+):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
     PER_PAGE = 25
-    page = max(1, int(page))
-    offset = (page - 1) * PER_PAGE
+    BUSQUEDA_MAX = 100
 
     hoy = date.today()
     ayer = hoy - timedelta(days=1)
@@ -614,209 +2508,197 @@ def clientes_list(request: Request, q: str = "", page: int = 1):
     hoy_txt = hoy.isoformat()
     ayer_txt = ayer.isoformat()
     antier_txt = antier.isoformat()
-    fechas = [antier_txt, ayer_txt, hoy_txt]
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    q = (q or "").strip()
 
-    # producto base (POLLO_ENTERO) para mostrar columnas antier/ayer/hoy
-    db_execute(c, "SELECT id FROM productos WHERE codigo = 'POLLO_ENTERO'")
-    row_prod = c.fetchone()
-    producto_base_id = row_prod["id"] if row_prod else None
+    def contenido():
+        # encabezado y formularios salen antes de tocar la base
+        yield f"""
+        <h2>Clientes</h2>
+        <div class="card">
+            <form action="/clientes/crear" method="post">
+                <label>Nombre cliente</label>
+                <input type="text" name="nombre" required />
+                <label>Referencia (opcional)</label>
+                <input type="text" name="referencia" />
+                <button class="btn btn-primary" type="submit">Crear cliente</button>
+            </form>
+        </div>
 
-    q = (q or "").strip()
+        <div class="card">
+            <h3>Lista de clientes</h3>
+            <p><small>Precios mostrados: POLLO_ENTERO, tipo NORMAL. Columnas: antier, ayer y hoy.</small></p>
 
-    # total para paginación
-    if q:
-        if q.isdigit():
-            db_execute(c, "SELECT COUNT(*) AS c FROM clientes WHERE id = ?", (int(q),))
-        else:
-            like = f"%{q}%"
-            db_execute(c, "SELECT COUNT(*) AS c FROM clientes WHERE nombre LIKE ? OR referencia LIKE ?", (like, like))
-    else:
-        db_execute(c, "SELECT COUNT(*) AS c FROM clientes")
+            <form method="get" action="/clientes" style="margin-bottom:10px; display:flex; gap:8px; align-items:center;">
+                <input name="q" value="{q}" placeholder="Buscar por id, nombre o referencia (sin acentos también)" style="flex:1;"/>
+                <button class="btn btn-primary" type="submit">Buscar</button>
+                <a class="btn btn-secondary" href="/clientes">Limpiar</a>
+            </form>
 
-    total = int(c.fetchone()["c"])
-    total_pages = max(1, (total + PER_PAGE - 1) // PER_PAGE)
+            <table>
+                <thead>
+                    <tr>
+                        <th>ID</th>
+                        <th>Nombre</th>
+                        <th>Referencia</th>
+                        <th>Precio antier ({antier_txt})</th>
+                        <th>Precio ayer ({ayer_txt})</th>
+                        <th>Precio hoy ({hoy_txt})</th>
+                        <th>Acciones</th>
+                    </tr>
+                </thead>
+                <tbody>
+        """
 
-    # página actual
-    if q:
-        if q.isdigit():
-            db_execute(
-                c,
-                "SELECT id, nombre, referencia FROM clientes WHERE id = ? ORDER BY id LIMIT ? OFFSET ?",
-                (int(q), PER_PAGE, offset),
-            )
+        c = db_cursor(conn)
+
+        # producto base (POLLO_ENTERO) para mostrar columnas antier/ayer/hoy
+        db_execute(c, "SELECT id FROM productos WHERE codigo = 'POLLO_ENTERO'")
+        row_prod = c.fetchone()
+        producto_base_id = row_prod["id"] if row_prod else None
+
+        busqueda_texto = bool(q) and not q.isdigit()
+
+        if busqueda_texto:
+            # búsqueda indexada: los más relevantes primero, sin paginar
+            clientes = buscar_clientes(c, q, BUSQUEDA_MAX)
+            total, total_exacto = len(clientes), len(clientes) < BUSQUEDA_MAX
+            hay_siguiente = hay_anterior = False
         else:
-            like = f"%{q}%"
+            if q:
+                where, params = "id = ?", (int(q),)
+            else:
+                where, params = "", ()
+
+            # total (cacheado / estimado), no en cada página
+            total, total_exacto = contar_filas(c, "clientes", where, params)
+
+            # página actual por cursor sobre id
+            cur_despues = cursor_decode(despues)
+            cur_antes = cursor_decode(antes)
+            hacia_atras = cur_antes is not None and cur_despues is None
+            conds = [where] if where else []
+            page_params = list(params)
+            if cur_despues is not None:
+                conds.append("id > ?")
+                page_params.append(int(cur_despues[0]))
+            elif hacia_atras:
+                conds.append("id < ?")
+                page_params.append(int(cur_antes[0]))
+            page_params.append(PER_PAGE + 1)
+
             db_execute(
                 c,
-                "SELECT id, nombre, referencia FROM clientes WHERE nombre LIKE ? OR referencia LIKE ? ORDER BY id LIMIT ? OFFSET ?",
-                (like, like, PER_PAGE, offset),
+                "SELECT id, nombre, referencia FROM clientes"
+                + (" WHERE " + " AND ".join(conds) if conds else "")
+                + (" ORDER BY id DESC" if hacia_atras else " ORDER BY id")
+                + " LIMIT ?",
+                tuple(page_params),
             )
-    else:
-        db_execute(c, "SELECT id, nombre, referencia FROM clientes ORDER BY id LIMIT ? OFFSET ?", (PER_PAGE, offset))
-
-    clientes = c.fetchall()
 
-    # ---- precargar precios (1 query) ----
-    precios_map = {}        # (cliente_id, fecha) -> precio
-    precios_general = {}    # fecha -> precio
+            clientes, hay_mas = pagina_keyset(c.fetchall(), PER_PAGE, hacia_atras)
+            hay_siguiente = hay_mas if not hacia_atras else True
+            hay_anterior = (cur_despues is not None) if not hacia_atras else hay_mas
 
-    if producto_base_id is not None and clientes:
-        ids = [cl["id"] for cl in clientes]
+        # ---- precargar precios (1 query) ----
+        # columnas antier/ayer/hoy de la matriz; None = aplica el general
+        sin_precio = [None, None, None]
+        precios_general = sin_precio
+        precios_cliente = {}
 
-        if IS_POSTGRES:
-            # Cast explícito para ANY en postgres
-            db_execute(c, """
-                SELECT cliente_id, fecha::text AS fecha, precio_por_kg
-                FROM precios
-                WHERE producto_id = ?
-                  AND tipo_venta = 'normal'
-                  AND fecha = ANY(?::date[])
-                  AND (cliente_id = ANY(?::int[]) OR cliente_id IS NULL)
-                ORDER BY id DESC
-            """, (producto_base_id, fechas, ids))
-        else:
-            ph_f = ",".join(["?"] * len(fechas))
-            ph_i = ",".join(["?"] * len(ids))
-            db_execute(c, f"""
-                SELECT cliente_id, fecha, precio_por_kg
-                FROM precios
-                WHERE producto_id = ?
-                  AND tipo_venta = 'normal'
-                  AND fecha IN ({ph_f})
-                  AND (cliente_id IN ({ph_i}) OR cliente_id IS NULL)
-                ORDER BY id DESC
-            """, tuple([producto_base_id] + fechas + ids))
-
-        rows = c.fetchall()
-
-        # setdefault para quedarnos con el más reciente (ORDER BY id DESC)
-        for r in rows:
-            f = str(r["fecha"])
-            cid = r["cliente_id"]
-            p = float(r["precio_por_kg"])
-            if cid is None:
-                precios_general.setdefault(f, p)
-            else:
-                precios_map.setdefault((cid, f), p)
+        if producto_base_id is not None and clientes:
+            ids = [cl["id"] for cl in clientes]
+            matriz = matriz_precios(c, antier, hoy, producto_base_id, "normal", ids)
+            precios_general = matriz["general"]
+            precios_cliente = dict(zip(matriz["cliente_id"], matriz["precios"]))
 
-    close_conn(conn)
+        for cl in clientes:
+            ref = cl["referencia"] or ""
 
-    rows_html = ""
-    for cl in clientes:
-        ref = cl["referencia"] or ""
+            precio_antier, precio_ayer, precio_hoy = (
+                p if p is not None else g
+                for p, g in zip(precios_cliente.get(cl["id"], sin_precio), precios_general)
+            )
 
-        if producto_base_id is not None:
-            precio_antier = precios_map.get((cl["id"], antier_txt), precios_general.get(antier_txt))
-            precio_ayer   = precios_map.get((cl["id"], ayer_txt),   precios_general.get(ayer_txt))
-            precio_hoy    = precios_map.get((cl["id"], hoy_txt),    precios_general.get(hoy_txt))
-        else:
-            precio_hoy = precio_ayer = precio_antier = None
-
-        texto_antier = f"${precio_antier:.2f}" if precio_antier is not None else "-"
-        texto_ayer = f"${precio_ayer:.2f}" if precio_ayer is not None else "-"
-        texto_hoy = f"${precio_hoy:.2f}" if precio_hoy is not None else "-"
-
-        rows_html += (
-            f"<tr>"
-            f"<td>{cl['id']}</td>"
-            f"<td>{cl['nombre']}</td>"
-            f"<td>{ref}</td>"
-            f"<td>{texto_antier}</td>"
-            f"<td>{texto_ayer}</td>"
-            f"<td>{texto_hoy}</td>"
-            f"<td class='actions'>"
-            f"  <a class='btn btn-secondary' href='/clientes/ajuste/{cl['id']}'>Agregar saldo</a>"
-            f"  <form method='post' action='/clientes/eliminar/{cl['id']}' style='display:inline;'>"
-            f"    <button class='btn btn-danger' type='submit' "
-            f"      onclick=\"return confirm('¿Seguro que quieres borrar este cliente?')\">"
-            f"      Borrar"
-            f"    </button>"
-            f"  </form>"
-            f"</td>"
-            f"</tr>"
-        )
+            texto_antier = f"${precio_antier:.2f}" if precio_antier is not None else "-"
+            texto_ayer = f"${precio_ayer:.2f}" if precio_ayer is not None else "-"
+            texto_hoy = f"${precio_hoy:.2f}" if precio_hoy is not None else "-"
+
+            yield (
+                f"<tr>"
+                f"<td>{cl['id']}</td>"
+                f"<td>{cl['nombre']}</td>"
+                f"<td>{ref}</td>"
+                f"<td>{texto_antier}</td>"
+                f"<td>{texto_ayer}</td>"
+                f"<td>{texto_hoy}</td>"
+                f"<td class='actions'>"
+                f"  <a class='btn btn-secondary' href='/clientes/ajuste/{cl['id']}'>Agregar saldo</a>"
+                f"  <form method='post' action='/clientes/eliminar/{cl['id']}' style='display:inline;'>"
+                f"    <button class='btn btn-danger' type='submit' "
+                f"      onclick=\"return confirm('¿Seguro que quieres borrar este cliente?')\">"
+                f"      Borrar"
+                f"    </button>"
+                f"  </form>"
+                f"</td>"
+                f"</tr>"
+            )
 
-    nav_pages = f"""
-    <div class="card" style="display:flex; gap:10px; align-items:center; justify-content:space-between;">
-      <div>
-        <a class="btn btn-secondary" href="/clientes?q={q}&page={max(1, page-1)}">← Anterior</a>
-        <a class="btn btn-secondary" href="/clientes?q={q}&page={min(total_pages, page+1)}">Siguiente →</a>
-      </div>
-      <div style="color:#374151;">
-        Página <b>{page}</b> de <b>{total_pages}</b> — Total: <b>{total}</b>
-      </div>
-    </div>
-    """
+        if not clientes:
+            yield "<tr><td colspan='7'>No hay clientes</td></tr>"
 
-    body = f"""
-    <h2>Clientes</h2>
-    <div class="card">
-        <form action="/clientes/crear" method="post">
-            <label>Nombre cliente</label>
-            <input type="text" name="nombre" required />
-            <label>Referencia (opcional)</label>
-            <input type="text" name="referencia" />
-            <button class="btn btn-primary" type="submit">Crear cliente</button>
-        </form>
-    </div>
+        link_anterior = (
+            f"<a class='btn btn-secondary' href='/clientes?{urlencode({'q': q, 'antes': cursor_encode(clientes[0]['id'])})}'>← Anterior</a>"
+            if clientes and hay_anterior else ""
+        )
+        link_siguiente = (
+            f"<a class='btn btn-secondary' href='/clientes?{urlencode({'q': q, 'despues': cursor_encode(clientes[-1]['id'])})}'>Siguiente →</a>"
+            if clientes and hay_siguiente else ""
+        )
+        if busqueda_texto:
+            texto_total = f"{total}" if total_exacto else f"{total}+ (los {BUSQUEDA_MAX} más parecidos)"
+        else:
+            texto_total = f"{total}" if total_exacto else f"≈ {total}"
 
-    <div class="card">
-        <h3>Lista de clientes</h3>
-        <p><small>Precios mostrados: POLLO_ENTERO, tipo NORMAL. Columnas: antier, ayer y hoy.</small></p>
-
-        <form method="get" action="/clientes" style="margin-bottom:10px; display:flex; gap:8px; align-items:center;">
-            <input name="q" value="{q}" placeholder="Buscar por id, nombre o referencia" style="flex:1;"/>
-            <input type="hidden" name="page" value="1" />
-            <button class="btn btn-primary" type="submit">Buscar</button>
-            <a class="btn btn-secondary" href="/clientes">Limpiar</a>
-        </form>
+        yield f"""
+                </tbody>
+            </table>
+        </div>
 
-        <table>
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Nombre</th>
-                    <th>Referencia</th>
-                    <th>Precio antier ({antier_txt})</th>
-                    <th>Precio ayer ({ayer_txt})</th>
-                    <th>Precio hoy ({hoy_txt})</th>
-                    <th>Acciones</th>
-                </tr>
-            </thead>
-            <tbody>
-                {rows_html or "<tr><td colspan='7'>No hay clientes</td></tr>"}
-            </tbody>
-        </table>
-    </div>
+        <div class="card" style="display:flex; gap:10px; align-items:center; justify-content:space-between;">
+          <div>
+            <a class="btn btn-secondary" href="/clientes?{urlencode({'q': q})}">« Inicio</a>
+            {link_anterior}
+            {link_siguiente}
+          </div>
+          <div style="color:#374151;">
+            Total: <b>{texto_total}</b>
+          </div>
+        </div>
+        """
 
-    {nav_pages}
-    """
-    return layout(request, "Clientes", body)
+    return layout_stream(request, "Clientes", contenido())
 
 @app.post("/clientes/crear")
-def clientes_crear(request: Request, nombre: str = Form(...), referencia: str = Form("")):
+def clientes_crear(request: Request, nombre: str = Form(...), referencia: str = Form(""), conn=Depends(get_db_escritura)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    insert_and_get_id(c, "INSERT INTO clientes (nombre, referencia) VALUES (?, ?)", (nombre, referencia))
+    c = db_cursor(conn)
+    cliente_id = insert_and_get_id(c, "INSERT INTO clientes (nombre, referencia) VALUES (?, ?)", (nombre, referencia))
     conn.commit()
-    close_conn(conn)
+    invalidar_conteos("clientes")
+    indice_clientes.agregar(cliente_id, nombre, referencia)
     return RedirectResponse(url="/clientes", status_code=303)
 
 @app.post("/clientes/eliminar/{cliente_id}")
-def clientes_eliminar(request: Request, cliente_id: int):
+def clientes_eliminar(request: Request, cliente_id: int, conn=Depends(get_db_escritura)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    c = db_cursor(conn)
 
     checks = [
         ("precios", "SELECT COUNT(*) AS c FROM precios WHERE cliente_id = ?", (cliente_id,)),
@@ -831,7 +2713,6 @@ def clientes_eliminar(request: Request, cliente_id: int):
         row = c.fetchone()
         cnt = row["c"] if row is not None else 0
         if int(cnt) > 0:
-            close_conn(conn)
             return error_card(
                 request,
                 f"No puedo borrar el cliente porque tiene {cnt} registro(s) en '{tabla}'. "
@@ -840,20 +2721,19 @@ def clientes_eliminar(request: Request, cliente_id: int):
 
     db_execute(c, "DELETE FROM clientes WHERE id = ?", (cliente_id,))
     conn.commit()
-    close_conn(conn)
+    invalidar_conteos("clientes")
+    indice_clientes.quitar(cliente_id)
     return RedirectResponse(url="/clientes", status_code=303)
 
 @app.get("/clientes/ajuste/{cliente_id}", response_class=HTMLResponse)
-def cliente_ajuste_form(request: Request, cliente_id: int):
+def cliente_ajuste_form(request: Request, cliente_id: int, conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    c = db_cursor(conn)
     db_execute(c, "SELECT id, nombre FROM clientes WHERE id = ?", (cliente_id,))
     cl = c.fetchone()
-    close_conn(conn)
 
     if not cl:
         return error_card(request, "Cliente no encontrado.")
@@ -882,6 +2762,7 @@ def cliente_ajuste_save(
     cliente_id: int,
     monto: float = Form(...),
     referencia_id: int = Form(0),
+    conn=Depends(get_db_escritura),
 ):
     guard = ensure_role(request, ["Caja"])
     if guard:
@@ -889,38 +2770,37 @@ def cliente_ajuste_save(
 
     fecha_hora = datetime.now().isoformat(timespec="seconds")
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    c = db_cursor(conn)
 
     db_execute(c, "SELECT id FROM clientes WHERE id = ?", (cliente_id,))
     if not c.fetchone():
-        close_conn(conn)
         return error_card(request, "Cliente no encontrado.")
 
-    insert_and_get_id(c, """
-        INSERT INTO movimientos_cliente (fecha_hora, cliente_id, tipo, referencia_id, monto)
-        VALUES (?, ?, 'ajuste', ?, ?)
-    """, (fecha_hora, cliente_id, int(referencia_id), float(monto)))
+    registrar_movimiento(c, fecha_hora, cliente_id, "ajuste", int(referencia_id), monto)
 
     conn.commit()
-    close_conn(conn)
     return RedirectResponse(url="/clientes", status_code=303)
 
+@app.get("/api/clientes/sugerir")
+def clientes_sugerir(request: Request, q: str = "", limite: int = 10):
+    role = request.session.get("role")
+    if role not in ("Caja", "Bascula"):
+        return JSONResponse({"error": "no autorizado"}, status_code=401)
+
+    limite = max(1, min(int(limite), 50))
+    return JSONResponse(indice_clientes.sugerir(q, limite))
+
 # ---------------- PRECIOS (Caja) ----------------
 
 @app.get("/precios", response_class=HTMLResponse)
-def precios_form(request: Request):
+def precios_form(request: Request, conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    productos = get_productos()
-    clientes = get_clientes()
+    productos = get_productos(conn)
     hoy = date.today().isoformat()
-
-    opciones_clientes = "<option value='0'>OTRO / contado (general)</option>"
-    for cl in clientes:
-        opciones_clientes += f"<option value='{cl['id']}'>{cl['nombre']}</option>"
+    ayer = (date.today() - timedelta(days=1)).isoformat()
 
     filas = ""
     for p in productos:
@@ -941,7 +2821,7 @@ def precios_form(request: Request):
             <input type="date" name="fecha" value="{hoy}" required />
 
             <label>Cliente</label>
-            <select name="cliente_id">{opciones_clientes}</select>
+            {cliente_autocomplete_html("OTRO / contado (general)")}
 
             <p><strong>Captura precios por kg:</strong></p>
             <table>
@@ -958,81 +2838,343 @@ def precios_form(request: Request):
 
             <p><button class="btn btn-primary" type="submit">Guardar precios</button></p>
         </form>
+        <p><a href="/precios/importar">Importar lista de precios (CSV / Excel)</a> ·
+           <a href="/precios/matriz">Matriz de precios por día</a></p>
+    </div>
+
+    <div class="card">
+        <form action="/precios/copiar" method="post" style="display:flex; gap:8px; align-items:center;">
+            <input type="hidden" name="fecha_origen" value="{ayer}" />
+            <input type="hidden" name="fecha_destino" value="{hoy}" />
+            <button class="btn btn-secondary" type="submit">Copiar precios de ayer a hoy (todos los clientes)</button>
+            <a href="/precios/copiar">Más opciones</a>
+        </form>
     </div>
     """
     return layout(request, "Precios", body)
 
-@app.post("/precios")
-async def precios_save(request: Request):
+@app.post("/precios")
+async def precios_save(request: Request):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    # el formulario se lee antes de tomar el escritor: un cliente lento no
+    # debe tenerlo ocupado (con BEGIN IMMEDIATE en SQLite) mientras sube el body
+    form = await request.form()
+    fecha = form.get("fecha")
+    cliente_id_raw = form.get("cliente_id", "0")
+    cliente_id = None if cliente_id_raw == "0" else int(cliente_id_raw)
+
+    async with adb_conn(escritura=True) as db:
+        productos = await db.fetchall(SQL_PRODUCTOS)
+        filas = []
+        for p in productos:
+            tipos = TIPOS_VENTA if p["codigo"] in PRODUCTOS_CON_TIPOS else ("normal",)
+            for tipo_venta in tipos:
+                valor = form.get(f"precio_{tipo_venta}_{p['id']}")
+                if valor:
+                    try:
+                        filas.append((cliente_id, p["id"], fecha, tipo_venta, float(valor)))
+                    except ValueError:
+                        pass
+
+        # todos los precios del formulario en un solo executemany
+        if filas:
+            await db.executemany("""
+                INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
+                VALUES (?, ?, ?, ?, ?)
+            """, filas)
+            filtro, params = filtro_clientes_precios([cliente_id] if cliente_id else [], cliente_id is None)
+            await db.execute(sql_vigencias(filtro), params)
+
+        await db.commit()
+    invalidar_precios_cache(fecha)
+    return RedirectResponse(url="/precios", status_code=303)
+
+@app.get("/precios/importar", response_class=HTMLResponse)
+def precios_importar_form(request: Request):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    hoy = date.today().isoformat()
+    body = f"""
+    <h2>Importar lista de precios</h2>
+    <div class="card">
+        <form action="/precios/importar" method="post" enctype="multipart/form-data">
+            <label>Archivo (.csv o .xlsx)</label>
+            <input type="file" name="archivo" accept=".csv,.xlsx" required />
+
+            <label>Fecha (para filas sin fecha)</label>
+            <input type="date" name="fecha" value="{hoy}" />
+
+            <p><button class="btn btn-primary" type="submit">Importar</button></p>
+        </form>
+        <p><small>
+            Una fila por precio con encabezados <b>fecha, cliente, producto, tipo_venta, precio</b>.
+            cliente: id, referencia o nombre (vacío u OTRO = precio general).
+            producto: código (POLLO_ENTERO) o nombre. tipo_venta: normal, mayoreo o menudeo.
+            Un precio con el mismo cliente, producto, fecha y tipo reemplaza al que ya estaba.
+            Si alguna fila tiene error no se carga nada.
+        </small></p>
+    </div>
+    """
+    return layout(request, "Importar precios", body)
+
+@app.post("/precios/importar", response_class=HTMLResponse)
+def precios_importar(
+    request: Request,
+    archivo: UploadFile = File(...),
+    fecha: str = Form(""),
+    conn=Depends(get_db_escritura),
+):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    try:
+        filas = leer_lista_precios(archivo.filename or "", archivo.file.read())
+    except Exception as e:
+        return error_card(request, f"No se pudo leer el archivo: {e}")
+    if not filas:
+        return error_card(request, "El archivo no trae precios.")
+
+    registros, errores, repetidos = validar_lista_precios(
+        filas, get_clientes(conn), get_productos(conn), fecha
+    )
+    if errores:
+        lista = "".join(f"<li>{e}</li>" for e in errores)
+        return error_card(request, f"No se cargó nada, revisa el archivo:<ul>{lista}</ul>")
+
+    c = db_cursor(conn)
+    insertados, reemplazados = cargar_precios(c, registros)
+    conn.commit()
+
+    invalidar_precios_cache(min(k[2] for k in registros))
+
+    nota_repetidos = f"<p>{repetidos} filas repetidas en el archivo (se tomó la última).</p>" if repetidos else ""
+    body = f"""
+    <h2>Lista de precios importada</h2>
+    <div class="card">
+        <p><b>{insertados}</b> precios cargados, <b>{reemplazados}</b> precios anteriores reemplazados.</p>
+        {nota_repetidos}
+        <p><a href="/precios/importar">Importar otro archivo</a> · <a href="/precios">Precios del día</a></p>
+    </div>
+    """
+    return layout(request, "Precios importados", body)
+
+@app.get("/precios/copiar", response_class=HTMLResponse)
+def precios_copiar_form(request: Request, conn=Depends(get_db)):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    hoy = date.today().isoformat()
+    ayer = (date.today() - timedelta(days=1)).isoformat()
+    opciones = "<option value='0'>OTRO / contado (general)</option>" + "".join(
+        f"<option value='{cl['id']}'>{cl['nombre']}</option>" for cl in get_clientes(conn)
+    )
+    body = f"""
+    <h2>Copiar precios de un día a otro</h2>
+    <div class="card">
+        <form action="/precios/copiar" method="post">
+            <label>Copiar de</label>
+            <input type="date" name="fecha_origen" value="{ayer}" required />
+            <label>A</label>
+            <input type="date" name="fecha_destino" value="{hoy}" required />
+
+            <label>Clientes (sin seleccionar = todos)</label>
+            <select name="cliente_ids" multiple size="10">{opciones}</select>
+
+            <label>Ajuste en % (ej. 3 o -2.5)</label>
+            <input type="number" step="0.01" name="ajuste_pct" value="0" />
+            <label>Ajuste por kg en $ (ej. 1.50)</label>
+            <input type="number" step="0.01" name="ajuste_kg" value="0" />
+
+            <label><input type="checkbox" name="reemplazar" value="1" />
+                Reemplazar precios que ya estén capturados en la fecha destino</label>
+
+            <p><button class="btn btn-primary" type="submit">Copiar precios</button></p>
+        </form>
+        <p><small>Se copia el último precio capturado de cada cliente, producto y tipo.
+        Sin marcar "reemplazar" no se tocan los precios que ya existan en la fecha destino.
+        Un precio que quede igual al que ya estaba vigente ese día no se guarda: el
+        precio anterior sigue valiendo, así que copiar sin ajuste entre días sin cambios
+        no cambia nada.</small></p>
+    </div>
+    """
+    return layout(request, "Copiar precios", body)
+
+@app.post("/precios/copiar", response_class=HTMLResponse)
+def precios_copiar(
+    request: Request,
+    fecha_origen: date = Form(...),
+    fecha_destino: date = Form(...),
+    cliente_ids: list[int] = Form([]),
+    ajuste_pct: float = Form(0.0),
+    ajuste_kg: float = Form(0.0),
+    reemplazar: bool = Form(False),
+    conn=Depends(get_db_escritura),
+):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    if fecha_origen == fecha_destino:
+        return error_card(request, "La fecha origen y destino son la misma.")
+    if ajuste_pct <= -100:
+        return error_card(request, "El ajuste en % debe ser mayor a -100.")
+
+    # sin selección = todos; 0 es el precio general
+    seleccion = [x for x in cliente_ids if x != 0] if cliente_ids else None
+    incluir_general = not cliente_ids or 0 in cliente_ids
+
+    fecha_origen, fecha_destino = fecha_origen.isoformat(), fecha_destino.isoformat()
+    c = db_cursor(conn)
+    copiados, reemplazados, sin_cambio = copiar_precios(c, fecha_origen, fecha_destino, seleccion,
+                                                        incluir_general, ajuste_pct, ajuste_kg, reemplazar)
+    conn.commit()
+    invalidar_precios_cache(fecha_destino)
+
+    nota = f", {reemplazados} precios anteriores reemplazados" if reemplazados else ""
+    if sin_cambio:
+        nota += (f". {sin_cambio} ya valían eso el {fecha_destino} (sigue vigente el precio anterior)"
+                 " y no se guardaron")
+    if not copiados and not reemplazados:
+        nota += ". No hubo cambios" if sin_cambio else ". No había nada que copiar"
+    body = f"""
+    <h2>Precios copiados</h2>
+    <div class="card">
+        <p><b>{copiados}</b> precios copiados de {fecha_origen} a {fecha_destino}{nota}.</p>
+        <p><a href="/precios">Precios del día</a> · <a href="/precios/copiar">Copiar otra vez</a></p>
+    </div>
+    """
+    return layout(request, "Precios copiados", body)
+
+def _matriz_args(productos, desde: str, hasta: str, producto_id: int, tipo_venta: str):
+    """Valida los parámetros de la matriz. Regresa (args, error)."""
+    try:
+        d_hasta = date.fromisoformat(hasta) if hasta else date.today()
+        d_desde = date.fromisoformat(desde) if desde else d_hasta - timedelta(days=29)
+    except ValueError:
+        return None, "Fecha inválida."
+    if d_desde > d_hasta:
+        return None, "La fecha inicial es posterior a la final."
+    if (d_hasta - d_desde).days + 1 > MATRIZ_MAX_DIAS:
+        return None, f"El periodo máximo es de {MATRIZ_MAX_DIAS} días."
+    if tipo_venta not in TIPOS_VENTA:
+        return None, "Tipo de venta inválido."
+    if not producto_id:
+        base = next((p for p in productos if p["codigo"] == "POLLO_ENTERO"), productos[0] if productos else None)
+        producto_id = base["id"] if base else 0
+    if not any(p["id"] == producto_id for p in productos):
+        return None, "Producto no encontrado."
+    return (d_desde, d_hasta, producto_id, tipo_venta), None
+
+@app.get("/api/precios/matriz")
+def precios_matriz_api(
+    request: Request,
+    desde: str = "",
+    hasta: str = "",
+    producto_id: int = 0,
+    tipo_venta: str = "normal",
+    conn=Depends(get_db),
+):
+    if request.session.get("role") != "Caja":
+        return JSONResponse({"error": "no autorizado"}, status_code=401)
+
+    args, error = _matriz_args(get_productos(conn), desde, hasta, producto_id, tipo_venta)
+    if error:
+        return JSONResponse({"error": error}, status_code=400)
+
+    c = db_cursor(conn)
+    return JSONResponse(matriz_precios(c, *args))
+
+@app.get("/precios/matriz", response_class=HTMLResponse)
+def precios_matriz(
+    request: Request,
+    desde: str = "",
+    hasta: str = "",
+    producto_id: int = 0,
+    tipo_venta: str = "normal",
+    conn=Depends(get_db),
+):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    form = await request.form()
-    fecha = form.get("fecha")
-    cliente_id_raw = form.get("cliente_id", "0")
-    cliente_id = None if cliente_id_raw == "0" else int(cliente_id_raw)
+    productos = get_productos(conn)
+    args, error = _matriz_args(productos, desde, hasta, producto_id, tipo_venta)
+    if error:
+        return error_card(request, error)
+    d_desde, d_hasta, producto_id, tipo_venta = args
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    opciones_prod = "".join(
+        f"<option value='{p['id']}'{' selected' if p['id'] == producto_id else ''}>{p['nombre']}</option>"
+        for p in productos
+    )
+    opciones_tipo = "".join(
+        f"<option value='{t}'{' selected' if t == tipo_venta else ''}>{t}</option>" for t in TIPOS_VENTA
+    )
 
-    productos = get_productos()
-    for p in productos:
-        pid = p["id"]
-        codigo = p["codigo"]
+    def celda(precio, heredado=False):
+        if precio is None:
+            return "<td>-</td>"
+        return f"<td style='color:#888'>{precio:.2f}</td>" if heredado else f"<td>{precio:.2f}</td>"
+
+    def contenido():
+        yield f"""
+        <h2>Matriz de precios</h2>
+        <div class="card">
+            <form method="get" action="/precios/matriz" style="display:flex; gap:8px; align-items:center; flex-wrap:wrap;">
+                <label>Desde</label><input type="date" name="desde" value="{d_desde.isoformat()}" />
+                <label>Hasta</label><input type="date" name="hasta" value="{d_hasta.isoformat()}" />
+                <select name="producto_id">{opciones_prod}</select>
+                <select name="tipo_venta">{opciones_tipo}</select>
+                <button class="btn btn-primary" type="submit">Ver</button>
+            </form>
+            <p><small>Precio vigente por día. Se listan los clientes con precio propio en el periodo;
+            en gris los días en que les aplica el general. Máximo {MATRIZ_MAX_DIAS} días.</small></p>
+        </div>
+        """
 
-        val_normal = form.get(f"precio_normal_{pid}")
-        if val_normal:
-            try:
-                precio = float(val_normal)
-                insert_and_get_id(c, """
-                    INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
-                    VALUES (?, ?, ?, ?, ?)
-                """, (cliente_id, pid, fecha, "normal", precio))
-            except ValueError:
-                pass
+        c = db_cursor(conn)
+        m = matriz_precios(c, d_desde, d_hasta, producto_id, tipo_venta)
 
-        if codigo in ("POLLO_ENTERO", "POLLO_VIVO"):
-            val_may = form.get(f"precio_mayoreo_{pid}")
-            if val_may:
-                try:
-                    precio = float(val_may)
-                    insert_and_get_id(c, """
-                        INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (cliente_id, pid, fecha, "mayoreo", precio))
-                except ValueError:
-                    pass
+        encabezado = "".join(f"<th>{f[8:10]}/{f[5:7]}</th>" for f in m["fechas"])
+        yield f"""
+        <div class="card" style="overflow-x:auto;">
+            <table>
+                <thead><tr><th>Cliente</th>{encabezado}</tr></thead>
+                <tbody>
+                <tr><td><b>General</b></td>{"".join(celda(p) for p in m["general"])}</tr>
+        """
+        for cid, nombre, fila in zip(m["cliente_id"], m["cliente"], m["precios"]):
+            celdas = "".join(
+                celda(p) if p is not None else celda(g, heredado=True)
+                for p, g in zip(fila, m["general"])
+            )
+            yield f"<tr><td><a href='/clientes/saldo?cliente_id={cid}'>{nombre}</a></td>{celdas}</tr>"
 
-            val_men = form.get(f"precio_menudeo_{pid}")
-            if val_men:
-                try:
-                    precio = float(val_men)
-                    insert_and_get_id(c, """
-                        INSERT INTO precios (cliente_id, producto_id, fecha, tipo_venta, precio_por_kg)
-                        VALUES (?, ?, ?, ?, ?)
-                    """, (cliente_id, pid, fecha, "menudeo", precio))
-                except ValueError:
-                    pass
+        yield f"""
+                </tbody>
+            </table>
+            <p><small>{len(m["cliente_id"])} clientes con precio propio.</small></p>
+        </div>
+        """
 
-    conn.commit()
-    close_conn(conn)
-    return RedirectResponse(url="/precios", status_code=303)
+    return layout_stream(request, "Matriz de precios", contenido())
 
 # ---------------- BOLETAS (Bascula y Caja) ----------------
 
 @app.get("/boletas/nueva", response_class=HTMLResponse)
-def boleta_form(request: Request):
+def boleta_form(request: Request, conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja", "Bascula"])
     if guard:
         return guard
 
-    clientes = get_clientes()
-    productos = get_productos()
-
-    opciones_clientes = "<option value='0'>OTRO / contado</option>"
-    for cl in clientes:
-        opciones_clientes += f"<option value='{cl['id']}'>{cl['nombre']}</option>"
+    productos = get_productos(conn)
 
     opciones_productos = ""
     for p in productos:
@@ -1043,7 +3185,7 @@ def boleta_form(request: Request):
     <div class="card">
         <form action="/boletas/nueva" method="post">
             <label>Cliente</label>
-            <select name="cliente_id">{opciones_clientes}</select>
+            {cliente_autocomplete_html("OTRO / contado")}
 
             <label>Producto</label>
             <select name="producto_id">{opciones_productos}</select>
@@ -1073,8 +3215,15 @@ def boleta_form(request: Request):
     """
     return layout(request, "Nueva boleta", body)
 
+SQL_BOLETA_INSERT = Consulta("boleta_insert", """
+    INSERT INTO boletas_pesaje (fecha_hora, cliente_id, producto_id, tipo_venta,
+                               num_pollos, num_cajas, peso_total_kg,
+                               comentarios, estado)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'abierta')
+""")
+
 @app.post("/boletas/nueva")
-def boleta_crear(
+async def boleta_crear(
     request: Request,
     cliente_id: int = Form(0),
     producto_id: int = Form(...),
@@ -1083,6 +3232,7 @@ def boleta_crear(
     num_cajas: int = Form(...),
     peso_total_kg: float = Form(...),
     comentarios: str = Form(""),
+    db=Depends(get_adb_escritura),
 ):
     guard = ensure_role(request, ["Caja", "Bascula"])
     if guard:
@@ -1091,171 +3241,206 @@ def boleta_crear(
     cliente_id_val = None if cliente_id == 0 else cliente_id
     fecha_hora = datetime.now().isoformat(timespec="seconds")
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    insert_and_get_id(c, """
-        INSERT INTO boletas_pesaje (fecha_hora, cliente_id, producto_id, tipo_venta,
-                                   num_pollos, num_cajas, peso_total_kg,
-                                   comentarios, estado)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'abierta')
-    """, (fecha_hora, cliente_id_val, producto_id, tipo_venta,
+    await db.execute(SQL_BOLETA_INSERT, (fecha_hora, cliente_id_val, producto_id, tipo_venta,
           num_pollos, num_cajas, peso_total_kg, comentarios))
-    conn.commit()
-    close_conn(conn)
+    await db.commit()
     return RedirectResponse(url="/boletas/pendientes", status_code=303)
 
 @app.get("/boletas/pendientes", response_class=HTMLResponse)
-def boletas_pendientes(request: Request):
+def boletas_pendientes(request: Request, conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja", "Bascula"])
     if guard:
         return guard
 
     role = request.session.get("role")
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    db_execute(c, """
-        SELECT b.id, b.fecha_hora, b.peso_total_kg, b.num_pollos, b.num_cajas,
-               b.tipo_venta, p.nombre AS producto
-        FROM boletas_pesaje b
-        JOIN productos p ON p.id = b.producto_id
-        WHERE b.estado = 'abierta'
-        ORDER BY b.fecha_hora
-    """)
-    boletas = c.fetchall()
-    close_conn(conn)
-
-    rows = ""
-    for b in boletas:
-        accion_html = (
-            f"<a class='btn btn-primary' href='/boletas/cobrar/{b['id']}'>Cobrar</a>"
-            if role == "Caja"
-            else "<span style='color:#6b7280; font-size:12px;'>—</span>"
-        )
+    def contenido():
+        yield """
+        <h2>Boletas pendientes de cobro</h2>
+        <div class="card">
+            <table>
+                <thead>
+                    <tr>
+                        <th>ID</th>
+                        <th>Fecha/hora</th>
+                        <th>Producto</th>
+                        <th>Pollos</th>
+                        <th>Cajas</th>
+                        <th>Peso total (kg)</th>
+                        <th>Tipo venta</th>
+                        <th>Acción</th>
+                    </tr>
+                </thead>
+                <tbody>
+        """
 
-        rows += f"""
-        <tr>
-            <td>{b['id']}</td>
-            <td>{b['fecha_hora']}</td>
-            <td>{b['producto']}</td>
-            <td>{b['num_pollos']}</td>
-            <td>{b['num_cajas']}</td>
-            <td>{float(b['peso_total_kg']):.3f}</td>
-            <td>{b['tipo_venta']}</td>
-            <td>{accion_html}</td>
-        </tr>
+        c = db_cursor(conn)
+        db_execute(c, """
+            SELECT b.id, b.fecha_hora, b.peso_total_kg, b.num_pollos, b.num_cajas,
+                   b.tipo_venta, p.nombre AS producto
+            FROM boletas_pesaje b
+            JOIN productos p ON p.id = b.producto_id
+            WHERE b.estado = 'abierta'
+            ORDER BY b.fecha_hora
+        """)
+
+        hay_filas = False
+        for b in iter_filas(c):
+            hay_filas = True
+            accion_html = (
+                f"<a class='btn btn-primary' href='/boletas/cobrar/{b['id']}'>Cobrar</a>"
+                if role == "Caja"
+                else "<span style='color:#6b7280; font-size:12px;'>—</span>"
+            )
+            yield f"""
+            <tr>
+                <td>{b['id']}</td>
+                <td>{b['fecha_hora']}</td>
+                <td>{b['producto']}</td>
+                <td>{b['num_pollos']}</td>
+                <td>{b['num_cajas']}</td>
+                <td>{float(b['peso_total_kg']):.3f}</td>
+                <td>{b['tipo_venta']}</td>
+                <td>{accion_html}</td>
+            </tr>
+            """
+
+        if not hay_filas:
+            yield "<tr><td colspan='8'>No hay boletas abiertas</td></tr>"
+        yield """
+                </tbody>
+            </table>
+        </div>
         """
 
-    body = f"""
-    <h2>Boletas pendientes de cobro</h2>
-    <div class="card">
-        <table>
-            <thead>
-                <tr>
-                    <th>ID</th>
-                    <th>Fecha/hora</th>
-                    <th>Producto</th>
-                    <th>Pollos</th>
-                    <th>Cajas</th>
-                    <th>Peso total (kg)</th>
-                    <th>Tipo venta</th>
-                    <th>Acción</th>
-                </tr>
-            </thead>
-            <tbody>
-                {rows or "<tr><td colspan='8'>No hay boletas abiertas</td></tr>"}
-            </tbody>
-        </table>
-    </div>
-    """
-    return layout(request, "Boletas pendientes", body)
+    return layout_stream(request, "Boletas pendientes", contenido())
 
 @app.get("/boletas/cobradas", response_class=HTMLResponse)
-def boletas_cobradas(request: Request):
+def boletas_cobradas(
+    request: Request,
+    despues: str = "",
+    antes: str = "",
+    conn=Depends(get_db),
+):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-    db_execute(c, """
-        SELECT
-            v.id AS venta_id,
-            v.fecha_hora AS fecha_venta,
-            b.id AS boleta_id,
-            b.fecha_hora AS fecha_boleta,
-            b.num_pollos,
-            b.num_cajas,
-            b.tipo_venta,
-            v.peso_neto_kg,
-            v.precio_por_kg,
-            v.total,
-            v.metodo_pago,
-            p.nombre AS producto,
-            cl.nombre AS cliente
-        FROM ventas v
-        JOIN boletas_pesaje b ON v.boleta_id = b.id
-        JOIN productos p ON p.id = b.producto_id
-        LEFT JOIN clientes cl ON cl.id = v.cliente_id
-        ORDER BY v.fecha_hora DESC
-        LIMIT 200
-    """)
-    rows_db = c.fetchall()
-    close_conn(conn)
+    PER_PAGE = 100
 
-    rows_html = ""
-    for r in rows_db:
-        cliente = r["cliente"] if r["cliente"] is not None else "OTRO / contado"
-        rows_html += f"""
-        <tr>
-            <td>{r['venta_id']}</td>
-            <td>{r['boleta_id']}</td>
-            <td>{r['fecha_venta']}</td>
-            <td>{cliente}</td>
-            <td>{r['producto']}</td>
-            <td>{float(r['peso_neto_kg']):.3f}</td>
-            <td>{float(r['precio_por_kg']):.2f}</td>
-            <td>{float(r['total']):.2f}</td>
-            <td>{r['metodo_pago']}</td>
-            <td>{r['tipo_venta']}</td>
-        </tr>
+    # cursor sobre (fecha_hora, id), de la más nueva a la más vieja
+    cur_despues = cursor_decode(despues)
+    cur_antes = cursor_decode(antes)
+    hacia_atras = cur_antes is not None and cur_despues is None
+    if cur_despues is not None:
+        where, params = "WHERE (v.fecha_hora, v.id) < (?, ?)", (str(cur_despues[0]), int(cur_despues[1]))
+    elif hacia_atras:
+        where, params = "WHERE (v.fecha_hora, v.id) > (?, ?)", (str(cur_antes[0]), int(cur_antes[1]))
+    else:
+        where, params = "", ()
+    orden = "ASC" if hacia_atras else "DESC"
+
+    def contenido():
+        yield f"""
+        <h2>Boletas cobradas (ventas)</h2>
+        <div class="card">
+            <p>Ventas de la más reciente a la más antigua, {PER_PAGE} por página.</p>
+            <table>
+                <thead>
+                    <tr>
+                        <th>ID venta</th>
+                        <th>ID boleta</th>
+                        <th>Fecha venta</th>
+                        <th>Cliente</th>
+                        <th>Producto</th>
+                        <th>Peso neto (kg)</th>
+                        <th>Precio/kg</th>
+                        <th>Total</th>
+                        <th>Método pago</th>
+                        <th>Tipo venta</th>
+                    </tr>
+                </thead>
+                <tbody>
         """
 
-    body = f"""
-    <h2>Boletas cobradas (ventas)</h2>
-    <div class="card">
-        <p>Últimas 200 ventas registradas.</p>
-        <table>
-            <thead>
-                <tr>
-                    <th>ID venta</th>
-                    <th>ID boleta</th>
-                    <th>Fecha venta</th>
-                    <th>Cliente</th>
-                    <th>Producto</th>
-                    <th>Peso neto (kg)</th>
-                    <th>Precio/kg</th>
-                    <th>Total</th>
-                    <th>Método pago</th>
-                    <th>Tipo venta</th>
-                </tr>
-            </thead>
-            <tbody>
-                {rows_html or "<tr><td colspan='10'>Aún no hay boletas cobradas</td></tr>"}
-            </tbody>
-        </table>
-    </div>
-    """
-    return layout(request, "Boletas cobradas", body)
+        c = db_cursor(conn)
+        db_execute(c, f"""
+            SELECT
+                v.id AS venta_id,
+                v.fecha_hora AS fecha_venta,
+                b.id AS boleta_id,
+                b.fecha_hora AS fecha_boleta,
+                b.num_pollos,
+                b.num_cajas,
+                b.tipo_venta,
+                v.peso_neto_kg,
+                v.precio_por_kg,
+                v.total,
+                v.metodo_pago,
+                p.nombre AS producto,
+                cl.nombre AS cliente
+            FROM ventas v
+            JOIN boletas_pesaje b ON v.boleta_id = b.id
+            JOIN productos p ON p.id = b.producto_id
+            LEFT JOIN clientes cl ON cl.id = v.cliente_id
+            {where}
+            ORDER BY v.fecha_hora {orden}, v.id {orden}
+            LIMIT ?
+        """, params + (PER_PAGE + 1,))
+
+        pagina = PaginaKeyset(c, PER_PAGE, hacia_atras)
+        for r in pagina:
+            cliente = r["cliente"] if r["cliente"] is not None else "OTRO / contado"
+            yield f"""
+            <tr>
+                <td>{r['venta_id']}</td>
+                <td>{r['boleta_id']}</td>
+                <td>{r['fecha_venta']}</td>
+                <td>{cliente}</td>
+                <td>{r['producto']}</td>
+                <td>{float(r['peso_neto_kg']):.3f}</td>
+                <td>{float(r['precio_por_kg']):.2f}</td>
+                <td>{float(r['total']):.2f}</td>
+                <td>{r['metodo_pago']}</td>
+                <td>{r['tipo_venta']}</td>
+            </tr>
+            """
+
+        if pagina.primera is None:
+            yield "<tr><td colspan='10'>Aún no hay boletas cobradas</td></tr>"
+
+        hay_siguiente = pagina.hay_mas if not hacia_atras else True
+        hay_anterior = (cur_despues is not None) if not hacia_atras else pagina.hay_mas
+        primera, ultima = pagina.primera, pagina.ultima
+        link_anterior = (
+            f"<a class='btn btn-secondary' href='/boletas/cobradas?antes={cursor_encode(primera['fecha_venta'], primera['venta_id'])}'>← Más recientes</a>"
+            if primera and hay_anterior else ""
+        )
+        link_siguiente = (
+            f"<a class='btn btn-secondary' href='/boletas/cobradas?despues={cursor_encode(ultima['fecha_venta'], ultima['venta_id'])}'>Más antiguas →</a>"
+            if ultima and hay_siguiente else ""
+        )
+
+        yield f"""
+                </tbody>
+            </table>
+        </div>
+        <div class="card">
+            <a class="btn btn-secondary" href="/boletas/cobradas">« Más recientes</a>
+            {link_anterior}
+            {link_siguiente}
+        </div>
+        """
+
+    return layout_stream(request, "Boletas cobradas", contenido())
 
 @app.get("/boletas/cobrar/{boleta_id}", response_class=HTMLResponse)
-def cobrar_boleta_form(request: Request, boleta_id: int):
+def cobrar_boleta_form(request: Request, boleta_id: int, conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    c = db_cursor(conn)
     db_execute(c, """
         SELECT b.*, p.nombre AS producto
         FROM boletas_pesaje b
@@ -1263,7 +3448,6 @@ def cobrar_boleta_form(request: Request, boleta_id: int):
         WHERE b.id = ?
     """, (boleta_id,))
     boleta = c.fetchone()
-    close_conn(conn)
 
     if not boleta:
         return error_card(request, "Boleta no encontrada.")
@@ -1293,28 +3477,37 @@ def cobrar_boleta_form(request: Request, boleta_id: int):
     """
     return layout(request, "Cobrar boleta", body)
 
+# columnas explícitas: en Postgres un SELECT * preparado falla ("cached plan
+# must not change result type") si después se le agrega una columna a la tabla
+SQL_BOLETA_COBRO = Consulta("boleta_cobro", """
+    SELECT id, fecha_hora, cliente_id, producto_id, tipo_venta,
+           num_pollos, num_cajas, peso_total_kg, estado
+    FROM boletas_pesaje WHERE id = ?
+""")
+SQL_VENTA_INSERT = Consulta("venta_insert", """
+    INSERT INTO ventas (fecha_hora, boleta_id, cliente_id, producto_id,
+                        peso_neto_kg, precio_por_kg, total, metodo_pago)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+""")
+SQL_BOLETA_CERRAR = Consulta("boleta_cerrar", "UPDATE boletas_pesaje SET estado = 'cerrada' WHERE id = ?")
+
 @app.post("/boletas/cobrar/{boleta_id}")
-def cobrar_boleta(
+async def cobrar_boleta(
     request: Request,
     boleta_id: int,
     peso_caja_kg: float = Form(...),
     metodo_pago: str = Form(...),
+    db=Depends(get_adb_escritura),
 ):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-
-    db_execute(c, "SELECT * FROM boletas_pesaje WHERE id = ?", (boleta_id,))
-    boleta = c.fetchone()
+    boleta = await db.fetchone(SQL_BOLETA_COBRO, (boleta_id,))
 
     if not boleta:
-        close_conn(conn)
         return error_card(request, "Boleta no encontrada.")
     if boleta["estado"] != "abierta":
-        close_conn(conn)
         return error_card(request, "La boleta ya fue cerrada.")
 
     peso_total = float(boleta["peso_total_kg"])
@@ -1325,35 +3518,29 @@ def cobrar_boleta(
     fecha_txt = boleta["fecha_hora"][:10]
     fecha_hora = datetime.now().isoformat(timespec="seconds")
 
-    precio_por_kg = obtener_precio(cliente_id, producto_id, fecha_txt, tipo_venta)
+    precio_por_kg = await obtener_precio_async(db, cliente_id, producto_id, fecha_txt, tipo_venta)
     if precio_por_kg is None:
-        close_conn(conn)
-        return error_card(request, "No hay precio configurado para ese día/cliente/tipo.")
+        return error_card(request, "No hay precio configurado para ese día/cliente/tipo. "
+                                   "<a href='/precios/copiar'>Copiar precios de otro día</a>")
 
     peso_neto = peso_total - (num_cajas * float(peso_caja_kg))
     if peso_neto <= 0:
-        close_conn(conn)
         return error_card(request, "Peso neto menor o igual a 0. Revisa datos.")
 
     total = round(peso_neto * float(precio_por_kg), 2)
 
-    venta_id = insert_and_get_id(c, """
-        INSERT INTO ventas (fecha_hora, boleta_id, cliente_id, producto_id,
-                            peso_neto_kg, precio_por_kg, total, metodo_pago)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-    """, (fecha_hora, boleta_id, cliente_id, producto_id,
+    venta_id = await db.insert_and_get_id(SQL_VENTA_INSERT, (fecha_hora, boleta_id, cliente_id, producto_id,
           peso_neto, precio_por_kg, total, metodo_pago))
 
-    db_execute(c, "UPDATE boletas_pesaje SET estado = 'cerrada' WHERE id = ?", (boleta_id,))
+    await db.execute(SQL_BOLETA_CERRAR, (boleta_id,))
+    await db.execute(SQL_RESUMEN_UPSERT, params_resumen_venta(
+        fecha_hora, producto_id, tipo_venta, metodo_pago, peso_neto, boleta["num_pollos"], num_cajas, total
+    ))
 
     if cliente_id is not None and metodo_pago == "credito_cliente":
-        insert_and_get_id(c, """
-            INSERT INTO movimientos_cliente (fecha_hora, cliente_id, tipo, referencia_id, monto)
-            VALUES (?, ?, 'venta', ?, ?)
-        """, (fecha_hora, cliente_id, venta_id, total))
+        await registrar_movimiento_async(db, fecha_hora, cliente_id, "venta", venta_id, total)
 
-    conn.commit()
-    close_conn(conn)
+    await db.commit()
 
     body = f"""
     <h2>Venta generada #{venta_id}</h2>
@@ -1395,24 +3582,35 @@ def devolucion_form(request: Request):
     """
     return layout(request, "Devolución", body)
 
+SQL_VENTA_DEVOLUCION = Consulta("venta_devolucion", """
+    SELECT v.cliente_id, v.producto_id, v.precio_por_kg, v.metodo_pago, b.tipo_venta
+    FROM ventas v
+    JOIN boletas_pesaje b ON b.id = v.boleta_id
+    WHERE v.id = ?
+""")
+SQL_DEVOLUCION_INSERT = Consulta("devolucion_insert", """
+    INSERT INTO devoluciones (fecha_hora, venta_id, cliente_id,
+                              peso_devuelto_kg, monto_devuelto, motivo)
+    VALUES (?, ?, ?, ?, ?, ?)
+""")
+
 @app.post("/devoluciones/nueva")
 def devolucion_crear(
     request: Request,
     venta_id: int = Form(...),
     peso_devuelto_kg: float = Form(...),
     motivo: str = Form(""),
+    conn=Depends(get_db_escritura),
 ):
     guard = ensure_role(request, ["Caja", "Bascula"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
+    c = db_cursor(conn)
 
-    db_execute(c, "SELECT * FROM ventas WHERE id = ?", (venta_id,))
+    db_execute(c, SQL_VENTA_DEVOLUCION, (venta_id,))
     venta = c.fetchone()
     if not venta:
-        close_conn(conn)
         return error_card(request, "Venta no encontrada.")
 
     cliente_id = venta["cliente_id"]
@@ -1420,20 +3618,17 @@ def devolucion_crear(
     monto_devuelto = round(float(peso_devuelto_kg) * precio_por_kg, 2)
     fecha_hora = datetime.now().isoformat(timespec="seconds")
 
-    devolucion_id = insert_and_get_id(c, """
-        INSERT INTO devoluciones (fecha_hora, venta_id, cliente_id,
-                                  peso_devuelto_kg, monto_devuelto, motivo)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (fecha_hora, venta_id, cliente_id, peso_devuelto_kg, monto_devuelto, motivo))
+    devolucion_id = insert_and_get_id(c, SQL_DEVOLUCION_INSERT, (fecha_hora, venta_id, cliente_id, peso_devuelto_kg, monto_devuelto, motivo))
+
+    db_execute(c, SQL_RESUMEN_UPSERT, params_resumen_devolucion(
+        fecha_hora, venta["producto_id"], venta["tipo_venta"], venta["metodo_pago"],
+        peso_devuelto_kg, monto_devuelto
+    ))
 
     if cliente_id is not None:
-        insert_and_get_id(c, """
-            INSERT INTO movimientos_cliente (fecha_hora, cliente_id, tipo, referencia_id, monto)
-            VALUES (?, ?, 'devolucion', ?, ?)
-        """, (fecha_hora, cliente_id, devolucion_id, -monto_devuelto))
+        registrar_movimiento(c, fecha_hora, cliente_id, "devolucion", devolucion_id, -monto_devuelto)
 
     conn.commit()
-    close_conn(conn)
 
     body = f"""
     <h2>Devolución registrada</h2>
@@ -1446,6 +3641,354 @@ def devolucion_crear(
     """
     return layout(request, "Devolución registrada", body)
 
+# ---------------- CIERRE DE CAJA (Caja) ----------------
+
+SQL_CIERRE_SUMAS = """
+    SUM(r.num_ventas) AS num_ventas, SUM(r.kg) AS kg, SUM(r.pollos) AS pollos,
+    SUM(r.cajas) AS cajas, SUM(r.total) AS total, SUM(r.num_devoluciones) AS num_devoluciones,
+    SUM(r.kg_devuelto) AS kg_devuelto, SUM(r.monto_devuelto) AS monto_devuelto
+"""
+
+@app.get("/cierre", response_class=HTMLResponse)
+def cierre(request: Request, dia: str = "", mes: str = "", conn=Depends(get_db)):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    try:
+        if mes:
+            inicio = date.fromisoformat(mes + "-01")
+            fin = (inicio + timedelta(days=32)).replace(day=1)
+            titulo = f"Cierre del mes {inicio.strftime('%m/%Y')}"
+        else:
+            inicio = date.fromisoformat(dia) if dia else date.today()
+            fin = inicio + timedelta(days=1)
+            titulo = f"Cierre del día {inicio.strftime('%d/%m/%Y')}"
+    except ValueError:
+        return error_card(request, "Fecha inválida.")
+    rango = (inicio.isoformat(), fin.isoformat())
+
+    c = db_cursor(conn)
+    db_execute(c, f"""
+        SELECT p.nombre AS producto, r.tipo_venta, {SQL_CIERRE_SUMAS}
+        FROM resumen_diario r
+        JOIN productos p ON p.id = r.producto_id
+        WHERE r.fecha >= ? AND r.fecha < ?
+        GROUP BY p.nombre, r.tipo_venta
+        ORDER BY p.nombre, r.tipo_venta
+    """, rango)
+    por_producto = c.fetchall()
+
+    db_execute(c, f"""
+        SELECT r.metodo_pago, {SQL_CIERRE_SUMAS}
+        FROM resumen_diario r
+        WHERE r.fecha >= ? AND r.fecha < ?
+        GROUP BY r.metodo_pago
+        ORDER BY r.metodo_pago
+    """, rango)
+    por_metodo = c.fetchall()
+
+    por_dia = []
+    if mes:
+        db_execute(c, f"""
+            SELECT r.fecha, {SQL_CIERRE_SUMAS}
+            FROM resumen_diario r
+            WHERE r.fecha >= ? AND r.fecha < ?
+            GROUP BY r.fecha
+            ORDER BY r.fecha
+        """, rango)
+        por_dia = c.fetchall()
+
+    def fila(etiqueta, r, con_kg=True):
+        total = float(r["total"] or 0)
+        devuelto = float(r["monto_devuelto"] or 0)
+        kg = f"""
+            <td>{float(r['kg'] or 0):.3f}</td>
+            <td>{int(r['pollos'] or 0)}</td>
+            <td>{int(r['cajas'] or 0)}</td>
+        """ if con_kg else ""
+        return f"""
+        <tr>
+            <td>{etiqueta}</td>
+            <td>{int(r['num_ventas'] or 0)}</td>
+            {kg}
+            <td>${total:.2f}</td>
+            <td>{int(r['num_devoluciones'] or 0)} / {float(r['kg_devuelto'] or 0):.3f} kg</td>
+            <td>${devuelto:.2f}</td>
+            <td><b>${total - devuelto:.2f}</b></td>
+        </tr>
+        """
+
+    encabezado_kg = "<th>Kg</th><th>Pollos</th><th>Cajas</th>"
+    def tabla(primera, filas, con_kg=True):
+        if not filas:
+            return "<p>Sin ventas ni devoluciones en el periodo.</p>"
+        return f"""
+        <table>
+            <thead>
+                <tr>
+                    <th>{primera}</th><th>Ventas</th>{encabezado_kg if con_kg else ""}
+                    <th>Total</th><th>Devoluciones</th><th>Devuelto</th><th>Neto</th>
+                </tr>
+            </thead>
+            <tbody>{"".join(filas)}</tbody>
+        </table>
+        """
+
+    filas_metodo = [fila(r["metodo_pago"], r, con_kg=False) for r in por_metodo]
+    filas_producto = [fila(f"{r['producto']} ({r['tipo_venta']})", r) for r in por_producto]
+    filas_dia = [fila(str(r["fecha"]), r) for r in por_dia]
+
+    seccion_dias = f"""
+    <div class="card">
+        <h3>Por día</h3>
+        {tabla("Día", filas_dia)}
+    </div>
+    """ if mes else ""
+
+    body = f"""
+    <h2>{titulo}</h2>
+    <div class="card">
+        <form method="get" action="/cierre" style="display:flex; gap:8px; align-items:center;">
+            <label>Día</label><input type="date" name="dia" value="{inicio.isoformat() if not mes else ''}" />
+            <button class="btn btn-primary" type="submit">Ver día</button>
+        </form>
+        <form method="get" action="/cierre" style="display:flex; gap:8px; align-items:center;">
+            <label>Mes</label><input type="month" name="mes" value="{mes}" />
+            <button class="btn btn-primary" type="submit">Ver mes</button>
+        </form>
+    </div>
+
+    <div class="card">
+        <h3>Por método de pago</h3>
+        {tabla("Método", filas_metodo, con_kg=False)}
+        <p><small>Las devoluciones cuentan el día en que se hacen, con el método de pago de la venta original.</small></p>
+    </div>
+
+    <div class="card">
+        <h3>Por producto</h3>
+        {tabla("Producto", filas_producto)}
+    </div>
+    {seccion_dias}
+    """
+    return layout(request, titulo, body)
+
+# ---------------- EXPORTAR (Caja) ----------------
+# CSV completos para contabilidad. Se escriben conforme llegan las filas del
+# cursor (del lado del servidor en Postgres), en bloques de ~STREAM_CHUNK, así
+# un año de datos sale con memoria constante y el primer byte sale de inmediato.
+
+EXPORTS = {
+    "ventas": ("""
+        SELECT v.id, v.fecha_hora, v.boleta_id, v.cliente_id, cl.nombre AS cliente,
+               p.codigo AS producto, b.tipo_venta, b.num_pollos, b.num_cajas,
+               v.peso_neto_kg, v.precio_por_kg, v.total, v.metodo_pago
+        FROM ventas v
+        JOIN productos p ON p.id = v.producto_id
+        LEFT JOIN boletas_pesaje b ON b.id = v.boleta_id
+        LEFT JOIN clientes cl ON cl.id = v.cliente_id
+        WHERE v.fecha_hora >= ? AND v.fecha_hora < ?{cliente}
+        ORDER BY v.fecha_hora, v.id
+    """, "v.cliente_id"),
+    "devoluciones": ("""
+        SELECT d.id, d.fecha_hora, d.venta_id, d.cliente_id, cl.nombre AS cliente,
+               p.codigo AS producto, d.peso_devuelto_kg, d.monto_devuelto, d.motivo
+        FROM devoluciones d
+        LEFT JOIN ventas v ON v.id = d.venta_id
+        LEFT JOIN productos p ON p.id = v.producto_id
+        LEFT JOIN clientes cl ON cl.id = d.cliente_id
+        WHERE d.fecha_hora >= ? AND d.fecha_hora < ?{cliente}
+        ORDER BY d.fecha_hora, d.id
+    """, "d.cliente_id"),
+    "movimientos": ("""
+        SELECT m.id, m.fecha_hora, m.cliente_id, cl.nombre AS cliente, m.tipo,
+               m.referencia_id, m.monto, m.saldo_despues
+        FROM movimientos_cliente m
+        LEFT JOIN clientes cl ON cl.id = m.cliente_id
+        WHERE m.fecha_hora >= ? AND m.fecha_hora < ?{cliente}
+        ORDER BY m.fecha_hora, m.id
+    """, "m.cliente_id"),
+}
+
+def _valor_csv(v):
+    if v is None:
+        return ""
+    if isinstance(v, float):
+        return round(v, 3)
+    return v
+
+@app.get("/export", response_class=HTMLResponse)
+def export_form(request: Request):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    hoy = date.today()
+    links = "".join(
+        f"<button class='btn btn-primary' type='submit' formaction='/export/{nombre}.csv'>{nombre.capitalize()} (CSV)</button> "
+        for nombre in EXPORTS
+    )
+    body = f"""
+    <h2>Exportar</h2>
+    <div class="card">
+        <form method="get" action="/export/ventas.csv">
+            <label>Desde</label>
+            <input type="date" name="desde" value="{hoy.replace(day=1).isoformat()}" required />
+            <label>Hasta (incluido)</label>
+            <input type="date" name="hasta" value="{hoy.isoformat()}" required />
+
+            <label>Cliente</label>
+            {cliente_autocomplete_html("Todos")}
+
+            <p>{links}</p>
+        </form>
+        <p><small>Los archivos salen completos (sin límite de filas), en UTF-8 con separador coma.</small></p>
+    </div>
+    """
+    return layout(request, "Exportar", body)
+
+@app.get("/export/{nombre}.csv")
+def export_csv(
+    request: Request,
+    nombre: str,
+    desde: str = "",
+    hasta: str = "",
+    cliente_id: int = 0,
+    conn=Depends(get_db),
+):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+    if nombre not in EXPORTS:
+        return error_card(request, "Exportación no encontrada.")
+
+    try:
+        d_hasta = date.fromisoformat(hasta) if hasta else date.today()
+        d_desde = date.fromisoformat(desde) if desde else d_hasta.replace(day=1)
+    except ValueError:
+        return error_card(request, "Fecha inválida.")
+
+    sql, col_cliente = EXPORTS[nombre]
+    params = [d_desde.isoformat(), (d_hasta + timedelta(days=1)).isoformat()]
+    if cliente_id:
+        params.append(cliente_id)
+    sql = sql.format(cliente=f" AND {col_cliente} = ?" if cliente_id else "")
+
+    def generar():
+        c = cursor_servidor(conn, f"export_{nombre}")
+        db_execute(c, sql, tuple(params))
+
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        buf.write("\ufeff")  # BOM: Excel abre bien los acentos
+        encabezado = False
+        for r in iter_filas(c, 2000):
+            if not encabezado:
+                w.writerow(r.keys())
+                encabezado = True
+            w.writerow([_valor_csv(v) for v in (r.values() if IS_POSTGRES else tuple(r))])
+            if buf.tell() >= STREAM_CHUNK:
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if not encabezado and c.description:
+            w.writerow([col[0] for col in c.description])
+        yield buf.getvalue()
+        c.close()
+
+    archivo = f"{nombre}_{d_desde.isoformat()}_{d_hasta.isoformat()}" + (f"_cliente{cliente_id}" if cliente_id else "")
+    return StreamingResponse(
+        generar(),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{archivo}.csv"'},
+    )
+
+# ---------------- REPORTES (Caja) ----------------
+# Salen del snapshot columnar de reportes.py, no de la base en vivo.
+
+def _modulo_reportes():
+    try:
+        import reportes
+    except ImportError:  # numpy no instalado
+        return None
+    return reportes
+
+@app.get("/reportes", response_class=HTMLResponse)
+def reportes_view(request: Request, r: str = "kg_semana_producto", desde: str = "", hasta: str = ""):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    reportes = _modulo_reportes()
+    if reportes is None:
+        return error_card(request, "Los reportes necesitan numpy (pip install numpy).")
+    if r not in reportes.REPORTES:
+        return error_card(request, "Reporte no encontrado.")
+    try:
+        for f in (desde, hasta):
+            if f:
+                date.fromisoformat(f)
+    except ValueError:
+        return error_card(request, "Fecha inválida.")
+
+    opciones = "".join(
+        f"<option value='{k}'{' selected' if k == r else ''}>{titulo}</option>"
+        for k, (titulo, _, _) in reportes.REPORTES.items()
+    )
+    snap = reportes.cargar_snapshot()
+    titulo, fn, columnas = reportes.REPORTES[r]
+
+    if snap is None:
+        resultado = "<p>Todavía no hay snapshot. Genéralo con el botón de abajo.</p>"
+        generado = "nunca"
+    else:
+        generado = snap.meta["generado"]
+        filas = fn(snap, desde, hasta)
+        cuerpo = "".join(
+            "<tr>" + "".join(f"<td>{'-' if f.get(col) is None else f[col]}</td>" for col in columnas) + "</tr>"
+            for f in filas
+        )
+        resultado = f"""
+        <table>
+            <thead><tr>{"".join(f"<th>{col}</th>" for col in columnas)}</tr></thead>
+            <tbody>{cuerpo}</tbody>
+        </table>
+        <p><small>{len(filas)} filas.</small></p>
+        """ if filas else "<p>Sin datos en el periodo.</p>"
+
+    body = f"""
+    <h2>Reportes</h2>
+    <div class="card">
+        <form method="get" action="/reportes" style="display:flex; gap:8px; align-items:center; flex-wrap:wrap;">
+            <select name="r">{opciones}</select>
+            <label>Desde</label><input type="date" name="desde" value="{desde}" />
+            <label>Hasta</label><input type="date" name="hasta" value="{hasta}" />
+            <button class="btn btn-primary" type="submit">Ver</button>
+        </form>
+        <form method="post" action="/reportes/snapshot" style="margin-top:8px;">
+            <small>Datos al {generado}.</small>
+            <button class="btn btn-secondary" type="submit">Actualizar datos</button>
+        </form>
+    </div>
+    <div class="card">
+        <h3>{titulo}</h3>
+        {resultado}
+    </div>
+    """
+    return layout(request, "Reportes", body)
+
+@app.post("/reportes/snapshot")
+def reportes_snapshot(request: Request):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    reportes = _modulo_reportes()
+    if reportes is None:
+        return error_card(request, "Los reportes necesitan numpy (pip install numpy).")
+    reportes.actualizar_snapshot()
+    return RedirectResponse(url="/reportes", status_code=303)
+
 # ---------------- SALDOS (Caja) ----------------
 
 @app.get("/clientes/saldos", response_class=HTMLResponse)
@@ -1454,79 +3997,227 @@ def saldo_selector(request: Request):
     if guard:
         return guard
 
-    clientes = get_clientes()
-    opciones = "".join([f"<option value='{cl['id']}'>{cl['nombre']}</option>" for cl in clientes])
-
     body = f"""
     <h2>Saldos de clientes</h2>
     <div class="card">
         <form action="/clientes/saldo" method="get">
             <label>Selecciona un cliente</label>
-            <select name="cliente_id">{opciones}</select>
+            {cliente_autocomplete_html()}
             <button class="btn btn-primary" type="submit">Ver saldo</button>
         </form>
     </div>
     """
     return layout(request, "Saldos clientes", body)
 
-@app.get("/clientes/saldo", response_class=HTMLResponse)
-def saldo_cliente(request: Request, cliente_id: int):
+@app.get("/clientes/cartera", response_class=HTMLResponse)
+def clientes_cartera(request: Request, despues: str = "", conn=Depends(get_db)):
     guard = ensure_role(request, ["Caja"])
     if guard:
         return guard
 
-    conn = get_conn()
-    c = conn.cursor(cursor_factory=RealDictCursor) if IS_POSTGRES else conn.cursor()
-
-    db_execute(c, "SELECT nombre FROM clientes WHERE id = ?", (cliente_id,))
-    row = c.fetchone()
-    if not row:
-        close_conn(conn)
-        return error_card(request, "Cliente no encontrado.")
+    PER_PAGE = 100
+    hoy = date.today()
+    # límites de cada tramo: cargos con fecha_hora >= desde
+    desde = [(hoy - timedelta(days=fin)).isoformat() for _, fin in CARTERA_TRAMOS]
 
-    nombre = row["nombre"]
+    c = db_cursor(conn)
 
+    # totales: una pasada sobre saldos_clientes (una fila por cliente)
     db_execute(c, """
-        SELECT tipo, referencia_id, monto, fecha_hora
-        FROM movimientos_cliente
-        WHERE cliente_id = ?
-        ORDER BY fecha_hora
-    """, (cliente_id,))
-    movs = c.fetchall()
-    close_conn(conn)
+        SELECT COUNT(*) AS deudores, COALESCE(SUM(saldo), 0) AS total
+        FROM saldos_clientes WHERE saldo > 0
+    """)
+    tot = c.fetchone()
+
+    # página de clientes de mayor a menor saldo (índice idx_saldos_saldo)
+    cur_despues = cursor_decode(despues)
+    cond, params = "", ()
+    if cur_despues is not None:
+        cond, params = "AND (s.saldo, s.cliente_id) < (?, ?)", (float(cur_despues[0]), int(cur_despues[1]))
+    db_execute(c, f"""
+        SELECT s.cliente_id, cl.nombre, s.saldo, s.ultimo_pago, s.ultimo_movimiento
+        FROM saldos_clientes s
+        JOIN clientes cl ON cl.id = s.cliente_id
+        WHERE s.saldo > 0 {cond}
+        ORDER BY s.saldo DESC, s.cliente_id DESC
+        LIMIT ?
+    """, params + (PER_PAGE + 1,))
+    filas_db, hay_mas = pagina_keyset(c.fetchall(), PER_PAGE, False)
+
+    # cargos de los últimos 60 días de los clientes de la página, por tramo (1 query)
+    cargos = {}
+    if filas_db:
+        ids = [r["cliente_id"] for r in filas_db]
+        ph = ",".join(["?"] * len(ids))
+        db_execute(c, f"""
+            SELECT cliente_id,
+                   SUM(CASE WHEN fecha_hora >= ? THEN monto ELSE 0 END) AS t0,
+                   SUM(CASE WHEN fecha_hora < ? AND fecha_hora >= ? THEN monto ELSE 0 END) AS t1,
+                   SUM(CASE WHEN fecha_hora < ? THEN monto ELSE 0 END) AS t2
+            FROM movimientos_cliente
+            WHERE cliente_id IN ({ph}) AND fecha_hora >= ? AND monto > 0
+            GROUP BY cliente_id
+        """, (desde[0], desde[0], desde[1], desde[1], *ids, desde[2]))
+        for r in c.fetchall():
+            cargos[r["cliente_id"]] = [r["t0"] or 0, r["t1"] or 0, r["t2"] or 0]
 
-    saldo = 0.0
-    filas = ""
-    for m in movs:
-        saldo += float(m["monto"])
-        filas += f"""
+    rows_html = ""
+    for r in filas_db:
+        saldo = float(r["saldo"])
+        tramos = antiguedad_saldo(saldo, cargos.get(r["cliente_id"], [0, 0, 0]))
+        celdas = "".join(f"<td>{t:.2f}</td>" if t else "<td>-</td>" for t in tramos)
+        rows_html += f"""
         <tr>
-            <td>{m['fecha_hora']}</td>
-            <td>{m['tipo']}</td>
-            <td>{m['referencia_id']}</td>
-            <td>{float(m['monto']):+.2f}</td>
-            <td>{saldo:.2f}</td>
+            <td>{r['cliente_id']}</td>
+            <td><a href="/clientes/saldo?cliente_id={r['cliente_id']}">{r['nombre']}</a></td>
+            <td><b>{saldo:.2f}</b></td>
+            {celdas}
+            <td>{(r['ultimo_pago'] or '-')[:10]}</td>
+            <td>{(r['ultimo_movimiento'] or '-')[:10]}</td>
         </tr>
         """
 
+    link_siguiente = (
+        f"<a class='btn btn-secondary' href='/clientes/cartera?despues={cursor_encode(float(filas_db[-1]['saldo']), filas_db[-1]['cliente_id'])}'>Siguiente →</a>"
+        if filas_db and hay_mas else ""
+    )
+    encabezados_tramos = "".join(f"<th>{ini}-{fin} días</th>" for ini, fin in CARTERA_TRAMOS)
+
     body = f"""
-    <h2>Estado de cuenta: {nombre}</h2>
+    <h2>Cartera de clientes</h2>
     <div class="card">
+        <p>
+            Clientes con saldo: <b>{int(tot['deudores'])}</b> —
+            Total por cobrar: <b>${float(tot['total']):.2f}</b>
+        </p>
         <table>
             <thead>
                 <tr>
-                    <th>Fecha/hora</th>
-                    <th>Tipo</th>
-                    <th>Referencia</th>
-                    <th>Monto</th>
+                    <th>ID</th>
+                    <th>Cliente</th>
                     <th>Saldo</th>
+                    {encabezados_tramos}
+                    <th>+60 días</th>
+                    <th>Último abono</th>
+                    <th>Último movimiento</th>
                 </tr>
             </thead>
             <tbody>
-                {filas or "<tr><td colspan='5'>Sin movimientos</td></tr>"}
+                {rows_html or "<tr><td colspan='9'>Ningún cliente debe</td></tr>"}
             </tbody>
         </table>
-        <p><strong>Saldo final:</strong> ${saldo:.2f}</p>
+    </div>
+    <div class="card">
+        <a class="btn btn-secondary" href="/clientes/cartera">« Inicio</a>
+        {link_siguiente}
     </div>
     """
-    return layout(request, "Saldo cliente", body)
+    return layout(request, "Cartera", body)
+
+@app.get("/clientes/saldo", response_class=HTMLResponse)
+def saldo_cliente(
+    request: Request,
+    cliente_id: int,
+    despues: str = "",
+    antes: str = "",
+    conn=Depends(get_db),
+):
+    guard = ensure_role(request, ["Caja"])
+    if guard:
+        return guard
+
+    PER_PAGE = 50
+
+    c = db_cursor(conn)
+
+    db_execute(c, "SELECT nombre FROM clientes WHERE id = ?", (cliente_id,))
+    row = c.fetchone()
+    if not row:
+        return error_card(request, "Cliente no encontrado.")
+
+    nombre = row["nombre"]
+    saldo = saldo_actual(c, cliente_id)
+
+    # por default los últimos PER_PAGE movimientos; el saldo de cada fila ya
+    # viene guardado, no hay que sumar desde el inicio de la historia
+    cur_despues = cursor_decode(despues)
+    cur_antes = cursor_decode(antes)
+    hacia_atras = cur_despues is None
+    params = [cliente_id]
+    cond = ""
+    if cur_despues is not None:
+        cond = "AND (fecha_hora, id) > (?, ?)"
+        params += [str(cur_despues[0]), int(cur_despues[1])]
+    elif cur_antes is not None:
+        cond = "AND (fecha_hora, id) < (?, ?)"
+        params += [str(cur_antes[0]), int(cur_antes[1])]
+    orden = "DESC" if hacia_atras else "ASC"
+
+    base_url = f"/clientes/saldo?cliente_id={cliente_id}"
+
+    def contenido():
+        yield f"""
+        <h2>Estado de cuenta: {nombre}</h2>
+        <div class="card">
+            <p><strong>Saldo actual:</strong> ${saldo:.2f}</p>
+            <table>
+                <thead>
+                    <tr>
+                        <th>Fecha/hora</th>
+                        <th>Tipo</th>
+                        <th>Referencia</th>
+                        <th>Monto</th>
+                        <th>Saldo</th>
+                    </tr>
+                </thead>
+                <tbody>
+        """
+
+        db_execute(c, f"""
+            SELECT id, tipo, referencia_id, monto, saldo_despues, fecha_hora
+            FROM movimientos_cliente
+            WHERE cliente_id = ? {cond}
+            ORDER BY fecha_hora {orden}, id {orden}
+            LIMIT ?
+        """, tuple(params) + (PER_PAGE + 1,))
+
+        pagina = PaginaKeyset(c, PER_PAGE, hacia_atras)
+        for m in pagina:
+            saldo_fila = f"{float(m['saldo_despues']):.2f}" if m["saldo_despues"] is not None else "-"
+            yield f"""
+            <tr>
+                <td>{m['fecha_hora']}</td>
+                <td>{m['tipo']}</td>
+                <td>{m['referencia_id']}</td>
+                <td>{float(m['monto']):+.2f}</td>
+                <td>{saldo_fila}</td>
+            </tr>
+            """
+
+        if pagina.primera is None:
+            yield "<tr><td colspan='5'>Sin movimientos</td></tr>"
+
+        hay_anteriores = pagina.hay_mas if hacia_atras else True
+        hay_siguientes = (cur_antes is not None) if hacia_atras else pagina.hay_mas
+        primera, ultima = pagina.primera, pagina.ultima
+        link_anteriores = (
+            f"<a class='btn btn-secondary' href='{base_url}&antes={cursor_encode(primera['fecha_hora'], primera['id'])}'>← Anteriores</a>"
+            if primera and hay_anteriores else ""
+        )
+        link_siguientes = (
+            f"<a class='btn btn-secondary' href='{base_url}&despues={cursor_encode(ultima['fecha_hora'], ultima['id'])}'>Siguientes →</a>"
+            if ultima and hay_siguientes else ""
+        )
+
+        yield f"""
+                </tbody>
+            </table>
+            <p>
+                {link_anteriores}
+                <a class="btn btn-secondary" href="{base_url}">Últimos movimientos</a>
+                {link_siguientes}
+            </p>
+        </div>
+        """
+
+    return layout_stream(request, "Saldo cliente", contenido())